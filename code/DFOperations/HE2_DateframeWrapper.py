@@ -8,8 +8,13 @@ def process_error():
     pass
 
 
+result_cols = ['mass_flow', 'flow_direction', 'result_start_P', 'result_start_T', 'result_end_P', 'result_end_T']
 iii = 0
-def solve_and_put_results_to_dataframe(input_df):
+def solve_and_put_results_to_dataframe(input_df, return_solver=False):
+    '''
+    :param return_solver: return graph and solver too, so caller can evaluate sensitivities on the solution
+    :return: result_df, or (result_df, G, solver). result_df is None, if solution is not found
+    '''
     global iii
     iii += 1
     df_pipes, df_bnds = tools.split_input_df_to_pipes_and_boundaries(input_df)
@@ -17,23 +22,23 @@ def solve_and_put_results_to_dataframe(input_df):
     G = sm.make_multigraph_schema_from_OISPipe_dataframes(df_pipes, df_bnds)
 
     solver = HE2_Solver(G)
-    solver.solve()
+    # Results are checked by 1e-3 residual, so solve is converged below it
+    solver.solve(threshold=1e-4, method='newton')
     op_result = solver.op_result
     if op_result.fun > 1e-3:
         process_error()
-        return None
+        return (None, G, solver) if return_solver else None
 
-    resd1, resd2 = tools.check_solution(G)
+    resd1, resd2 = tools.evaluate_1stCL_residual(G), tools.evaluate_2ndCL_residual(G)
     if resd1 + resd2 > 1e-3:
         process_error()
-        return None
+        return (None, G, solver) if return_solver else None
 
     # tools.draw_solution(G, shifts=None, p_nodes=[], sources=[], sinks=[], juncs=[])
 
-    result_cols = ['mass_flow', 'flow_direction', 'result_start_P', 'result_start_T', 'result_end_P', 'result_end_T']
     result_df = input_df.copy()
     for col in result_cols:
-        result_df[col] = 0
+        result_df[col] = 0.
 
     for u, v, k in G.edges:
         idx = G[u][v][k]["idx_for_result"]
@@ -47,6 +52,8 @@ def solve_and_put_results_to_dataframe(input_df):
         x = obj.result['x']
         dir = np.sign(x)
         result_df.loc[idx, result_cols] = [abs(x), dir, P1, T1, P2, T2]
+    if return_solver:
+        return result_df, G, solver
     return result_df
 
 def do_upcase_columns_adhoc(columns):
@@ -82,12 +89,11 @@ def transform_measure_units(df):
     df['end_Q'] = df.end_Q * 1000 / 86400
     return df
 
-def do_predict(input_df):
+def do_predict(input_df, return_solver=False):
     df = input_df
     df.columns = do_upcase_columns_adhoc(df.columns)
     df = transform_measure_units(df)
-    result_df = solve_and_put_results_to_dataframe(df)
-    return result_df
+    return solve_and_put_results_to_dataframe(df, return_solver)
 
 
 if __name__ == '__main__':
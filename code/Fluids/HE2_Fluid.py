@@ -1,10 +1,13 @@
 from Hydraulics.Properties.Mishenko import Mishenko, from_oil_params
-from Tools.HE2_ABC import HE2_ABC_Fluid, oil_params
+from Tools.HE2_ABC import HE2_ABC_Fluid, oil_params, fieldlist
 from typing import List, Tuple
 import numpy as np
 from Tools.HE2_Logger import getLogger
 logger = getLogger(__name__)
 
+# Take flow independent properties from PVT tables, see Mishenko.get_pvt_table()
+use_pvt_tables = False
+
 class HE2_DummyWater(HE2_ABC_Fluid):
     def __init__(self):
         self.rho_wat_kgm3 = 1000
@@ -27,7 +30,7 @@ class HE2_BlackOil(HE2_ABC_Fluid):
         calc_params = self.oil_params
 
         tubing = {"IntDiameter": IntDiameter} if IntDiameter else None
-        temp_mishenko = from_oil_params(P_for_PVT, T_C, X_kgsec, calc_params=calc_params, tubing=tubing)
+        temp_mishenko = from_oil_params(P_for_PVT, T_C, X_kgsec, calc_params=calc_params, tubing=tubing, use_table=use_pvt_tables)
         #Side effects
         self.CurrentLiquidDensity_kg_m3 = temp_mishenko.CurrentLiquidDensity_kg_m3
         self.CurrentOilViscosity_Pa_s = temp_mishenko.CurrentOilViscosity_Pa_s
@@ -35,6 +38,68 @@ class HE2_BlackOil(HE2_ABC_Fluid):
         return temp_mishenko
 
 
+class HE2_FluidTable():
+    '''
+    Network wide fluids storage. One float row per fluid, columns are oil_params fields (fieldlist).
+    Solver keeps edges fluids here, so fluids are mixed by array operations, see mix_fluid_rows()
+    '''
+    def __init__(self, n):
+        self.rows = np.zeros((n, len(fieldlist)))
+        self.liquid_density = np.zeros(n)
+        self.params = [None] * n # oil_params tuples, are built on demand for python edges
+
+    def set_rows(self, idx, rows):
+        self.rows[idx] = rows
+        self.liquid_density[idx] = initial_liquid_density(self.rows[idx])
+        for i in idx:
+            self.params[i] = None
+
+    def get_oil_params(self, i):
+        op = self.params[i]
+        if op is None:
+            op = oil_params(*self.rows[i].tolist())
+            self.params[i] = op
+        return op
+
+
+class HE2_TableFluid(HE2_BlackOil):
+    '''
+    HE2_BlackOil, which oil_params is a row of HE2_FluidTable. Row can be changed by table owner, fluid object is kept
+    '''
+    def __init__(self, table: HE2_FluidTable, idx):
+        self.table = table
+        self.idx = idx
+
+    @property
+    def oil_params(self):
+        return self.table.get_oil_params(self.idx)
+
+    @property
+    def CurrentLiquidDensity_kg_m3(self):
+        return self.table.liquid_density[self.idx]
+
+    @CurrentLiquidDensity_kg_m3.setter
+    def CurrentLiquidDensity_kg_m3(self, value):
+        self.table.liquid_density[self.idx] = value
+
+
+def gimme_fluids_table(fluids):
+    '''
+    :return: HE2_FluidTable, if all the fluids are rows of the same table, None otherwise
+    '''
+    if not fluids or type(fluids[0]) != HE2_TableFluid:
+        return None
+    table = fluids[0].table
+    if all(type(fluid) == HE2_TableFluid and fluid.table is table for fluid in fluids):
+        return table
+    return None
+
+
+def initial_liquid_density(rows):
+    wc = rows[:, 7] / 100
+    return rows[:, 3] * (1 - wc) + rows[:, 4] * wc
+
+
 # fieldlist = ['sat_P_bar', 'plastT_C', 'gasFactor', 'oildensity_kg_m3', 'waterdensity_kg_m3', 'gasdensity_kg_m3',
 #             'oilviscosity_Pa_s', 'volumewater_percent', 'volumeoilcoeff']
 # oil_params = namedtuple('oil_params', fieldlist)
@@ -148,6 +213,73 @@ def dot_product(xs_vec, fluids, fluid_vectors=None, oil_ro = None, wat_ro = None
     return rez
 
 
+def make_fluid_rows_vectors(rows):
+    '''
+    The same as make_fluid_vectors(), for fluids table rows
+    :return: matrix fluids x (Qo, Qw, Qg, Xo, Xw, Xg), phases volumes and masses per 1 kg of fluid
+    '''
+    gf, oil_ro, wat_ro, gas_ro = rows[:, 2], rows[:, 3], rows[:, 4], rows[:, 5]
+    wc = rows[:, 7] * 0.01
+    Q_owg = 1 / (oil_ro * (1 - wc) + wat_ro * wc + gas_ro * (1 - wc) * gf)
+    Qo, Qw, Qg = (1 - wc) * Q_owg, wc * Q_owg, (1 - wc) * gf * Q_owg
+    return np.column_stack((Qo, Qw, Qg, Qo * oil_ro, Qw * wat_ro, Qg * gas_ro))
+
+
+def fluid_rows_by_vectors(vectors, base_row, oil_ro=None, wat_ro=None, gas_ro=None, gf=None):
+    '''
+    Inverse of make_fluid_rows_vectors(). Fields which are not mixed are taken from base_row, like dot_product() does
+    '''
+    Qo, Qw, Qg, Xo, Xw, Xg = vectors.T
+    rez = np.empty((len(vectors), len(fieldlist)))
+    rez[:] = base_row
+    rez[:, 2] = Qg / Qo if gf is None else gf
+    rez[:, 3] = Xo / Qo if oil_ro is None else oil_ro
+    rez[:, 4] = Xw / Qw if wat_ro is None else wat_ro
+    rez[:, 5] = Xg / Qg if gas_ro is None else gas_ro
+    rez[:, 7] = Qw / (Qo + Qw) * 100
+    return rez
+
+
+def mix_fluid_rows(cocktails, src_rows, src_vectors=None, **constants):
+    '''
+    Vectorized dot_product(), all the fluids are mixed by one matrix product
+    :param cocktails: matrix fluids x sources, mass shares
+    :param src_rows: sources fluids rows, see HE2_FluidTable
+    :param src_vectors: make_fluid_rows_vectors(src_rows), if it is already known
+    :param constants: oil_ro, wat_ro, gas_ro, gf, see dot_product()
+    :return: fluids rows
+    '''
+    if src_vectors is None:
+        src_vectors = make_fluid_rows_vectors(src_rows)
+    rez = fluid_rows_by_vectors(cocktails @ src_vectors, src_rows[0], **constants)
+    # Pure source fluid is taken as is
+    k = cocktails.argmax(axis=1)
+    pure = cocktails[np.arange(len(k)), k] == 1
+    rez[pure] = src_rows[k[pure]]
+    return rez
+
+
+def dot_product_batch(cocktails, fluids, fluid_vectors=None, oil_ro=None, wat_ro=None, gas_ro=None, gf=None):
+    '''
+    dot_product() for many cocktails at once
+    :param cocktails: matrix n x len(fluids)
+    :param fluid_vectors: make_fluid_vectors(fluids) output
+    :return: matrix n x len(fieldlist), oil_params of mixed fluids
+    '''
+    if fluid_vectors is None:
+        fluid_vectors = make_fluid_vectors(fluids)
+    src_rows = np.array([fl.oil_params for fl in fluids], dtype=float).reshape((len(fluids), len(fieldlist)))
+    return mix_fluid_rows(cocktails, src_rows, np.column_stack(fluid_vectors), oil_ro=oil_ro, wat_ro=wat_ro, gas_ro=gas_ro, gf=gf)
+
+
+def blend_fluid_rows(rows_a, rows_b, rate_b, **constants):
+    '''
+    Row by row dot_product([1 - rate_b, rate_b], [fluid_a, fluid_b])
+    '''
+    vectors = (1 - rate_b) * make_fluid_rows_vectors(rows_a) + rate_b * make_fluid_rows_vectors(rows_b)
+    return fluid_rows_by_vectors(vectors, rows_a, **constants)
+
+
 def gimme_dummy_oil_params(volumeWater=50):
     rez = oil_params(sat_P_bar = 66.7, plastT_C = 84, gasFactor = 39, oildensity_kg_m3 = 826,
                      waterdensity_kg_m3 = 1015, gasdensity_kg_m3 = 1, oilviscosity_Pa_s = 35e-3, volumewater_percent = volumeWater, volumeoilcoeff = 1.015)
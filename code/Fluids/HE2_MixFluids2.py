@@ -1,5 +1,8 @@
 import networkx as nx
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from numba import njit
 from Tools.HE2_ABC import Root
 from Tools.HE2_Logger import getLogger
 from Tools.HE2_SolverInternalViewer import plot_neighbours_subgraph as plot_nghbs
@@ -8,32 +11,229 @@ from typing import Tuple, Dict
 
 logger = getLogger(__name__)
 
-reduced_graph = None
-mappings = None
-
-def evalute_network_fluids_with_root(solver_G, x_dict, have_to_reduce = False):
-    # This is like a nested doll
-    # Outer layer - solver call with solver graph and xs (flows)
-    # Second layer - we remove root node and zero flows, also reverse negative flows
-    # Third layer - we reduce graph removing 2-degree nodes and parallel edges, cause it does not affect to solultion
-    # Internal layer - on reduced graph we build mass conservation equation matrix and solve it
-    # Than, from deep to surface, we rebuild solution on each layer
-    global reduced_graph, mappings
-    if reduced_graph is None or have_to_reduce:
-        reduced_graph, mappings = make_small_graph_for_mixer(solver_G, removeRoot=True)
-
-    G2 = reduced_graph
-    x_dict2 = build_x_dict_for_reduced_graph(G2, x_dict, **mappings)
-    edges1, edges2, x_dict3 = revert_edges_to_make_all_flows_positive(G2, x_dict2)
-
-    G3 = nx.DiGraph(edges2)
-    cocktails3, srcs = evalute_network_fluids_wo_root(G3, x_dict3)
-
-    cocktails2 = restore_reverted_edges_cocktails(cocktails3, edges1, edges2)
-
-    cocktails = restore_cocktail_from_reduced_graph(cocktails2, srcs, x_dict2, **mappings)
-
-    return cocktails, srcs
+def evalute_network_fluids_with_root(solver_G, x_dict, have_to_reduce = True, reduction = None):
+    '''
+    Stateless version of FluidMixer.evaluate_network_fluids(), graph is reduced on every call (if reduction is not given).
+    have_to_reduce is kept for compatibility, solvers use their own FluidMixer to reduce graph once
+    '''
+    return FluidMixer(solver_G, reduction).evaluate_network_fluids(x_dict)
+
+
+class FluidMixer():
+    '''
+    Evaluates fluids cocktails on solver graph edges.
+    This is like a nested doll
+    Outer layer - solver call with solver graph and xs (flows)
+    Second layer - we remove root node and zero flows, also reverse negative flows
+    Third layer - we reduce graph removing 2-degree nodes and parallel edges, cause it does not affect to solultion
+    Internal layer - on reduced graph we build mass conservation equation matrix and solve it
+    Than, from deep to surface, we rebuild solution on each layer
+
+    Reduction depends on topology only, so it is evaluated once, and all the layers work on index arrays built here.
+    Mixer does not change its state in evaluate_network_fluids(), so it can be shared by solvers of the same topology
+    '''
+    def __init__(self, solver_G, reduction=None):
+        if reduction is None:
+            reduction = make_small_graph_for_mixer(solver_G, removeRoot=True)
+        self.reduction = reduction
+        self.reduced_graph, self.mappings = reduction
+        G2 = self.reduced_graph
+        self.edges = list(G2.edges) # reduced graph edges, cocktails are evaluated for them
+        self.nodes = list(G2.nodes)
+        node_idx = {n: i for i, n in enumerate(self.nodes)}
+        self.u = np.array([node_idx[u] for u, v in self.edges], dtype=np.int64)
+        self.v = np.array([node_idx[v] for u, v in self.edges], dtype=np.int64)
+
+        # Reduced graph flows are sums of original edges flows, with signs. x2 = x_pos - x_neg
+        self.x_edges = []
+        x_edge_idx = dict()
+        idx = dict(pos=([], []), neg=([], []))
+        for key in ['pos', 'neg']:
+            em = self.mappings[f'x_{key}_em']
+            for i, e2 in enumerate(self.edges):
+                for e in em.get(e2, []):
+                    if e not in x_edge_idx:
+                        x_edge_idx[e] = len(self.x_edges)
+                        self.x_edges += [e]
+                    idx[key][0].append(i)
+                    idx[key][1].append(x_edge_idx[e])
+        self.pos_red, self.pos_x = np.array(idx['pos'][0], dtype=np.int64), np.array(idx['pos'][1], dtype=np.int64)
+        self.neg_red, self.neg_x = np.array(idx['neg'][0], dtype=np.int64), np.array(idx['neg'][1], dtype=np.int64)
+        self.fluid_em = [self.mappings['fluid_em'][e2] for e2 in self.edges]
+
+    def reduced_graph_flows(self, x_dict):
+        '''
+        The same as build_x_dict_for_reduced_graph(), but returns vector in self.edges order
+        '''
+        x = np.fromiter((x_dict[e] for e in self.x_edges), dtype=float, count=len(self.x_edges))
+        E2 = len(self.edges)
+        x2 = np.bincount(self.pos_red, weights=x[self.pos_x], minlength=E2)
+        x2 -= np.bincount(self.neg_red, weights=x[self.neg_x], minlength=E2)
+        return x2
+
+    def evaluate_network_fluids(self, x_dict):
+        '''
+        :param x_dict: solver graph edges flows
+        :return: cocktails dict (solver graph edge -> vector of sources shares) and sources list
+        '''
+        x2 = self.reduced_graph_flows(x_dict)
+        # Negative flows are reverted
+        reverted = x2 < 0
+        u = np.where(reverted, self.v, self.u)
+        v = np.where(reverted, self.u, self.v)
+        x3 = np.abs(x2)
+
+        cktls, srcs = self.evaluate_reduced_graph_fluids(u, v, x3)
+
+        cocktails = {}
+        for i, cktl in cktls.items():
+            cktl = np.around(cktl, 6)
+            for edge in self.fluid_em[i]:
+                cocktails[edge] = cktl
+        return cocktails, srcs
+
+    def reduced_edges_index(self, keys):
+        '''
+        :param keys: solver graph edges (or nodes)
+        :return: index of reduced graph edge, which cocktail the key gets, -1 if there is no one
+        '''
+        key_idx = {key: i for i, em in enumerate(self.fluid_em) for key in em}
+        return np.array([key_idx.get(key, -1) for key in keys], dtype=np.int64)
+
+    def evaluate_network_cocktails(self, x_dict, keys_idx):
+        '''
+        Matrix form of evaluate_network_fluids()
+        :param keys_idx: see reduced_edges_index()
+        :return: cocktails matrix (keys with cocktail x sources), mask of keys with cocktail, sources list
+        '''
+        x2 = self.reduced_graph_flows(x_dict)
+        reverted = x2 < 0
+        u = np.where(reverted, self.v, self.u)
+        v = np.where(reverted, self.u, self.v)
+        active, rez_mx, srcs = self.evaluate_reduced_graph_cocktails(u, v, np.abs(x2))
+        return self.gimme_keys_cocktails(active, rez_mx, keys_idx) + (srcs,)
+
+    def gimme_keys_cocktails(self, active, rez_mx, keys_idx):
+        row = np.full(len(self.edges) + 1, -1, dtype=np.int64) # The last one is for keys without reduced edge
+        row[active] = np.arange(len(active))
+        key_rows = row[keys_idx]
+        mask = key_rows >= 0
+        return np.around(rez_mx[key_rows[mask]], 6), mask
+
+    def evaluate_network_cocktails_incremental(self, x_dict, keys_idx, state, rtol=1e-6):
+        '''
+        evaluate_network_cocktails(), which reuses the previous call results. Mixer is skipped at all, if flows directions
+        are the same and flows relative changes are less than rtol. Otherwise only nodes downstream of changed edges
+        are evaluated again. If sources are changed, all the nodes are evaluated
+        :param state: dict, previous call results are kept here. It is owned by caller, so mixer can be shared still
+        :return: the same as evaluate_network_cocktails(). Result is the same object, if mixer is skipped
+        '''
+        x2 = self.reduced_graph_flows(x_dict)
+        x = np.abs(x2)
+        pattern = np.where(x < 1e-7, 0, np.sign(x2))
+        reverted = x2 < 0
+        u = np.where(reverted, self.v, self.u)
+        v = np.where(reverted, self.u, self.v)
+        if state.get('keys_idx', None) is keys_idx and rtol is not None:
+            changed = (pattern != state['pattern']) | ((pattern != 0) & (np.abs(x2 - state['x2']) > rtol * np.abs(state['x2'])))
+            if not np.any(changed):
+                state['skipped'] = state.get('skipped', 0) + 1
+                return state['result']
+            C = self.update_nodes_cocktails(u, v, x, pattern != 0, changed, state)
+            if C is not None:
+                state['incremental'] = state.get('incremental', 0) + 1
+                state.update(x2=x2, pattern=pattern, C=C)
+                active = np.flatnonzero(pattern != 0)
+                state['result'] = self.gimme_keys_cocktails(active, C[u[active]], keys_idx) + (state['srcs'],)
+                return state['result']
+
+        active, C, src_nodes = self.mix_reduced_graph(u, v, x)
+        srcs = [self.nodes[n] for n in src_nodes]
+        state.update(keys_idx=keys_idx, x2=x2, pattern=pattern, C=C, src_nodes=src_nodes, srcs=srcs)
+        state['result'] = self.gimme_keys_cocktails(active, C[u[active]], keys_idx) + (srcs,)
+        return state['result']
+
+    def update_nodes_cocktails(self, u, v, x, is_active, changed, state):
+        '''
+        Nodes downstream of changed edges are evaluated again, other nodes cocktails are taken from state.
+        Flows from other nodes to the region are known, so they are injections, like sources flows are
+        :return: nodes cocktails, or None if sources are changed
+        '''
+        N = len(self.nodes)
+        ua, va, xa = u[is_active], v[is_active], x[is_active]
+        Q = np.bincount(ua, weights=xa, minlength=N) - np.bincount(va, weights=xa, minlength=N)
+        src_nodes = np.flatnonzero(Q > 1e-7)
+        if not np.array_equal(np.sort(src_nodes), np.sort(state['src_nodes'])):
+            return None
+        is_node_active = np.zeros(N, dtype=np.bool_)
+        is_node_active[ua] = True
+        is_node_active[va] = True
+        seeds = np.unique(np.concatenate((u[changed], v[changed])))
+        seeds = seeds[is_node_active[seeds]]
+        in_region = downstream_closure(N, ua, va, seeds)
+        region = np.flatnonzero(in_region)
+        row = np.full(N, -1, dtype=np.int64)
+        row[region] = np.arange(len(region))
+
+        C_old = state['C']
+        S = C_old.shape[1]
+        denom = np.bincount(ua, weights=xa, minlength=N) - np.where(Q < -1e-7, Q, 0)
+        inj = np.zeros((len(region), S))
+        src_cols = np.arange(S)
+        src_in_region = in_region[state['src_nodes']]
+        inj[row[state['src_nodes'][src_in_region]], src_cols[src_in_region]] = Q[state['src_nodes'][src_in_region]]
+        inlet = ~in_region[ua] & in_region[va]
+        np.add.at(inj, row[va[inlet]], xa[inlet].reshape((-1, 1)) * C_old[ua[inlet]])
+        inner = in_region[ua] & in_region[va]
+        C_region = solve_nodes_cocktails(len(region), row[ua[inner]], row[va[inner]], xa[inner], denom[region], inj)
+        if np.any(np.abs(C_region.sum(axis=1) - 1) > 1e-7):
+            logger.error('Cocktail matrix is invalid')
+            raise ValueError
+        C = C_old.copy()
+        C[region] = C_region
+        return C
+
+    def evaluate_reduced_graph_fluids(self, u, v, x):
+        '''
+        The same as evalute_network_fluids_wo_root(), on reduced graph with all flows positive
+        :return: cocktails dict (reduced edge index -> vector of sources shares), sources list
+        '''
+        active, rez_mx, srcs = self.evaluate_reduced_graph_cocktails(u, v, x)
+        return dict(zip(active, rez_mx)), srcs
+
+    def evaluate_reduced_graph_cocktails(self, u, v, x):
+        '''
+        :return: active (with not zero flow) reduced edges, cocktails matrix for them, sources list
+        '''
+        active, C, src_nodes = self.mix_reduced_graph(u, v, x)
+        return active, C[u[active]], [self.nodes[n] for n in src_nodes]
+
+    def mix_reduced_graph(self, u, v, x):
+        '''
+        :return: active (with not zero flow) reduced edges, cocktails matrix for all the reduced graph nodes, sources nodes
+        '''
+        # Nodes are ordered as they appear in edges list, like networkx does. It keeps sources order stable
+        appearance = np.full(len(self.nodes), len(u) * 2)
+        uv = np.column_stack((u, v)).flatten()
+        np.minimum.at(appearance, uv, np.arange(len(uv)))
+
+        active = np.flatnonzero(x >= 1e-7)
+        u, v, x = u[active], v[active], x[active]
+        EN = len(active)
+        if EN == 0:
+            return active, np.zeros((len(self.nodes), 0)), np.zeros(0, dtype=np.int64)
+        nodes = np.unique(np.concatenate((u, v)))
+        nodes = nodes[np.argsort(appearance[nodes], kind='stable')]
+        N = len(nodes)
+        row = np.zeros(len(self.nodes), dtype=np.int64)
+        row[nodes] = np.arange(N)
+        ru, rv = row[u], row[v]
+
+        Q = np.bincount(ru, weights=x, minlength=N) - np.bincount(rv, weights=x, minlength=N)
+        C, src_rows = evaluate_nodes_cocktails(N, ru, rv, x, Q)
+        C_all = np.zeros((len(self.nodes), C.shape[1]))
+        C_all[nodes] = C
+        return active, C_all, nodes[src_rows]
 
 
 def revert_edges_to_make_all_flows_positive(G2, x_dict2):
@@ -216,6 +416,117 @@ def make_small_graph_for_mixer(solver_G: nx.DiGraph, removeRoot: bool = True) ->
 
     return rez_G, dict(fluid_em=rez_fluid_em, x_pos_em=rez_pos_em, x_neg_em=rez_neg_em)
 
+@njit(cache=True)
+def mix_by_topological_sweep(N, u, v, x, denom, inj):
+    '''
+    Nodes cocktails for acyclic flows. Nodes are evaluated in topological order (Kahn algorithm), so all the inlet
+    cocktails are known when the node is evaluated
+    :return: cocktails matrix and flag, False if flows have a cycle
+    '''
+    E = len(u)
+    indeg = np.zeros(N, dtype=np.int64)
+    start = np.zeros(N + 1, dtype=np.int64)
+    for e in range(E):
+        indeg[v[e]] += 1
+        start[u[e] + 1] += 1
+    start = np.cumsum(start)
+    pos = start[:-1].copy()
+    out_edges = np.empty(E, dtype=np.int64)
+    for e in range(E):
+        out_edges[pos[u[e]]] = e
+        pos[u[e]] += 1
+
+    queue = np.empty(N, dtype=np.int64)
+    head, tail = 0, 0
+    for n in range(N):
+        if indeg[n] == 0:
+            queue[tail] = n
+            tail += 1
+    acc = inj.copy()
+    C = np.zeros(inj.shape)
+    while head < tail:
+        n = queue[head]
+        head += 1
+        C[n] = acc[n] / denom[n]
+        for k in range(start[n], start[n + 1]):
+            e = out_edges[k]
+            w = v[e]
+            acc[w] += x[e] * C[n]
+            indeg[w] -= 1
+            if indeg[w] == 0:
+                queue[tail] = w
+                tail += 1
+    return C, tail == N
+
+
+def solve_nodes_cocktails(N, u, v, x, denom, inj):
+    '''
+    C[n] * denom[n] = sum(x[e] * C[u[e]] for inlet edges) + inj[n]
+    '''
+    C, is_dag = mix_by_topological_sweep(N, u, v, x, denom, inj)
+    if not is_dag:
+        idx = np.arange(N)
+        K = sp.csc_matrix((np.concatenate((denom, -x)), (np.concatenate((idx, v)), np.concatenate((idx, u)))), shape=(N, N))
+        C = spla.splu(K).solve(inj)
+    return C
+
+
+@njit(cache=True)
+def downstream_closure(N, u, v, seeds):
+    '''
+    :return: mask of nodes, which are reachable from seeds by edges u -> v
+    '''
+    start = np.zeros(N + 1, dtype=np.int64)
+    for e in range(len(u)):
+        start[u[e] + 1] += 1
+    start = np.cumsum(start)
+    pos = start[:-1].copy()
+    out_nodes = np.empty(len(u), dtype=np.int64)
+    for e in range(len(u)):
+        out_nodes[pos[u[e]]] = v[e]
+        pos[u[e]] += 1
+    mask = np.zeros(N, dtype=np.bool_)
+    stack = np.empty(N, dtype=np.int64)
+    top = 0
+    for n in seeds:
+        if not mask[n]:
+            mask[n] = True
+            stack[top] = n
+            top += 1
+    while top > 0:
+        top -= 1
+        n = stack[top]
+        for k in range(start[n], start[n + 1]):
+            w = out_nodes[k]
+            if not mask[w]:
+                mask[w] = True
+                stack[top] = w
+                top += 1
+    return mask
+
+
+def evaluate_nodes_cocktails(N, u, v, x, Q):
+    '''
+    Fluid leaving the node is the same for all the outlet edges and for sink, so unknowns are nodes cocktails:
+    C[n] * (outflow + sink flow) = sum(x[e] * C[u[e]] for inlet edges) + source flow * source unit vector
+    Acyclic flows are solved by topological sweep, cyclic ones by sparse LU
+    :param u, v, x: edges (nodes indices) and positive flows
+    :param Q: nodes imbalances, outflow - inflow. Positive is source, negative is sink
+    :return: cocktails matrix N x S, sources nodes indices
+    '''
+    src_rows = np.flatnonzero(Q > 1e-7)
+    S = len(src_rows)
+    denom = np.bincount(u, weights=x, minlength=N) - np.where(Q < -1e-7, Q, 0)
+    inj = np.zeros((N, S))
+    inj[src_rows, np.arange(S)] = Q[src_rows]
+    C = solve_nodes_cocktails(N, u, v, x, denom, inj)
+    sums = C.sum(axis=1)
+    if np.any(np.abs(sums - 1) > 1e-7):
+        logger.error('Cocktail matrix is invalid')
+        raise ValueError
+    return C, src_rows
+
+
 def evalute_network_fluids_wo_root(_G, x_dict):
     assert not (Root in _G.nodes)
 
@@ -231,61 +542,17 @@ def evalute_network_fluids_wo_root(_G, x_dict):
 
     nodes = list(G.nodes)
     edges = list(G.edges)
-    EN = len(edges)
     N = len(nodes)
 
     x = np.array([x_dict[e] for e in edges])
-    A = -1 * nx.incidence_matrix(G, nodelist=nodes, edgelist=edges, oriented=True).toarray()
-    Q = np.matmul(A, x)
-    var_idx = {e:i for i, e in enumerate(edges)}
-    sinks = [n for i, n in enumerate(nodes) if Q[i] < -1e-7]
-    var_idx.update({n:i+EN for i, n in enumerate(sinks)})
-    M = len(var_idx)
-    mx1 = np.zeros((N, M)) # the first partition of matrix is for 1stCL
-    mx2 = np.zeros((M-N, M)) # the second partition is to dictate condition: all fluids leaving one node have to be the same
-    i2 = 0
-    for i, node in enumerate(nodes):
-        these_vars_are_the_same = []
-        if node in sinks: # n is sink, so there is an unknown (equation variable) for outbound flow
-            j = var_idx[node] # get the unknown index in matrix
-            mx1[i, j] = Q[i]
-            these_vars_are_the_same += [j] # remember the unknown for a while
-
-        for u, v in G.in_edges(node):  # inlet flows
-            j = var_idx[(u, v)]
-            mx1[i, j] = x_dict[(u, v)]
-
-        for u, v in G.out_edges(node): # all the outlet flows are the same
-            j = var_idx[(u, v)]
-            mx1[i, j] = -x_dict[(u, v)]
-            these_vars_are_the_same += [j] # so we have to remember this unknown too
-
-        if Q[i] > 0:
-            mx1[i] /= -Q[i] # cause we need only ones and zeros on the right side
-
-        if len(these_vars_are_the_same) > 1: # if there are more than one remembered outlet flow
-            for fl1, fl2 in zip(these_vars_are_the_same[1:], these_vars_are_the_same[:-1]):
-                mx2[i2, fl1] = 1  # we have to right an equation to matrix, to describe that these outlet fluids are equal
-                mx2[i2, fl2] = -1
-                i2 += 1
-    mx = np.append(mx1, mx2, axis=0)
-    assert mx.shape == (M, M)
-
-    mx_inv = np.linalg.inv(mx)
-    rez_mx = np.zeros((M, N))
-    srcs = []
-    S = 0
-    for i, n in enumerate(nodes):
-        if Q[i] > 1e-7:
-            rez_mx[:, S] = mx_inv[:,i]
-            srcs += [n]
-            S += 1
-
-    cocktails = {}
-    for k, i in var_idx.items():
-        cocktails[k] = rez_mx[i, :S]
-        sck = cocktails[k].sum()
-        if abs(sck - 1) > 1e-7:
-            logger.error('Cocktail matrix is invalid')
-            raise ValueError
+    node_idx = {n: i for i, n in enumerate(nodes)}
+    u = np.array([node_idx[u] for u, v in edges], dtype=np.int64)
+    v = np.array([node_idx[v] for u, v in edges], dtype=np.int64)
+    Q = np.bincount(u, weights=x, minlength=N) - np.bincount(v, weights=x, minlength=N)
+    C, src_rows = evaluate_nodes_cocktails(N, u, v, x, Q)
+    srcs = [nodes[i] for i in src_rows]
+
+    cocktails = dict(zip(edges, C[u]))
+    for i in np.flatnonzero(Q < -1e-7):
+        cocktails[nodes[i]] = C[i]
     return cocktails, srcs
@@ -4,10 +4,183 @@ import uniflocpy.uTools.uconst as uc
 import numpy as np
 
 import Hydraulics.Methodics.Mukherjee_Brill as mb
+from Hydraulics.Properties.Mishenko import liquid_density_by_oil_params
+from numba import njit
 from functools import lru_cache
 from Tools.HE2_Logger import check_for_nan, getLogger
+from Tools.HE2_Dual import dual
 logger = getLogger(__name__)
 
+# Pipe segment geometry is kept in numpy vector, and pipe keeps segments vectors as columns of one 2D array
+geometry_fields = ['L_m', 'uphill_m', 'inner_diam_m', 'roughness_m', 'angle_dgr']
+
+
+def geometry_property(i):
+    def getter(self):
+        return self.geometry[i]
+    def setter(self, value):
+        self.geometry[i] = np.nan if value is None else value
+    return property(getter, setter)
+
+
+@njit(cache=True)
+def water_friction_gradient(X_kgsec, inner_diam_m, roughness_m, rho_kgm3, mu_pasec):
+    '''
+    The same as HE2_WaterPipeSegment.calc_P_friction_gradient_Pam()
+    :return: friction gradient and its derivative by X, analytically
+    '''
+    D_m = inner_diam_m
+    Area_m2 = uc.pi*D_m**2/4
+    if X_kgsec == 0:
+        return 0., 34 * mu_pasec / (D_m**2 * rho_kgm3 * Area_m2)
+    Q_m3sec = X_kgsec / rho_kgm3
+    V_msec = Q_m3sec / Area_m2
+    Re = rho_kgm3 * V_msec * D_m / mu_pasec
+    if Re < 2300:
+        lambda_fr = 68/ Re
+        dlnlambda = -1.
+    else:
+        lambda_fr = 0.11 * (roughness_m/D_m + 68.5/Re) ** 0.25
+        dlnlambda = -0.25 * (68.5/Re) / (roughness_m/D_m + 68.5/Re)
+    P_fric_grad_Pam = 0.5 * lambda_fr * V_msec**2 * rho_kgm3 / D_m
+    # d ln(grad) / d ln(X) = 2 + d ln(lambda) / d ln(Re)
+    return P_fric_grad_Pam, P_fric_grad_Pam * (2 + dlnlambda) / X_kgsec
+
+
+@njit(cache=True)
+def water_friction_gradient_parameters_derivatives(X_kgsec, inner_diam_m, roughness_m, rho_kgm3, mu_pasec):
+    '''
+    :return: derivatives of water_friction_gradient() by inner diameter and roughness, analytically
+    '''
+    if X_kgsec == 0:
+        return 0., 0.
+    D_m = inner_diam_m
+    P_fric_grad_Pam = water_friction_gradient(X_kgsec, inner_diam_m, roughness_m, rho_kgm3, mu_pasec)[0]
+    V_msec = X_kgsec / rho_kgm3 / (uc.pi*D_m**2/4)
+    Re = rho_kgm3 * V_msec * D_m / mu_pasec
+    # V ~ D^-2 and Re ~ D^-1, so grad ~ lambda * D^-5
+    if Re < 2300:
+        return -4 * P_fric_grad_Pam / D_m, 0.
+    u = roughness_m/D_m + 68.5/Re
+    dlnlambda_dlnD = 0.25 * (68.5/Re - roughness_m/D_m) / u
+    return P_fric_grad_Pam * (dlnlambda_dlnD - 5) / D_m, P_fric_grad_Pam * 0.25 / u / D_m
+
+
+@njit(cache=True)
+def march_water_pipe(P_bar, X_kgsec, geometry, calc_direction, rho_kgm3, mu_pasec):
+    '''
+    The same as HE2_WaterPipeSegment.calc_segment_pressure_drop() for all the pipe segments, one by one
+    :param geometry: 2D array, rows are geometry_fields, columns are segments
+    :param calc_direction: 1 - from the pipe begin to the end, -1 - backward
+    :return: pressure on the other end of pipe and its derivative by X
+    '''
+    flow_direction = 1 if X_kgsec > 0 else -1 if X_kgsec < 0 else 0
+    grav_sign = calc_direction
+    fric_sign = flow_direction * calc_direction
+    p, dpdx = P_bar, 0.
+    N = geometry.shape[1]
+    for k in range(N):
+        i = k if calc_direction > 0 else N - 1 - k
+        L_m, uphill_m, inner_diam_m, roughness_m = geometry[0, i], geometry[1, i], geometry[2, i], geometry[3, i]
+        P_fric_grad_Pam, dgrad_dx = water_friction_gradient(abs(X_kgsec), inner_diam_m, roughness_m, rho_kgm3, mu_pasec)
+        dP_fric_Pa = P_fric_grad_Pam * L_m
+        p = p - (grav_sign * rho_kgm3 * uc.g * uphill_m + fric_sign * dP_fric_Pa) / 1e5
+        # Water is incompressible here, so only friction depends on X. d|X|/dX * fric_sign == calc_direction
+        dpdx = dpdx - calc_direction * dgrad_dx * L_m / 1e5
+    return p, dpdx
+
+
+@njit(cache=True)
+def march_water_pipe_parameters_derivatives(X_kgsec, geometry, rho_kgm3, mu_pasec):
+    '''
+    Derivatives of forward march_water_pipe() by inner diameter and roughness, all the pipe segments are changed together.
+    Water is incompressible, so segments pressure drops do not depend on each other
+    :return: dp/dD, dp/droughness
+    '''
+    flow_direction = 1 if X_kgsec > 0 else -1 if X_kgsec < 0 else 0
+    dpdD, dpdR = 0., 0.
+    for i in range(geometry.shape[1]):
+        L_m, inner_diam_m, roughness_m = geometry[0, i], geometry[2, i], geometry[3, i]
+        dgrad_dD, dgrad_dR = water_friction_gradient_parameters_derivatives(abs(X_kgsec), inner_diam_m, roughness_m, rho_kgm3, mu_pasec)
+        dpdD = dpdD - flow_direction * dgrad_dD * L_m / 1e5
+        dpdR = dpdR - flow_direction * dgrad_dR * L_m / 1e5
+    return dpdD, dpdR
+
+
+@njit(cache=True)
+def oil_segment_pressure_drop(P_bar, T_C, X_kgsec, calc_params, L_m, uphill_m, inner_diam_m, roughness_m, angle_dgr, calc_direction):
+    '''
+    The same as HE2_OilPipeSegment.calc_segment_pressure_drop(), returns pressure drop in bars
+    '''
+    grav_sign = calc_direction
+    fric_sign = np.sign(X_kgsec) * calc_direction
+    # Same as in HE2_BlackOil.calc()
+    P_for_PVT = max(abs(P_bar), 0.75)
+    tubing_IntDiam = inner_diam_m if inner_diam_m else 0.
+    if X_kgsec == 0:
+        P_fric_grad_Pam = 0.
+        P_grav_grad_Pam = liquid_density_by_oil_params(P_for_PVT, T_C, 1., calc_params, tubing_IntDiam) * 9.81
+    else:
+        angle = angle_dgr if calc_direction > 0 else -angle_dgr
+        P_fric_grad_Pam, P_grav_grad_Pam = mb.calculate_by_oil_params(P_for_PVT, T_C, abs(X_kgsec), calc_params, tubing_IntDiam,
+                                                                      angle, inner_diam_m, roughness_m)
+    return fric_sign * (P_fric_grad_Pam * L_m / 1e5) + grav_sign * (P_grav_grad_Pam * uphill_m / 1e5)
+
+
+@njit(cache=True)
+def march_oil_pipe(P_bar, T_C, X_kgsec, calc_params, geometry, calc_direction):
+    '''
+    The same as HE2_OilPipeSegment.calc_segment_pressure_drop() for all the pipe segments, one by one
+    :param geometry: 2D array, rows are geometry_fields, columns are segments
+    :param calc_direction: 1 - from the pipe begin to the end, -1 - backward
+    '''
+    p = P_bar
+    N = geometry.shape[1]
+    for k in range(N):
+        i = k if calc_direction > 0 else N - 1 - k
+        p = p - oil_segment_pressure_drop(p, T_C, X_kgsec, calc_params, geometry[0, i], geometry[1, i], geometry[2, i],
+                                          geometry[3, i], geometry[4, i], calc_direction)
+    return p, T_C
+
+
+@njit(cache=True)
+def march_oil_pipe_with_derivative(P_bar, T_C, X_kgsec, calc_params, geometry):
+    '''
+    Forward march_oil_pipe(), which returns also dp/dx. Flow is a dual number, so every segment is evaluated once,
+    and dp/dx is chained through segments by pressure dual number
+    '''
+    if X_kgsec == 0:
+        # Friction derivative vanishes on zero flow, and loop matrix becomes singular, so secant slope is taken
+        dx = 1e-3
+        p0 = march_oil_pipe(P_bar, T_C, X_kgsec, calc_params, geometry, 1)[0]
+        p1 = march_oil_pipe(P_bar, T_C, dx, calc_params, geometry, 1)[0]
+        return p0, T_C, (p1 - p0) / dx
+    x = dual(X_kgsec, 1.)
+    p = dual(P_bar, 0.)
+    for i in range(geometry.shape[1]):
+        p = p - oil_segment_pressure_drop(p, T_C, x, calc_params, geometry[0, i], geometry[1, i], geometry[2, i],
+                                          geometry[3, i], geometry[4, i], 1)
+    return p.v, T_C, p.d
+
+
+@njit(cache=True)
+def march_oil_pipe_parameters_derivatives(P_bar, T_C, X_kgsec, calc_params, geometry):
+    '''
+    Derivatives of forward march_oil_pipe() by inner diameter and roughness, all the pipe segments are changed together.
+    Inner diameters (and then roughness) of segments are dual numbers, so pipe is marched once per parameter, and
+    derivative is chained through segments by pressure dual number
+    :return: dp/dD, dp/droughness
+    '''
+    rez = np.zeros(2)
+    for k in range(2):
+        p = dual(P_bar, 0.)
+        for i in range(geometry.shape[1]):
+            inner_diam_m, roughness_m = dual(geometry[2, i], 1. - k), dual(geometry[3, i], k)
+            p = p - oil_segment_pressure_drop(p, T_C, X_kgsec, calc_params, geometry[0, i], geometry[1, i], inner_diam_m,
+                                              roughness_m, geometry[4, i], 1)
+        rez[k] = p.d
+    return rez[0], rez[1]
+
 
 class HE2_WaterPipeSegment(abc.HE2_ABC_PipeSegment):
     '''
@@ -16,9 +189,12 @@ class HE2_WaterPipeSegment(abc.HE2_ABC_PipeSegment):
     Но поскольку сгемент трубы все равно является трубой, только лишь простой, то есть потребность считать ее в обе стороны.
     Поэтому она умеет считать в обе стороны, но интерфейс для этого отличается, здесь используется calc_direction in [-1,+1]
     '''
+    L_m, uphill_m, inner_diam_m, roughness_m, angle_dgr = [geometry_property(i) for i in range(len(geometry_fields))]
+
     def __init__(self, fluid=None, inner_diam_m=None, roughness_m=None, L_m=None, uphill_m=None):
         fluid = HE2_DummyWater()
         self.fluid = fluid
+        self.geometry = np.full(len(geometry_fields), np.nan)
         self.inner_diam_m = inner_diam_m
         self.roughness_m = roughness_m
         self.L_m = None
@@ -132,7 +308,11 @@ class HE2_WaterPipeSegment(abc.HE2_ABC_PipeSegment):
 
 
 class HE2_WaterPipe(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
-    def __init__(self, dxs, dys, diams, rghs):
+    def __init__(self, dxs, dys, diams, rghs, fluid=None):
+        # Water pipe segments use HE2_DummyWater for hydraulics. But solver mixes fluids on all the edges and reports them
+        if fluid is None:
+            fluid = gimme_dummy_BlackOil()
+        self.fluid = fluid
         self.segments = []
         self.intermediate_results = []
         self._printstr = ';\n '.join([' '.join([f'{itm:.2f}' for itm in vec]) for vec in [dxs, dys, diams, rghs]])
@@ -140,6 +320,27 @@ class HE2_WaterPipe(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
             seg = HE2_WaterPipeSegment(None, diam, rgh)
             seg.set_pipe_geometry(dx, dy)
             self.segments += [seg]
+        self.water = HE2_DummyWater()
+        self.geometry = None
+        self.bind_segments_geometry()
+
+    def bind_segments_geometry(self, storage=None):
+        '''
+        Makes segments geometry vectors to be columns of the pipe geometry array,
+        so segments attributes changes are visible for the marcher
+        :param storage: array (or view) to keep geometry in, see HE2_CompiledNetwork.pack_geometry()
+        '''
+        if storage is None:
+            storage = np.zeros((len(geometry_fields), len(self.segments)))
+        self.geometry = storage
+        for i, seg in enumerate(self.segments):
+            self.geometry[:, i] = seg.geometry
+            seg.geometry = self.geometry[:, i]
+
+    def __setstate__(self, state):
+        # Copy and pickle do not keep numpy views, so segments should be bound again
+        self.__dict__.update(state)
+        self.bind_segments_geometry()
 
     def __str__(self):
         return self._printstr
@@ -153,19 +354,52 @@ class HE2_WaterPipe(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         else:
             return self.perform_calc_backward(P_bar, T_C, flow_direction * abs(X_kgsec))
 
+    def check_geometry(self):
+        # Segments can be added after pipe creation, see HE2_GraphPersister.dict_to_pipe
+        if self.geometry.shape[1] != len(self.segments):
+            self.bind_segments_geometry()
+
+    def march(self, P_bar, X_kgsec, calc_direction):
+        self.check_geometry()
+        return march_water_pipe(P_bar, X_kgsec, self.geometry, calc_direction, self.water.rho_wat_kgm3, uc.cP2pasec(self.water.mu_wat_cp))
+
     def perform_calc_forward(self, P_bar, T_C, X_kgsec):
-        p, t = P_bar, T_C
-        self.intermediate_results = []
-        for seg in self.segments:
-            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, 1)
-            self.intermediate_results += [(p, t)]
-        return p, t
+        if not self.segments:
+            return P_bar, T_C
+        p, dpdx = self.march(P_bar, X_kgsec, 1)
+        return p, 20
 
     def perform_calc_backward(self, P_bar, T_C, X_kgsec):
+        if not self.segments:
+            return P_bar, T_C
+        p, dpdx = self.march(P_bar, X_kgsec, -1)
+        return p, 20
+
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        if not self.segments:
+            return P_bar, T_C, 0
+        p, dpdx = self.march(P_bar, X_kgsec, 1)
+        return p, 20, dpdx
+
+    def perform_calc_forward_with_parameters_derivatives(self, P_bar, T_C, X_kgsec):
+        '''
+        :return: p, t and dict of outlet pressure derivatives by inner diameter and roughness, all the segments are changed together
+        '''
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        if not self.segments:
+            return p, t, dict(inner_diam_m=0., roughness_m=0.)
+        dpdD, dpdR = march_water_pipe_parameters_derivatives(X_kgsec, self.geometry, self.water.rho_wat_kgm3, uc.cP2pasec(self.water.mu_wat_cp))
+        return p, t, dict(inner_diam_m=dpdD, roughness_m=dpdR)
+
+    def perform_calc_by_segments(self, P_bar, T_C, X_kgsec, calc_direction):
+        '''
+        Segment by segment python calculation, the same as marcher does. Is kept for debug and comparison purposes
+        '''
         p, t = P_bar, T_C
         self.intermediate_results = []
-        for seg in self.segments[::-1]:
-            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, -1)
+        segments = self.segments if calc_direction == 1 else self.segments[::-1]
+        for seg in segments:
+            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, calc_direction)
             self.intermediate_results += [(p, t)]
         return p, t
 
@@ -175,10 +409,13 @@ class HE2_OilPipeSegment(abc.HE2_ABC_PipeSegment):
     '''
     Аналог HE2_WaterPipeSegment с реюзом Mishenko и Mukherjee_Brill
     '''
+    L_m, uphill_m, inner_diam_m, roughness_m, angle_dgr = [geometry_property(i) for i in range(len(geometry_fields))]
+
     def __init__(self, fluid:HE2_BlackOil=None, inner_diam_m=None, roughness_m=None, L_m=None, uphill_m=None):
         if fluid is None:
             fluid = gimme_dummy_BlackOil()
         self.fluid = fluid
+        self.geometry = np.full(len(geometry_fields), np.nan)
 
         self.inner_diam_m = inner_diam_m
         self.roughness_m = roughness_m
@@ -282,6 +519,26 @@ class HE2_OilPipe(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
             seg.set_pipe_geometry(dx=dx, dy=dy)
             a = seg
             self.segments += [seg]
+        self.geometry = None
+        self.bind_segments_geometry()
+
+    def bind_segments_geometry(self, storage=None):
+        '''
+        Makes segments geometry vectors to be columns of the pipe geometry array,
+        so segments attributes changes are visible for the marcher
+        :param storage: array (or view) to keep geometry in, see HE2_CompiledNetwork.pack_geometry()
+        '''
+        if storage is None:
+            storage = np.zeros((len(geometry_fields), len(self.segments)))
+        self.geometry = storage
+        for i, seg in enumerate(self.segments):
+            self.geometry[:, i] = seg.geometry
+            seg.geometry = self.geometry[:, i]
+
+    def __setstate__(self, state):
+        # Copy and pickle do not keep numpy views, so segments should be bound again
+        self.__dict__.update(state)
+        self.bind_segments_geometry()
 
     def __str__(self):
         return self._printstr
@@ -295,21 +552,40 @@ class HE2_OilPipe(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         else:
             return self.perform_calc_backward(P_bar, T_C, flow_direction * abs(X_kgsec))
 
+    def check_geometry(self):
+        # Segments can be added after pipe creation, see HE2_GraphPersister.dict_to_pipe
+        if self.geometry.shape[1] != len(self.segments):
+            self.bind_segments_geometry()
+
     def perform_calc_forward(self, P_bar, T_C, X_kgsec):
-        p, t = P_bar, T_C
-        self.intermediate_results = []
-        for seg in self.segments:
-            seg.fluid.oil_params = self.fluid.oil_params
-            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, 1)
-            self.intermediate_results += [(p, t)]
-        return p, t
+        self.check_geometry()
+        return march_oil_pipe(P_bar, T_C, X_kgsec, self.fluid.oil_params, self.geometry, 1)
 
     def perform_calc_backward(self, P_bar, T_C, X_kgsec):
+        self.check_geometry()
+        return march_oil_pipe(P_bar, T_C, X_kgsec, self.fluid.oil_params, self.geometry, -1)
+
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        self.check_geometry()
+        return march_oil_pipe_with_derivative(P_bar, T_C, X_kgsec, self.fluid.oil_params, self.geometry)
+
+    def perform_calc_forward_with_parameters_derivatives(self, P_bar, T_C, X_kgsec):
+        '''
+        :return: p, t and dict of outlet pressure derivatives by inner diameter and roughness, all the segments are changed together
+        '''
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        dpdD, dpdR = march_oil_pipe_parameters_derivatives(P_bar, T_C, X_kgsec, self.fluid.oil_params, self.geometry)
+        return p, t, dict(inner_diam_m=dpdD, roughness_m=dpdR)
+
+    def perform_calc_by_segments(self, P_bar, T_C, X_kgsec, calc_direction):
+        '''
+        Segment by segment python calculation, the same as marcher does. Is kept for debug and comparison purposes
+        '''
         p, t = P_bar, T_C
         self.intermediate_results = []
-        for seg in self.segments[::-1]:
+        segments = self.segments if calc_direction == 1 else self.segments[::-1]
+        for seg in segments:
             seg.fluid.oil_params = self.fluid.oil_params
-            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, -1)
+            p, t = seg.calc_segment_pressure_drop(p, t, X_kgsec, calc_direction)
             self.intermediate_results += [(p, t)]
         return p, t
-
@@ -35,6 +35,22 @@ class HE2_Plast(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         p, t = self.calculate_pressure_differrence(p, t, X_kgsec, -1)
         return p, t
 
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        # Liquid density doesnt depend on X, and it is already evaluated by fluid.calc() inside perform_calc_forward
+        liq_dens = self.fluid.CurrentLiquidDensity_kg_m3
+        dpdx = -86400 / liq_dens / self.Productivity
+        return p, t, dpdx
+
+    def perform_calc_forward_with_parameters_derivatives(self, P_bar, T_C, X_kgsec):
+        '''
+        :return: p, t and dict of outlet pressure derivative by productivity
+        '''
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        liq_dens = self.fluid.CurrentLiquidDensity_kg_m3
+        dpdk = X_kgsec * 86400 / liq_dens / self.Productivity ** 2
+        return p, t, dict(Productivity=dpdk)
+
     def calculate_pressure_differrence(self, P_bar, T_C, X_kgsec, calc_direction, unifloc_direction=-1):
         check_for_nan(P_bar=P_bar, T_C=T_C, X_kgsec=X_kgsec)
         #Определяем направления расчета
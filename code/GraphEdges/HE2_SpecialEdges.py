@@ -16,5 +16,8 @@ class HE2_MockEdge(abc.HE2_ABC_GraphEdge):
     def perform_calc_forward(self, P_bar, T_C, X_kgsec):
         return P_bar + self.dP, T_C
 
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        return P_bar + self.dP, T_C, 0
+
     def perform_calc_backward(self, P_bar, T_C, X_kgsec):
         return P_bar - self.dP, T_C
@@ -3,7 +3,8 @@ from Fluids.HE2_Fluid import gimme_dummy_BlackOil
 import uniflocpy.uTools.uconst as uc
 import numpy as np
 import pandas as pd
-from scipy.interpolate import interp1d
+from scipy.interpolate import make_interp_spline, PPoly
+from numba import njit
 from Tools.HE2_Logger import check_for_nan, getLogger
 logger = getLogger(__name__)
 
@@ -55,6 +56,80 @@ def create_HE2_WellPump_instance_from_dataframe(full_HPX:pd.DataFrame, model = "
     return pump
 
 
+def make_curve(q_vec, y_vec):
+    '''
+    Quadratic interpolation spline, the same as interp1d(kind="quadratic") uses, converted to piecewise polynomial
+    :return: (4, K) array, row 0 is breakpoints, rows 1..3 are quadratic coefficients of intervals, highest degree first.
+    Last column is right end of curve, so curve[3, -1] is the last value
+    '''
+    pp = PPoly.from_spline(make_interp_spline(q_vec, y_vec, k=2))
+    mask = np.diff(pp.x) > 0
+    breaks = np.append(pp.x[:-1][mask], q_vec[-1])
+    coefs = pp.c[:, mask]
+    coefs = np.column_stack((coefs, [0, 0, y_vec[-1]]))
+    return np.vstack((breaks, coefs))
+
+
+@njit(cache=True)
+def eval_curve(curve, q):
+    '''
+    :return: curve value and its derivative in point q, see make_curve()
+    '''
+    i = np.searchsorted(curve[0], q, side='right') - 1
+    i = min(max(i, 0), curve.shape[1] - 2)
+    dq = q - curve[0, i]
+    val = (curve[1, i] * dq + curve[2, i]) * dq + curve[3, i]
+    der = 2 * curve[1, i] * dq + curve[2, i]
+    return val, der
+
+
+@njit(cache=True)
+def pump_head(liquid_debit, curve, freq_k, stages_ratio):
+    '''
+    Pump head curve is stored for 50Hz and stages ratio 1. Affinity laws are applied here, debit scales as frequency,
+    head as squared frequency
+    :return: head, m and d(head)/d(debit)
+    '''
+    min_q, max_q = curve[0, 0] * freq_k, curve[0, -1] * freq_k
+    head_k = stages_ratio * freq_k ** 2
+    if liquid_debit <= min_q:
+        head = head_k * curve[3, 0] + A_keff * abs(min_q - liquid_debit) ** B_keff
+    elif liquid_debit < max_q:
+        head = head_k * eval_curve(curve, liquid_debit / freq_k)[0]
+    else:
+        head = head_k * curve[3, -1] - A_keff * (liquid_debit - max_q) ** B_keff
+
+    # Right-hand derivative on curve parts joints
+    if liquid_debit < min_q:
+        der = -A_keff * B_keff * abs(min_q - liquid_debit) ** (B_keff - 1)
+    elif liquid_debit < max_q:
+        der = head_k / freq_k * eval_curve(curve, liquid_debit / freq_k)[1]
+    else:
+        der = -A_keff * B_keff * (liquid_debit - max_q) ** (B_keff - 1)
+    return head, der
+
+
+@njit(cache=True)
+def pump_head_parameters_derivatives(liquid_debit, curve, freq_k, stages_ratio):
+    '''
+    :return: derivatives of pump_head() head by freq_k and by stages_ratio, analytically
+    '''
+    min_q, max_q = curve[0, 0] * freq_k, curve[0, -1] * freq_k
+    if liquid_debit <= min_q:
+        # Curve end moves with frequency, so the extrapolation term depends on it too
+        value = curve[3, 0]
+        dfreq = A_keff * B_keff * abs(min_q - liquid_debit) ** (B_keff - 1) * curve[0, 0]
+    elif liquid_debit < max_q:
+        value, der = eval_curve(curve, liquid_debit / freq_k)
+        # head = stages_ratio * freq_k^2 * curve(debit / freq_k)
+        dfreq = -stages_ratio * der * liquid_debit
+    else:
+        value = curve[3, -1]
+        dfreq = A_keff * B_keff * (liquid_debit - max_q) ** (B_keff - 1) * curve[0, -1]
+    dfreq += 2 * stages_ratio * freq_k * value
+    return dfreq, freq_k ** 2 * value
+
+
 class HE2_WellPump(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
     def __init__(self, p_vec, q_vec, n_vec, eff_vec, model = "", fluid = None, frequency = 50):
         if fluid is None:
@@ -87,10 +162,11 @@ class HE2_WellPump(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         self.power = 0
         self.efficiency = 0
 
-        self.get_pressure_raise_1 = None
-        self.get_pressure_raise_2 = None
-        self.get_pressure_raise_3 = None
-        self.make_extrapolators()
+        # Curves are built once. Frequency and stages ratio are applied on evaluation, so they are cheap to change
+        self.head_curve = make_curve(self.q_vec_50hz, self.p_vec_50hz)
+        self.eff_curve = make_curve(self.q_vec_50hz, self.eff_vec_50hz)
+        self.n_curve = make_curve(self.q_vec_50hz, self.n_vec_50hz)
+        self.changeFrequency(self.frequency)
 
 
     def rebuild_HPX_curves_to_viscosity(self, q_vec, p_vec, eff_vec, viscosity_Pa_s):
@@ -129,6 +205,34 @@ class HE2_WellPump(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         p, t = self.calculate_pressure_differrence(p, t, X_kgsec, -1, fl)
         return p, t
 
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        if self.state.upper() == 'OFF':
+            return p, t, -100500
+
+        # Liquid density doesnt depend on X, so d(pressure_raise)/dX = d(head)/d(debit) * 9.81 * 86400
+        liquid_debit = X_kgsec * 86400 / self.fluid.CurrentLiquidDensity_kg_m3
+        dpdx = uc.Pa2bar(self.get_pressure_raise_derivative(liquid_debit) * 9.81 * 86400)
+        return p, t, dpdx
+
+    def perform_calc_forward_with_parameters_derivatives(self, P_bar, T_C, X_kgsec):
+        '''
+        :return: p, t and dict of outlet pressure derivatives by frequency, Hz and by stages ratio
+        '''
+        p, t = self.perform_calc_forward(P_bar, T_C, X_kgsec)
+        if self.state.upper() == 'OFF':
+            return p, t, dict(frequency=0., stages_ratio=0.)
+        liq_dens = self.fluid.CurrentLiquidDensity_kg_m3
+        liquid_debit = X_kgsec * 86400 / liq_dens
+        dfreq_k, dstages = pump_head_parameters_derivatives(liquid_debit, self.head_curve, self.frequency / 50, self.stages_ratio)
+        return p, t, dict(frequency=uc.Pa2bar(dfreq_k / 50 * 9.81 * liq_dens), stages_ratio=uc.Pa2bar(dstages * 9.81 * liq_dens))
+
+    def get_pressure_raise(self, liquid_debit):
+        return pump_head(liquid_debit, self.head_curve, self.frequency / 50, self.stages_ratio)[0]
+
+    def get_pressure_raise_derivative(self, liquid_debit):
+        return pump_head(liquid_debit, self.head_curve, self.frequency / 50, self.stages_ratio)[1]
+
     def calculate_pressure_differrence(self, P_bar, T_C, X_kgsec, calc_direction, mishenko, unifloc_direction=-1):
         check_for_nan(P_bar=P_bar, T_C=T_C, X_kgsec=X_kgsec)
         if self.state.upper() == 'OFF':
@@ -142,16 +246,12 @@ class HE2_WellPump(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         grav_sign, fric_sign, t_sign = self.decode_direction(X_kgsec, calc_direction, unifloc_direction)
         self.power = 0
         self.efficiency = 5
-        if liquid_debit <= self.min_q:
-            get_pressure_raise = self.get_pressure_raise_1
-        elif (self.min_q < liquid_debit) and (liquid_debit < self.max_q):
-            get_pressure_raise = self.get_pressure_raise_2
-            self.power = self.n_interpolator(liquid_debit)*1.0
-            self.efficiency = self.get_eff_2(liquid_debit)*1.0
-        else:
-            get_pressure_raise = self.get_pressure_raise_3
+        freq_k = self.frequency / 50
+        if (self.min_q < liquid_debit) and (liquid_debit < self.max_q):
+            self.power = eval_curve(self.n_curve, liquid_debit / freq_k)[0] * freq_k ** 3
+            self.efficiency = eval_curve(self.eff_curve, liquid_debit / freq_k)[0]
 
-        pressure_raise = get_pressure_raise(liquid_debit) * 9.81 * mishenko.CurrentLiquidDensity_kg_m3
+        pressure_raise = self.get_pressure_raise(liquid_debit) * 9.81 * mishenko.CurrentLiquidDensity_kg_m3
 
         P_rez_bar = P_bar + calc_direction * uc.Pa2bar(pressure_raise)
 
@@ -181,33 +281,10 @@ class HE2_WellPump(abc.HE2_ABC_Pipeline, abc.HE2_ABC_GraphEdge):
         t_sign = calc_direction
         return grav_sign, fric_sign, t_sign
 
-    def make_extrapolators(self):
-        freq_k = self.frequency / 50
-        q_vec = self.q_vec_50hz * freq_k
-        min_q = self.min_Q_50hz * freq_k
-        max_q = self.max_Q_50hz * freq_k
-        p_vec = self.stages_ratio * self.p_vec_50hz * freq_k ** 2
-        n_vec = self.n_vec_50hz * freq_k ** 3
-        eff_vec = self.eff_vec_50hz #sic!
-        zero_head = p_vec[0]
-        last_head = p_vec[-1]
-
-        self.get_pressure_raise_1 = lambda x: zero_head + A_keff * abs(min_q - x) ** B_keff
-        self.get_pressure_raise_2 = interp1d(q_vec, p_vec, kind="quadratic")
-        self.get_pressure_raise_3 = lambda x: last_head - A_keff * (x - max_q) ** B_keff
-
-        self.get_eff_2 = interp1d(q_vec, eff_vec, kind="quadratic")
-        self.n_interpolator = interp1d(q_vec, n_vec, kind="quadratic")
-
-        self.min_q = min_q
-        self.max_q = max_q
-
-
     def changeFrequency(self, new_frequency):
         self.frequency = new_frequency
-        self.make_extrapolators()
+        self.min_q = self.min_Q_50hz * new_frequency / 50
+        self.max_q = self.max_Q_50hz * new_frequency / 50
 
     def change_stages_ratio(self, new_ratio):
         self.stages_ratio = new_ratio
-        self.make_extrapolators()
-
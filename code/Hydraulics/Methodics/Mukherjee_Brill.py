@@ -1,6 +1,6 @@
 from Hydraulics.Formulas import *
 import warnings
-from Hydraulics.Properties.Mishenko import Mishenko
+from Hydraulics.Properties.Mishenko import Mishenko, is_two_phase_flow, two_phase_flow, three_phase_flow
 from numba import njit
 import numpy as np
 warnings.filterwarnings("ignore")
@@ -82,3 +82,12 @@ def calculate (mishenko : Mishenko, angle, IntDiameter, Roughness):
     dP_fric, dP_grav = count_dP_MB(mishenko, angle, IntDiameter, Roughness, form, lambda0, dens_true, Ek, phi1, phi2, Lw, Lg, Lm, wm)
 
     return dP_fric, dP_grav
+
+
+@njit(cache=True)
+def calculate_by_oil_params(P_bar, T_C, X_kg_sec, calc_params, tubing_IntDiam, angle, IntDiameter, Roughness):
+    # Two branches return Mishenko tuples of different numba types, so calculate() is called inside each branch
+    if is_two_phase_flow(P_bar, T_C, calc_params):
+        return calculate(two_phase_flow(P_bar, T_C, X_kg_sec, calc_params, tubing_IntDiam), angle, IntDiameter, Roughness)
+    else:
+        return calculate(three_phase_flow(P_bar, T_C, X_kg_sec, calc_params), angle, IntDiameter, Roughness)
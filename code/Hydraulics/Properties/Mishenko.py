@@ -2,7 +2,7 @@ from Hydraulics.Formulas import get_dens_freegas
 from Tools.HE2_ABC import oil_params
 from Tools.HE2_Logger import check_for_nan, getLogger
 from collections import namedtuple
-from numba import njit
+from numba import njit, literal_unroll
 import numpy as np
 
 # TODO: Диаметр трубы нужен для уточнения вязкости смеси при движении по трубе, больше ни для чего
@@ -39,6 +39,33 @@ field_list = [
 
 Mishenko = namedtuple('Mishenko', field_list)
 
+# Flow independent fluid properties, depend only on P, T and oil_params. See two_phase_pvt(), three_phase_pvt()
+pvt_field_list = [
+'VolumeWater_fraction',
+'SaturationPressure_MPa',
+'CurrentP_MPa',
+'CurrentT_K',
+'DissolvedGasAmount',
+'FreeGasDensity_kg_m3',
+'SaturatedOilDensity_kg_m3',
+'CurrentWaterDensity_kg_m3',
+'CurrentOilViscosity_Pa_s',
+'CurrentWaterViscosity_Pa_s',
+'RelativePressure',
+'RelativeTemperature',
+'CurrentFreeGasDensity_kg_m3',
+'CurrentFreeGasViscosity_Pa_s',
+'CurrentLiquidDensity_kg_m3',
+'TensionOilGas',
+'TensionWaterGas',
+'TensionOilWater',
+'OWG_density_kg_m3',
+'FreeGasFactor'
+]
+
+PVT = namedtuple('PVT', pvt_field_list)
+PVT_FIELDS_COUNT = len(pvt_field_list)
+
 # def print(mishenko : Mishenko):
 #     print(f"""Газовый фактор GasFactor= {mishenko.oil_params.gasFactor}
 # Обводненность VolumeWater =  {mishenko.oil_params.VolumeWater}
@@ -58,7 +85,13 @@ Mishenko = namedtuple('Mishenko', field_list)
 # Объемная доля газа в смеси VolumeGas = {mishenko.VolumeGas}""")
 
 
-def from_oil_params(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing=None):
+def from_oil_params(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing=None, use_table=False):
+    '''
+    :param use_table: take flow independent properties from PVT table of calc_params, see get_pvt_table()
+    '''
+    if use_table:
+        tubing_IntDiam = tubing["IntDiameter"] if tubing else 0.
+        return mishenko_by_pvt_table(P_bar, T_C, X_kg_sec, calc_params, tubing_IntDiam, *get_pvt_table(calc_params))
     SaturationPressure_MPa = calc_params.sat_P_bar * 101325 * 1e-6
     CurrentP = P_bar * 101325 * 1e-6
     PlastT = calc_params.plastT_C + 273
@@ -74,11 +107,41 @@ def from_oil_params(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing=None):
         return three_phase_flow(P_bar, T_C, X_kg_sec, calc_params)
 
 
+@njit(cache=True)
+def is_two_phase_flow(P_bar, T_C, calc_params:oil_params):
+    '''
+    The same choice as in from_oil_params, but can be called from other njit functions
+    '''
+    SaturationPressure_MPa = calc_params.sat_P_bar * 101325 * 1e-6
+    CurrentP = P_bar * 101325 * 1e-6
+    PlastT = calc_params.plastT_C + 273
+    CurrentT = T_C + 273
+    GasFactor = calc_params.gasFactor
+    Saturation_pressure = SaturationPressure_MPa - (PlastT - CurrentT) / (GasFactor * (0.91 - 0.09))
+    return (CurrentP >= Saturation_pressure) | (calc_params.volumewater_percent == 100)
+
+
+@njit(cache=True)
+def liquid_density_by_oil_params(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing_IntDiam=0):
+    if is_two_phase_flow(P_bar, T_C, calc_params):
+        return two_phase_flow(P_bar, T_C, X_kg_sec, calc_params, tubing_IntDiam).CurrentLiquidDensity_kg_m3
+    else:
+        return three_phase_flow(P_bar, T_C, X_kg_sec, calc_params).CurrentLiquidDensity_kg_m3
+
+
 @njit(cache=True, fastmath=True)
 def two_phase_flow(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing_IntDiam=0):
     """
     :param oil_params: Параметры нефти
     """
+    return two_phase_flow_by_pvt(two_phase_pvt(P_bar, T_C, calc_params), X_kg_sec, calc_params, tubing_IntDiam)
+
+
+@njit(cache=True, fastmath=True)
+def two_phase_pvt(P_bar, T_C, calc_params:oil_params):
+    """
+    Flow independent part of two_phase_flow()
+    """
     # Давление насыщения нефти попутным газом
     SaturationPressure_MPa = calc_params.sat_P_bar * 101325 * 1e-6
     # Текущее давление
@@ -163,6 +226,27 @@ def two_phase_flow(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing_IntDiam=
     #CurrentLiquidDensity = VolumeWater * PlastWaterDensity + VolumeOil * SaturatedOilDensity
     CurrentLiquidDensity = VolumeWater * PlastWaterDensity + VolumeOil * SaturatedOilDensity
 
+    # All the fields are float, so PVT can be kept in array, see make_pvt_table()
+    return PVT(CurrentP_MPa=CurrentP, CurrentT_K=CurrentT, VolumeWater_fraction=VolumeWater, SaturationPressure_MPa=Saturation_pressure,
+               DissolvedGasAmount=1., FreeGasDensity_kg_m3=0., SaturatedOilDensity_kg_m3=SaturatedOilDensity,
+               CurrentWaterDensity_kg_m3=PlastWaterDensity, CurrentOilViscosity_Pa_s=CurrentOilViscosity,
+               CurrentWaterViscosity_Pa_s=CurrentWaterViscosity, RelativePressure=-100500., RelativeTemperature=-100500.,
+               CurrentFreeGasDensity_kg_m3=0., CurrentFreeGasViscosity_Pa_s=0., CurrentLiquidDensity_kg_m3=CurrentLiquidDensity,
+               TensionOilGas=TensionOilGas, TensionWaterGas=TensionWaterGas, TensionOilWater=TensionOilWater,
+               OWG_density_kg_m3=CurrentLiquidDensity, FreeGasFactor=0.)
+
+
+@njit(cache=True, fastmath=True)
+def two_phase_flow_by_pvt(pvt, X_kg_sec, calc_params:oil_params, tubing_IntDiam=0):
+    """
+    Flow dependent part of two_phase_flow(). Mixture viscosity depends on flow structure in the tubing
+    """
+    g = 9.81
+    VolumeWater = pvt.VolumeWater_fraction
+    CurrentOilViscosity = pvt.CurrentOilViscosity_Pa_s
+    CurrentWaterViscosity = pvt.CurrentWaterViscosity_Pa_s
+    CurrentLiquidDensity = pvt.CurrentLiquidDensity_kg_m3
+
     if not X_kg_sec:
         X_kg_sec = 0
     # Объемный расход нефтеводогазовой смеси в условиях транспорта
@@ -196,24 +280,32 @@ def two_phase_flow(P_bar, T_C, X_kg_sec, calc_params:oil_params, tubing_IntDiam=
 
     CurrentOilViscosity = CurrentWaterViscosity if VolumeWater == 1 else CurrentOilViscosity
 
-    return Mishenko(oil_params=calc_params, CurrentP_MPa=CurrentP, CurrentT_K=CurrentT, VolumeWater_fraction=VolumeWater, Q_liq_m3_s=Q,
-                    g=g, SaturationPressure_MPa=Saturation_pressure,
-                    DissolvedGasAmount=1, FreeGasDensity_kg_m3=0,
-                    SaturatedOilDensity_kg_m3=SaturatedOilDensity,
-                    CurrentWaterDensity_kg_m3=PlastWaterDensity, CurrentOilViscosity_Pa_s=CurrentOilViscosity,
+    return Mishenko(oil_params=calc_params, CurrentP_MPa=pvt.CurrentP_MPa, CurrentT_K=pvt.CurrentT_K, VolumeWater_fraction=VolumeWater, Q_liq_m3_s=Q,
+                    g=g, SaturationPressure_MPa=pvt.SaturationPressure_MPa,
+                    DissolvedGasAmount=1., FreeGasDensity_kg_m3=0.,
+                    SaturatedOilDensity_kg_m3=pvt.SaturatedOilDensity_kg_m3,
+                    CurrentWaterDensity_kg_m3=pvt.CurrentWaterDensity_kg_m3, CurrentOilViscosity_Pa_s=CurrentOilViscosity,
                     CurrentWaterViscosity_Pa_s=CurrentWaterViscosity,
-                    RelativePressure=-100500, RelativeTemperature=-100500,
-                    CurrentFreeGasDensity_kg_m3=0,
-                    CurrentFreeGasViscosity_Pa_s=0, CurrentLiquidDensity_kg_m3=CurrentLiquidDensity,
-                    TensionOilGas=TensionOilGas,
-                    TensionWaterGas=TensionWaterGas, TensionOilWater=TensionOilWater, Q_gas_m3_s=0, Q_liq_and_gas_m3_s=Q,
-                    VolumeGas_fraction=0)
+                    RelativePressure=-100500., RelativeTemperature=-100500.,
+                    CurrentFreeGasDensity_kg_m3=0.,
+                    CurrentFreeGasViscosity_Pa_s=0., CurrentLiquidDensity_kg_m3=CurrentLiquidDensity,
+                    TensionOilGas=pvt.TensionOilGas,
+                    TensionWaterGas=pvt.TensionWaterGas, TensionOilWater=pvt.TensionOilWater, Q_gas_m3_s=0., Q_liq_and_gas_m3_s=Q,
+                    VolumeGas_fraction=0.)
 
 @njit(cache=True, fastmath=True)
 def three_phase_flow(P_bar, T_C, X_kg_sec, calc_params):
     """
     :param oil_params: Параметры нефти
     """
+    return three_phase_flow_by_pvt(three_phase_pvt(P_bar, T_C, calc_params), X_kg_sec, calc_params)
+
+
+@njit(cache=True, fastmath=True)
+def three_phase_pvt(P_bar, T_C, calc_params):
+    """
+    Flow independent part of three_phase_flow()
+    """
     # Давление насыщения нефти попутным газом
     SaturationPressure_MPa = calc_params.sat_P_bar * 101325 * 1e-6
     # Текущее давление
@@ -365,6 +457,25 @@ def three_phase_flow(P_bar, T_C, X_kg_sec, calc_params):
     # Плотность смеси Oil+Water+Gas = OWG
     OWG_density = CurrentLiquidDensity + CurrentFreeGasDensity * FreeGasFactor * (1-VolumeWater)
 
+    return PVT(CurrentP_MPa=CurrentP, CurrentT_K=CurrentT, VolumeWater_fraction=VolumeWater, SaturationPressure_MPa=Saturation_pressure,
+               DissolvedGasAmount=DissolvedGasAmount, FreeGasDensity_kg_m3=FreeGasDensity, SaturatedOilDensity_kg_m3=SaturatedOilDensity,
+               CurrentWaterDensity_kg_m3=CurrentWaterDensity, CurrentOilViscosity_Pa_s=CurrentOilViscosity,
+               CurrentWaterViscosity_Pa_s=CurrentWaterViscosity, RelativePressure=RelativePressure, RelativeTemperature=RelativeTemperature,
+               CurrentFreeGasDensity_kg_m3=CurrentFreeGasDensity, CurrentFreeGasViscosity_Pa_s=CurrentFreeGasViscosity,
+               CurrentLiquidDensity_kg_m3=CurrentLiquidDensity, TensionOilGas=TensionOilGas, TensionWaterGas=TensionWaterGas,
+               TensionOilWater=TensionOilWater, OWG_density_kg_m3=OWG_density, FreeGasFactor=FreeGasFactor)
+
+
+@njit(cache=True, fastmath=True)
+def three_phase_flow_by_pvt(pvt, X_kg_sec, calc_params):
+    """
+    Flow dependent part of three_phase_flow()
+    """
+    g = 9.81
+    VolumeWater = pvt.VolumeWater_fraction
+    OWG_density = pvt.OWG_density_kg_m3
+    FreeGasFactor = pvt.FreeGasFactor
+
     if not X_kg_sec:
         X_kg_sec = 0
     # Объемный расход нефтеводогазовой смеси в условиях транспорта
@@ -381,15 +492,144 @@ def three_phase_flow(P_bar, T_C, X_kg_sec, calc_params):
     VolumeGas = Q_gas / (Q_gas + Q_liquid) if Q_owg!=0 else 0  # if CurrentP < SaturationPressure_MPa else 0
 
 # TODO Separate input and output fluid parameters. It is not necessary to return all, most of them aint used
-    return Mishenko(oil_params=calc_params, CurrentP_MPa=CurrentP, CurrentT_K=CurrentT, VolumeWater_fraction=VolumeWater, Q_liq_m3_s=Q_liquid,
-                    g=g, SaturationPressure_MPa=Saturation_pressure,
-                    DissolvedGasAmount=DissolvedGasAmount, FreeGasDensity_kg_m3=FreeGasDensity,
-                    SaturatedOilDensity_kg_m3=SaturatedOilDensity,
-                    CurrentWaterDensity_kg_m3=CurrentWaterDensity, CurrentOilViscosity_Pa_s=CurrentOilViscosity,
-                    CurrentWaterViscosity_Pa_s=CurrentWaterViscosity,
-                    RelativePressure=RelativePressure, RelativeTemperature=RelativeTemperature,
-                    CurrentFreeGasDensity_kg_m3=CurrentFreeGasDensity,
-                    CurrentFreeGasViscosity_Pa_s=CurrentFreeGasViscosity, CurrentLiquidDensity_kg_m3=CurrentLiquidDensity,
-                    TensionOilGas=TensionOilGas,
-                    TensionWaterGas=TensionWaterGas, TensionOilWater=TensionOilWater, Q_gas_m3_s=Q_gas, Q_liq_and_gas_m3_s=Q_owg,
+    return Mishenko(oil_params=calc_params, CurrentP_MPa=pvt.CurrentP_MPa, CurrentT_K=pvt.CurrentT_K, VolumeWater_fraction=VolumeWater, Q_liq_m3_s=Q_liquid,
+                    g=g, SaturationPressure_MPa=pvt.SaturationPressure_MPa,
+                    DissolvedGasAmount=pvt.DissolvedGasAmount, FreeGasDensity_kg_m3=pvt.FreeGasDensity_kg_m3,
+                    SaturatedOilDensity_kg_m3=pvt.SaturatedOilDensity_kg_m3,
+                    CurrentWaterDensity_kg_m3=pvt.CurrentWaterDensity_kg_m3, CurrentOilViscosity_Pa_s=pvt.CurrentOilViscosity_Pa_s,
+                    CurrentWaterViscosity_Pa_s=pvt.CurrentWaterViscosity_Pa_s,
+                    RelativePressure=pvt.RelativePressure, RelativeTemperature=pvt.RelativeTemperature,
+                    CurrentFreeGasDensity_kg_m3=pvt.CurrentFreeGasDensity_kg_m3,
+                    CurrentFreeGasViscosity_Pa_s=pvt.CurrentFreeGasViscosity_Pa_s, CurrentLiquidDensity_kg_m3=pvt.CurrentLiquidDensity_kg_m3,
+                    TensionOilGas=pvt.TensionOilGas,
+                    TensionWaterGas=pvt.TensionWaterGas, TensionOilWater=pvt.TensionOilWater, Q_gas_m3_s=Q_gas, Q_liq_and_gas_m3_s=Q_owg,
                     VolumeGas_fraction=VolumeGas)
+
+
+pvt_tables = dict()
+pvt_tables_size = 64
+default_P_grid = np.arange(0.75, 401, 1.)
+default_T_grid = np.arange(0., 151, 5.)
+
+
+@njit(cache=True)
+def pvt_to_array(pvt):
+    rez = np.zeros(PVT_FIELDS_COUNT)
+    i = 0
+    # Fields types depend on oil_params types, so tuple is heterogeneous
+    for value in literal_unroll(pvt):
+        rez[i] = value
+        i += 1
+    return rez
+
+
+@njit(cache=True)
+def pvt_from_array(v):
+    return PVT(v[0], v[1], v[2], v[3], v[4], v[5], v[6], v[7], v[8], v[9], v[10], v[11], v[12], v[13], v[14], v[15], v[16], v[17],
+               v[18], v[19])
+
+
+@njit(cache=True)
+def get_pvt_regime(pvt, is_two_phase):
+    '''
+    Correlations are piecewise, and properties are not continuous on pieces boundaries. So table cells are interpolated
+    only if all the cell nodes are in the same regime
+    :return: 0 for two phase flow, gas compressibility and gas viscosity branches code for three phase flow,
+    -1 if the node should not be interpolated
+    '''
+    if is_two_phase:
+        return 0
+    if pvt.CurrentP_MPa < 0.5:
+        # Free gas factor ~ 1 / P on low pressure
+        return -1
+    P0, T0 = pvt.RelativePressure, max(pvt.RelativeTemperature, 1.05)
+    if (0 <= P0 <= 3.8) & (1.17 <= T0 <= 2):
+        zc_branch = 1
+    elif (0 <= P0 <= 1.45) & (1.05 <= T0 <= 1.17):
+        # zc ~ 1 / P0**2 here, it is too steep for bilinear interpolation
+        return -1
+    elif (1.45 <= P0 <= 4) & (1.05 <= T0 <= 1.17):
+        zc_branch = 3
+    else:
+        zc_branch = 4
+    # Relative temperature is clamped, so it is the boundary too
+    return zc_branch + 4 * (pvt.CurrentP_MPa >= 5) + 8 * (pvt.RelativeTemperature < 1.05)
+
+
+@njit(cache=True)
+def make_pvt_table(calc_params, P_grid, T_grid):
+    '''
+    :param P_grid, T_grid: uniform grids
+    :return: PVT values on grid nodes, shape is (len(P_grid), len(T_grid), len(pvt_field_list)), and nodes regimes
+    '''
+    values = np.zeros((len(P_grid), len(T_grid), PVT_FIELDS_COUNT))
+    regimes = np.zeros((len(P_grid), len(T_grid)), dtype=np.int64)
+    for i in range(len(P_grid)):
+        for j in range(len(T_grid)):
+            is_two_phase = is_two_phase_flow(P_grid[i], T_grid[j], calc_params)
+            if is_two_phase:
+                pvt = pvt_from_array(pvt_to_array(two_phase_pvt(P_grid[i], T_grid[j], calc_params)))
+            else:
+                pvt = pvt_from_array(pvt_to_array(three_phase_pvt(P_grid[i], T_grid[j], calc_params)))
+            values[i, j] = pvt_to_array(pvt)
+            regimes[i, j] = get_pvt_regime(pvt, is_two_phase)
+    return values, regimes
+
+
+def get_pvt_table(calc_params, P_grid=default_P_grid, T_grid=default_T_grid):
+    '''
+    Tables are built once for every oil_params, and are kept in pvt_tables
+    :return: P_grid, T_grid, values, regimes, see make_pvt_table()
+    '''
+    table = pvt_tables.get(calc_params, None)
+    if table is not None:
+        return table
+    table = (P_grid, T_grid) + make_pvt_table(calc_params, P_grid, T_grid)
+    if len(pvt_tables) >= pvt_tables_size:
+        pvt_tables.pop(next(iter(pvt_tables)))
+    pvt_tables[calc_params] = table
+    return table
+
+
+@njit(cache=True)
+def interpolate_pvt(values, i, j, a, b):
+    w00, w10, w01, w11 = (1 - a) * (1 - b), a * (1 - b), (1 - a) * b, a * b
+    def f(k):
+        return w00 * values[i, j, k] + w10 * values[i + 1, j, k] + w01 * values[i, j + 1, k] + w11 * values[i + 1, j + 1, k]
+    # No temporary arrays, cause it is called for every segment
+    return PVT(f(0), f(1), f(2), f(3), f(4), f(5), f(6), f(7), f(8), f(9), f(10), f(11), f(12), f(13), f(14), f(15), f(16), f(17),
+               f(18), f(19))
+
+
+@njit(cache=True)
+def pvt_by_table(P_bar, T_C, calc_params, P_grid, T_grid, values, regimes):
+    '''
+    Bilinear interpolation of flow independent properties. Points outside the table, and table cells on regimes boundaries
+    are evaluated directly
+    :return: PVT and is it two phase flow
+    '''
+    is_two_phase = is_two_phase_flow(P_bar, T_C, calc_params)
+    fi = (P_bar - P_grid[0]) / (P_grid[1] - P_grid[0])
+    fj = (T_C - T_grid[0]) / (T_grid[1] - T_grid[0])
+    i, j = int(np.floor(fi)), int(np.floor(fj))
+    if 0 <= i < len(P_grid) - 1 and 0 <= j < len(T_grid) - 1:
+        r = regimes[i, j]
+        if r >= 0 and r == regimes[i + 1, j] and r == regimes[i, j + 1] and r == regimes[i + 1, j + 1] and (r == 0) == is_two_phase:
+            a, b = fi - i, fj - j
+            return interpolate_pvt(values, i, j, a, b), is_two_phase
+    if is_two_phase:
+        v = pvt_to_array(two_phase_pvt(P_bar, T_C, calc_params))
+    else:
+        v = pvt_to_array(three_phase_pvt(P_bar, T_C, calc_params))
+    return pvt_from_array(v), is_two_phase
+
+
+@njit(cache=True)
+def mishenko_by_pvt_table(P_bar, T_C, X_kg_sec, calc_params, tubing_IntDiam, P_grid, T_grid, values, regimes):
+    '''
+    The same as from_oil_params(), but flow independent properties are taken from PVT table
+    '''
+    pvt, is_two_phase = pvt_by_table(P_bar, T_C, calc_params, P_grid, T_grid, values, regimes)
+    if is_two_phase:
+        return two_phase_flow_by_pvt(pvt, X_kg_sec, calc_params, tubing_IntDiam)
+    return three_phase_flow_by_pvt(pvt, X_kg_sec, calc_params)
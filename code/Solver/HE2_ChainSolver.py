@@ -0,0 +1,251 @@
+import numpy as np
+import networkx as nx
+import scipy.optimize as scop
+import Fluids.HE2_Fluid as fl
+from GraphNodes import HE2_Vertices as vrtxs
+from Solver.HE2_Solver import gimme_convergence_stats
+from Tools import HE2_ABC as abc
+from Tools.HE2_Logger import getLogger
+logger = getLogger(__name__)
+
+'''
+Solver for single well subgraphs, see Tools.HE2_tools.cut_single_well_subgraph(). Such graph is a simple path
+plast -> zaboi -> pump intake -> pump outlet -> wellhead (-> pad) with boundary nodes on the ends, so the only unknown
+is the path flow. If both ends are P-nodes, flow is the root of pressure residual on the path end, it is found by
+Newton steps inside the bracket, and by bisection when Newton step leaves the bracket.
+It has the same interface as HE2_Solver: set_known_Q(), update_parameters(), solve(), op_result, edges_x
+'''
+
+
+def gimme_chain_nodes(G):
+    '''
+    :return: nodes list from the path start to the path end, if graph is a simple directed path with boundary nodes
+    on the ends and without boundary nodes inside. None otherwise
+    '''
+    if G.number_of_nodes() < 2 or G.number_of_edges() != G.number_of_nodes() - 1:
+        return None
+    starts = [n for n in G.nodes if G.in_degree(n) == 0]
+    if len(starts) != 1:
+        return None
+    nodes = starts
+    while G.out_degree(nodes[-1]) == 1:
+        nodes = nodes + [next(iter(G.successors(nodes[-1])))]
+    if len(nodes) != G.number_of_nodes():
+        return None
+    objs = [G.nodes[n]['obj'] for n in nodes]
+    if not all(isinstance(obj, vrtxs.HE2_Boundary_Vertex) for obj in (objs[0], objs[-1])):
+        return None
+    if any(isinstance(obj, vrtxs.HE2_Boundary_Vertex) for obj in objs[1:-1]):
+        return None
+    return nodes
+
+
+class HE2_ChainSolver():
+    def __init__(self, schema):
+        '''
+        :param schema: nx.DiGraph or nx.MultiDiGraph, simple path, see gimme_chain_nodes()
+        '''
+        self.schema = schema
+        self.nodes = gimme_chain_nodes(schema)
+        if self.nodes is None:
+            logger.error('Graph is not a simple path with boundary nodes on the ends, use HE2_Solver for it')
+            raise ValueError
+        self.edges = list(zip(self.nodes[:-1], self.nodes[1:]))
+        if isinstance(schema, nx.MultiDiGraph):
+            self.edge_objs = [schema[u][v][0]['obj'] for u, v in self.edges]
+        else:
+            self.edge_objs = [schema[u][v]['obj'] for u, v in self.edges]
+        for (u, v), obj in zip(self.edges, self.edge_objs):
+            if not isinstance(obj, abc.HE2_ABC_GraphEdge):
+                logger.error(f'({u}, {v}) graph edge cannot evaluate its pressure drop')
+                assert False
+        self.known_Q = dict()
+        self.initial_edges_x = dict()
+        self.edges_x = None
+        self.pt_on_nodes = None
+        self.last_x = None
+        self.op_result = None
+        self.it_num = 0
+        self.y_history = []
+
+    def set_known_Q(self, Q_dict):
+        self.known_Q = Q_dict
+
+    def update_parameters(self, nodes_values=None, known_Q=None, edges_x=None):
+        '''
+        The same as HE2_Solver.update_parameters()
+        '''
+        for n, value in (nodes_values or dict()).items():
+            obj = self.schema.nodes[n]['obj']
+            if not isinstance(obj, vrtxs.HE2_Boundary_Vertex):
+                logger.error(f'{n} is not a boundary node, cannot set value {value}')
+                raise ValueError
+            if obj.kind == 'Q':
+                obj.value = obj.Q = abs(value)
+            else:
+                obj.value = obj.P = value
+        if known_Q is not None:
+            self.set_known_Q(known_Q)
+        if edges_x is not None:
+            self.initial_edges_x = edges_x
+
+    def gimme_ends(self):
+        return self.schema.nodes[self.nodes[0]]['obj'], self.schema.nodes[self.nodes[-1]]['obj']
+
+    def gimme_known_x(self):
+        '''
+        :return: path flow, if one of the ends is Q-node, None if both ends are P-nodes
+        '''
+        start, end = self.gimme_ends()
+        if start.kind == 'Q':
+            return start.value if start.is_source else -start.value
+        if end.kind == 'Q':
+            return -end.value if end.is_source else end.value
+        return None
+
+    def get_initial_approximation(self):
+        x0 = (self.initial_edges_x or dict()).get(self.edges[0], None)
+        if x0 is not None:
+            return x0
+        start, end = self.gimme_ends()
+        if self.nodes[0] in self.known_Q:
+            Q = abs(self.known_Q[self.nodes[0]])
+            return Q if start.is_source else -Q
+        if self.nodes[-1] in self.known_Q:
+            Q = abs(self.known_Q[self.nodes[-1]])
+            return -Q if end.is_source else Q
+        return 1.
+
+    def set_source_fluid(self, x):
+        # The only source of the path defines fluid on all the edges, so it is the same as HE2_Solver fluids mixing
+        src_node = self.nodes[0] if x >= 0 else self.nodes[-1]
+        if not vrtxs.is_source(self.schema, src_node):
+            return
+        src = self.schema.nodes[src_node]['obj']
+        src_params = tuple(src.fluid.oil_params)
+        for obj in self.edge_objs:
+            if obj.fluid is None or tuple(obj.fluid.oil_params) != src_params:
+                obj.fluid = fl.HE2_BlackOil(src.fluid.oil_params)
+
+    def target(self, x):
+        '''
+        Evaluates pressures on the path by known pressure on one of the ends
+        :return: pressure residual on the path end, and its derivative by x
+        '''
+        start, end = self.gimme_ends()
+        self.it_num += 1
+        self.last_x = x
+        self.edges_x = {e: x for e in self.edges}
+        pt = [None] * len(self.nodes)
+        drdx = 0
+        if start.kind == 'P':
+            pt[0] = (start.value, abc.Root_T_C)
+            for i, obj in enumerate(self.edge_objs):
+                der_func = getattr(obj, 'perform_calc_forward_with_derivative', None)
+                if der_func is not None:
+                    p, t, dpdx = der_func(*pt[i], x)
+                    drdx += dpdx
+                else:
+                    p, t = obj.perform_calc_forward(*pt[i], x)
+                    drdx = np.nan
+                pt[i + 1] = (p, t)
+        else:
+            pt[-1] = (end.value, abc.Root_T_C)
+            for i in range(len(self.edge_objs) - 1, -1, -1):
+                pt[i] = self.edge_objs[i].perform_calc_backward(*pt[i + 1], x)
+        self.pt_on_nodes = dict(zip(self.nodes, pt))
+
+        r = 0
+        if start.kind == 'P' and end.kind == 'P':
+            r = pt[-1][0] - end.value
+        self.y_history += [abs(r)]
+        return r, drdx
+
+    def find_root(self, x, threshold, it_limit):
+        '''
+        Residual is decreasing by flow (more flow - more pressure drop), so the root is bracketed by flows with positive
+        and negative residuals. Until the bracket is closed, it is expanded by steps doubling
+        :return: y_best, x_best
+        '''
+        lo, hi = -np.inf, np.inf
+        y_best, x_best, x_prev = 100500100500, x, None
+        while self.it_num <= it_limit:
+            r, drdx = self.target(x)
+            if np.isnan(r):
+                # Edges cannot be evaluated on this flow, so it is a bound, and the step is halved
+                if x_prev is None:
+                    break
+                lo, hi = (lo, x) if x > x_prev else (x, hi)
+                x = (x + x_prev) / 2
+                continue
+
+            if abs(r) < y_best:
+                y_best, x_best = abs(r), x
+            if y_best < threshold:
+                break
+            if r > 0:
+                lo = max(lo, x)
+            else:
+                hi = min(hi, x)
+            x_prev, x = x, self.next_x(x, r, drdx, lo, hi)
+        return y_best, x_best
+
+    def next_x(self, x, r, drdx, lo, hi):
+        span = max(abs(x), 1.)
+        if np.isfinite(drdx) and drdx < 0:
+            x_newton = x - r / drdx
+            if np.isfinite(lo) and np.isfinite(hi) and lo < x_newton < hi:
+                return x_newton
+            if lo < x_newton < hi and abs(x_newton - x) < 4 * span:
+                return x_newton
+        if np.isfinite(lo) and np.isfinite(hi):
+            return (lo + hi) / 2
+        return x + span if r > 0 else x - span
+
+    def solve(self, threshold=0.05, it_limit=100, mix_fluids=True):
+        '''
+        :param threshold: solution is found, when pressure residual on the path end is less than threshold
+        :param it_limit: max path evaluations count
+        :param mix_fluids: set source fluid on the path edges
+        '''
+        y_best, x_best = 100500100500, None
+        self.it_num = 0
+        self.y_history = []
+        try:
+            x = self.gimme_known_x()
+            if x is None:
+                x = self.get_initial_approximation()
+                if mix_fluids:
+                    self.set_source_fluid(x)
+                y_best, x_best = self.find_root(x, threshold, it_limit)
+            else:
+                if mix_fluids:
+                    self.set_source_fluid(x)
+                y_best, x_best = abs(self.target(x)[0]), x
+            if self.last_x != x_best:
+                self.target(x_best)
+            self.attach_results_to_schema()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+        if self.it_num > it_limit:
+            logger.error(f'Solution is NOT found, iterations limit {it_limit} is exceed. y_best = {y_best} threshold = {threshold}')
+        x_best = None if x_best is None else np.array([[x_best]])
+        self.op_result = scop.OptimizeResult(success=y_best < threshold, fun=y_best, x=x_best, nfev=self.it_num)
+        self.op_result.update(gimme_convergence_stats(self.y_history))
+        if self.op_result.success:
+            self.initial_edges_x = self.edges_x.copy()
+
+    def attach_results_to_schema(self):
+        x = self.last_x
+        for i, n in enumerate(self.nodes):
+            obj = self.schema.nodes[n]['obj']
+            p, t = self.pt_on_nodes[n]
+            obj.result = dict(P_bar=p, T_C=t, Q=0)
+            if i in (0, len(self.nodes) - 1) and obj.kind == 'P':
+                obj.result['Q'] = x if i == 0 else -x
+            elif i in (0, len(self.nodes) - 1):
+                obj.result['Q'] = obj.value if obj.is_source else -obj.value
+
+        for obj in self.edge_objs:
+            obj.result = dict(x=x, WC=obj.fluid.oil_params.volumewater_percent, liquid_density=obj.fluid.CurrentLiquidDensity_kg_m3)
@@ -0,0 +1,314 @@
+import numpy as np
+from numba import njit
+from Tools.HE2_ABC import oil_params, fieldlist, Root_T_C
+from GraphEdges.HE2_Pipe import HE2_OilPipe, HE2_WaterPipe, march_oil_pipe, march_oil_pipe_with_derivative, march_water_pipe
+from GraphEdges.HE2_Plast import HE2_Plast
+from GraphEdges.HE2_SpecialEdges import HE2_MockEdge
+from GraphEdges.HE2_WellPump import HE2_WellPump, pump_head
+from Hydraulics.Properties.Mishenko import liquid_density_by_oil_params
+from Fluids.HE2_Fluid import gimme_fluids_table
+import uniflocpy.uTools.uconst as uc
+from Tools.HE2_Logger import getLogger
+logger = getLogger(__name__)
+
+'''
+Compiled network mode for HE2_Solver. All the edges are packed into struct-of-arrays, and pressures propagation by the tree
+and chordes residuals are evaluated by one njit kernel. Edges of other types (subclasses, for example) are evaluated by python,
+between kernel calls
+'''
+
+PYTHON_EDGE, OIL_PIPE, WATER_PIPE, MOCK_EDGE, PLAST, PUMP = 0, 1, 2, 3, 4, 5
+
+
+def get_edge_type(obj):
+    # Exact class check, cause subclasses can override edge functions
+    if type(obj) == HE2_OilPipe:
+        return OIL_PIPE
+    if type(obj) == HE2_WaterPipe:
+        return WATER_PIPE
+    if type(obj) == HE2_MockEdge:
+        return MOCK_EDGE
+    if type(obj) == HE2_Plast and obj.fluid is not None:
+        return PLAST
+    if type(obj) == HE2_WellPump and obj.fluid is not None:
+        return PUMP
+    return PYTHON_EDGE
+
+
+@njit(cache=True)
+def edge_calc(etype, P_bar, T_C, X_kgsec, calc_direction, param, fluid_row, geometry, water_rho, water_mu, curve, pump_param):
+    '''
+    The same as perform_calc_forward_with_derivative() and perform_calc_backward() of edge objects
+    :return: p, t on the other end of edge, and dp/dx for forward calculation (nan for backward one)
+    '''
+    if etype == OIL_PIPE:
+        calc_params = oil_params(fluid_row[0], fluid_row[1], fluid_row[2], fluid_row[3], fluid_row[4], fluid_row[5],
+                                 fluid_row[6], fluid_row[7], fluid_row[8])
+        if calc_direction == 1:
+            return march_oil_pipe_with_derivative(P_bar, T_C, X_kgsec, calc_params, geometry)
+        p, t = march_oil_pipe(P_bar, T_C, X_kgsec, calc_params, geometry, -1)
+        return p, t, np.nan
+    elif etype == WATER_PIPE:
+        if geometry.shape[1] == 0:
+            return P_bar, T_C, 0.
+        p, dpdx = march_water_pipe(P_bar, X_kgsec, geometry, calc_direction, water_rho, water_mu)
+        return p, 20., dpdx
+    elif etype == MOCK_EDGE:
+        return P_bar + calc_direction * param, T_C, 0.
+    elif etype == PUMP:
+        # pump_param is frequency / 50, stages ratio and is pump on
+        if pump_param[2] == 0:
+            return P_bar - X_kgsec * 100500, T_C, -100500.
+        calc_params = oil_params(fluid_row[0], fluid_row[1], fluid_row[2], fluid_row[3], fluid_row[4], fluid_row[5],
+                                 fluid_row[6], fluid_row[7], fluid_row[8])
+        liq_dens = liquid_density_by_oil_params(max(abs(P_bar), 0.75), T_C, X_kgsec, calc_params, 0.)
+        head, dhead = pump_head(X_kgsec * 86400 / liq_dens, curve, pump_param[0], pump_param[1])
+        P_rez_bar = P_bar + calc_direction * head * 9.81 * liq_dens / 1e5
+        return P_rez_bar, T_C, dhead * 9.81 * 86400 / 1e5
+    else:
+        # HE2_Plast
+        calc_params = oil_params(fluid_row[0], fluid_row[1], fluid_row[2], fluid_row[3], fluid_row[4], fluid_row[5],
+                                 fluid_row[6], fluid_row[7], fluid_row[8])
+        liq_dens = liquid_density_by_oil_params(max(abs(P_bar), 0.75), T_C, X_kgsec, calc_params, 0.)
+        P_rez_bar = P_bar - calc_direction * (X_kgsec * 86400 / liq_dens) / param
+        return P_rez_bar, T_C, -86400 / liq_dens / param
+
+
+@njit(cache=True)
+def evaluate_edges(order, is_chord, known_is_u, etype, u, v, X, param, fluid_rows, geometry, seg_begin, seg_end,
+                   water_rho, water_mu, curves, curve_begin, curve_end, pump_params, P, T, P_end, T_end, dpdx):
+    '''
+    Evaluates edges in given order. Tree edges propagate pressure to unknown node, chordes evaluate pressure on its end
+    :param P, T: nodes pressures and temperatures, unknown ones are filled by the kernel
+    :param P_end, T_end, dpdx: forward calculation results for edges
+    '''
+    for e in order:
+        g = geometry[:, seg_begin[e]:seg_end[e]]
+        c = curves[:, curve_begin[e]:curve_end[e]]
+        if is_chord[e] or known_is_u[e]:
+            p, t, d = edge_calc(etype[e], P[u[e]], T[u[e]], X[e], 1, param[e], fluid_rows[e], g, water_rho, water_mu, c, pump_params[e])
+            P_end[e], T_end[e], dpdx[e] = p, t, d
+            if not is_chord[e]:
+                P[v[e]], T[v[e]] = p, t
+        else:
+            p, t, d = edge_calc(etype[e], P[v[e]], T[v[e]], X[e], -1, param[e], fluid_rows[e], g, water_rho, water_mu, c, pump_params[e])
+            P[u[e]], T[u[e]] = p, t
+            p, t, d = edge_calc(etype[e], p, t, X[e], 1, param[e], fluid_rows[e], g, water_rho, water_mu, c, pump_params[e])
+            P_end[e], T_end[e], dpdx[e] = p, t, d
+
+
+@njit(cache=True)
+def evaluate_edges_batch(order, active, is_chord, known_is_u, etype, u, v, X, param, fluid_rows, geometry, seg_begin, seg_end,
+                         water_rho, water_mu, curves, curve_begin, curve_end, pump_params, P, T, P_end, T_end, dpdx):
+    '''
+    evaluate_edges() for scenarios batch. X, param, P, T, P_end, T_end, dpdx have leading scenario axis
+    :param active: scenarios mask, inactive scenarios are skipped
+    '''
+    for k in range(len(active)):
+        if active[k]:
+            evaluate_edges(order, is_chord, known_is_u, etype, u, v, X[k], param[k], fluid_rows, geometry, seg_begin, seg_end,
+                           water_rho, water_mu, curves, curve_begin, curve_end, pump_params, P[k], T[k], P_end[k], T_end[k], dpdx[k])
+
+
+class HE2_CompiledNetwork():
+    def __init__(self, graph, node_list, edge_list, tree_travers, chordes, forward_edge_functions, backward_edge_functions,
+                 forward_derivative_functions, root):
+        node_idx = {n: i for i, n in enumerate(node_list)}
+        edge_idx = {e: i for i, e in enumerate(edge_list)}
+        E = len(edge_list)
+        self.edge_list = edge_list
+        self.N = len(node_list)
+        self.root_idx = node_idx[root]
+        self.objs = [graph[u][v]['obj'] for (u, v) in edge_list]
+        self.etype = np.array([get_edge_type(obj) for obj in self.objs], dtype=np.int64)
+        self.u = np.array([node_idx[u] for (u, v) in edge_list], dtype=np.int64)
+        self.v = np.array([node_idx[v] for (u, v) in edge_list], dtype=np.int64)
+        self.is_chord = np.zeros(E, dtype=np.bool_)
+        self.is_chord[[edge_idx[e] for e in chordes]] = True
+        self.known_is_u = np.zeros(E, dtype=np.bool_)
+        self.forward_edge_functions = forward_edge_functions
+        self.backward_edge_functions = backward_edge_functions
+        self.forward_derivative_functions = forward_derivative_functions
+
+        # Tree edges are reordered, so python edges are grouped, and kernel is called as few times as possible.
+        # Edge stage is count of python edges on the path from root. Parents are still evaluated before children
+        known = {root}
+        fallback_depth = {root: 0}
+        keys = []
+        for u, v, direction in tree_travers:
+            e = edge_idx[(u, v)]
+            kn, unk = (u, v) if u in known else (v, u)
+            self.known_is_u[e] = kn == u
+            is_python = self.etype[e] == PYTHON_EDGE
+            fallback_depth[unk] = fallback_depth[kn] + is_python
+            keys += [2 * fallback_depth[kn] + is_python]
+            known.add(unk)
+        tree_order = [edge_idx[(u, v)] for u, v, d in tree_travers]
+        tree_order = [tree_order[i] for i in np.argsort(keys, kind='stable')]
+        chordes_order = [edge_idx[e] for e in chordes]
+        chordes_order = [e for e in chordes_order if self.etype[e] != PYTHON_EDGE] + [e for e in chordes_order if self.etype[e] == PYTHON_EDGE]
+
+        # Order is splitted to runs of compiled and python edges
+        self.runs = []
+        for e in tree_order + chordes_order:
+            is_python = self.etype[e] == PYTHON_EDGE
+            if not self.runs or self.runs[-1][0] != is_python:
+                self.runs += [(is_python, [])]
+            self.runs[-1][1].append(e)
+        self.runs = [(is_python, np.array(order, dtype=np.int64)) for is_python, order in self.runs]
+        logger.debug(f'{len(self.runs)} runs, {np.sum(self.etype == PYTHON_EDGE)} python edges')
+
+        self.pipe_idx = list(np.flatnonzero((self.etype == OIL_PIPE) | (self.etype == WATER_PIPE)))
+        self.fluid_idx = list(np.flatnonzero((self.etype == OIL_PIPE) | (self.etype == PLAST) | (self.etype == PUMP)))
+        self.mock_idx = list(np.flatnonzero(self.etype == MOCK_EDGE))
+        self.plast_idx = list(np.flatnonzero(self.etype == PLAST))
+        self.pump_idx = list(np.flatnonzero(self.etype == PUMP))
+        self.param = np.zeros(E)
+        self.fluid_rows = np.zeros((E, len(fieldlist)))
+        self.seg_begin = np.zeros(E, dtype=np.int64)
+        self.seg_end = np.zeros(E, dtype=np.int64)
+        self.geometry = None
+        self.packed_geometry = None
+        self.packed_fluids = None
+        self.pump_params = np.zeros((E, 3))
+        self.curve_begin = np.zeros(E, dtype=np.int64)
+        self.curve_end = np.zeros(E, dtype=np.int64)
+        self.curves = None
+        self.packed_curves = None
+        self.water_rho = 1000.
+        self.water_mu = 1e-3
+        for obj in self.objs:
+            if type(obj) == HE2_WaterPipe:
+                self.water_rho, self.water_mu = obj.water.rho_wat_kgm3, uc.cP2pasec(obj.water.mu_wat_cp)
+
+        self.P = np.zeros(self.N)
+        self.T = np.zeros(self.N)
+        self.P_end = np.zeros(E)
+        self.T_end = np.zeros(E)
+        self.dpdx = np.zeros(E)
+        self.python_forward_calls = dict()
+        self.batch_P, self.batch_T = None, None
+        self.batch_P_end, self.batch_T_end, self.batch_dpdx = None, None, None
+
+    def pack_geometry(self):
+        '''
+        Pipes geometry arrays are concatenated, and pipes are bound to views of the network array, like segments are bound
+        to pipe array. So segments changes are visible for the kernel without repacking
+        '''
+        pipes = [self.objs[i] for i in self.pipe_idx]
+        for pipe in pipes:
+            pipe.check_geometry()
+        geoms = [pipe.geometry for pipe in pipes]
+        self.geometry = np.concatenate(geoms, axis=1) if geoms else np.zeros((5, 0))
+        lengths = [g.shape[1] for g in geoms]
+        self.seg_end[self.pipe_idx] = np.cumsum(lengths, dtype=np.int64)
+        self.seg_begin[self.pipe_idx] = self.seg_end[self.pipe_idx] - lengths
+        for pipe, b, e in zip(pipes, self.seg_begin[self.pipe_idx], self.seg_end[self.pipe_idx]):
+            pipe.bind_segments_geometry(self.geometry[:, b:e])
+        self.packed_geometry = [pipe.geometry for pipe in pipes]
+
+    def pack_curves(self):
+        '''
+        Pumps head curves are fixed arrays, frequency and stages ratio are applied by the kernel
+        '''
+        curves = [self.objs[i].head_curve for i in self.pump_idx]
+        self.curves = np.concatenate(curves, axis=1) if curves else np.zeros((4, 0))
+        lengths = [c.shape[1] for c in curves]
+        self.curve_end[self.pump_idx] = np.cumsum(lengths, dtype=np.int64)
+        self.curve_begin[self.pump_idx] = self.curve_end[self.pump_idx] - lengths
+        self.packed_curves = curves
+
+    def refresh(self):
+        '''
+        Fluids, pipes geometry and edges parameters can be changed between solver iterations, so they are packed again,
+        if they are changed
+        '''
+        pipes = [self.objs[i] for i in self.pipe_idx]
+        if self.packed_geometry is None or any(pipe.geometry is not g or g.shape[1] != len(pipe.segments) for pipe, g in zip(pipes, self.packed_geometry)):
+            self.pack_geometry()
+        fluids = [self.objs[i].fluid for i in self.fluid_idx]
+        table = gimme_fluids_table(fluids)
+        if table is not None:
+            # Solver fluid table rows are taken as is, oil_params tuples are not needed
+            self.fluid_rows[self.fluid_idx] = table.rows[[fluid.idx for fluid in fluids]]
+            self.packed_fluids = None
+        else:
+            fluids = [fluid.oil_params for fluid in fluids]
+            if self.packed_fluids is None or any(f is not f_ for f, f_ in zip(fluids, self.packed_fluids)):
+                self.fluid_rows[self.fluid_idx] = np.array(fluids, dtype=float).reshape((len(fluids), len(fieldlist)))
+                self.packed_fluids = fluids
+        self.param[self.mock_idx] = [self.objs[i].dP for i in self.mock_idx]
+        self.param[self.plast_idx] = [self.objs[i].Productivity for i in self.plast_idx]
+        pumps = [self.objs[i] for i in self.pump_idx]
+        if self.packed_curves is None or any(pump.head_curve is not c for pump, c in zip(pumps, self.packed_curves)):
+            self.pack_curves()
+        if pumps:
+            self.pump_params[self.pump_idx] = [(p.frequency / 50, p.stages_ratio, p.state.upper() != 'OFF') for p in pumps]
+
+    def evaluate(self, X):
+        '''
+        :param X: edges flows, in edge_list order
+        Fills nodes pressures P, T, and P_end, T_end, dpdx for edges. dpdx is nan, if it is not known yet
+        '''
+        self.refresh()
+        self.P[:], self.T[:] = np.nan, np.nan
+        self.P[self.root_idx], self.T[self.root_idx] = 0, Root_T_C
+        self.dpdx[:] = np.nan
+        self.python_forward_calls = dict()
+        for is_python, order in self.runs:
+            if is_python:
+                self.evaluate_python_edges(order, X)
+            else:
+                evaluate_edges(order, self.is_chord, self.known_is_u, self.etype, self.u, self.v, X, self.param, self.fluid_rows,
+                               self.geometry, self.seg_begin, self.seg_end, self.water_rho, self.water_mu,
+                               self.curves, self.curve_begin, self.curve_end, self.pump_params,
+                               self.P, self.T, self.P_end, self.T_end, self.dpdx)
+
+    def evaluate_batch(self, X, active, param_idx=(), param_values=None):
+        '''
+        evaluate() for scenarios batch, edges objects are the same for all the scenarios
+        :param X: (K, E) edges flows, in edge_list order
+        :param active: (K,) mask of scenarios to evaluate, rows of inactive ones are kept as is
+        :param param_idx, param_values: (K, len(param_idx)) edges parameters by scenarios - mock edges dP, plasts productivity
+        Fills batch_P, batch_T (K, N) and batch_P_end, batch_T_end, batch_dpdx (K, E)
+        '''
+        self.refresh()
+        K, E = X.shape
+        if self.batch_P is None or len(self.batch_P) != K:
+            self.batch_P, self.batch_T = np.zeros((K, self.N)), np.zeros((K, self.N))
+            self.batch_P_end, self.batch_T_end, self.batch_dpdx = np.zeros((K, E)), np.zeros((K, E)), np.zeros((K, E))
+        param = np.tile(self.param, (K, 1))
+        if len(param_idx):
+            param[:, param_idx] = param_values
+        P, T, P_end, T_end, dpdx = self.batch_P, self.batch_T, self.batch_P_end, self.batch_T_end, self.batch_dpdx
+        P[active], T[active], dpdx[active] = np.nan, np.nan, np.nan
+        P[active, self.root_idx], T[active, self.root_idx] = 0, Root_T_C
+        for is_python, order in self.runs:
+            if is_python:
+                for k in np.flatnonzero(active):
+                    self.evaluate_python_edges(order, X[k], P[k], T[k], P_end[k], T_end[k], dpdx[k])
+            else:
+                evaluate_edges_batch(order, active, self.is_chord, self.known_is_u, self.etype, self.u, self.v, X, param,
+                                     self.fluid_rows, self.geometry, self.seg_begin, self.seg_end, self.water_rho, self.water_mu,
+                                     self.curves, self.curve_begin, self.curve_end, self.pump_params, P, T, P_end, T_end, dpdx)
+
+    def evaluate_python_edges(self, order, X, P=None, T=None, P_end=None, T_end=None, dpdx=None):
+        calls = dict()
+        if P is None:
+            P, T, P_end, T_end, dpdx = self.P, self.T, self.P_end, self.T_end, self.dpdx
+            calls = self.python_forward_calls
+        for e in order:
+            edge = self.edge_list[e]
+            u, v, x = self.u[e], self.v[e], X[e]
+            if self.is_chord[e] or self.known_is_u[e]:
+                der_func = self.forward_derivative_functions[edge]
+                if der_func is not None:
+                    p, t, dpdx[e] = der_func(P[u], T[u], x)
+                else:
+                    p, t = self.forward_edge_functions[edge](P[u], T[u], x)
+                P_end[e], T_end[e] = p, t
+                calls[edge] = (p, t)
+                if not self.is_chord[e]:
+                    P[v], T[v] = p, t
+            else:
+                P[u], T[u] = self.backward_edge_functions[edge](P[v], T[v], x)
@@ -0,0 +1,68 @@
+from GraphEdges.HE2_Pipe import HE2_OilPipe
+from GraphEdges.HE2_WellPump import HE2_WellPump
+from Tools.cachespline import LazySplineCache
+from Tools.HE2_Logger import getLogger
+logger = getLogger(__name__)
+
+'''
+Surrogates of edges pressure drop for HE2_Solver early iterations. Edge perform_calc_forward() and perform_calc_backward()
+are approximated by lazy spline caches over (P, X) grid, see Tools.cachespline.LazySplineCache
+'''
+
+default_cache_kwargs = dict(dx=1., dy=0.1, half_nx=4, half_ny=4, kind='cubic', err_control_rate=0.01, tol=1e-3,
+                            max_pieces=64, max_level=3)
+
+
+def edge_can_have_surrogate(obj):
+    return type(obj) in (HE2_OilPipe, HE2_WellPump)
+
+
+class HE2_EdgeSurrogate():
+    def __init__(self, obj, T_C=20, **cache_kwargs):
+        '''
+        :param obj: HE2_OilPipe or HE2_WellPump
+        :param T_C: temperature is assumed constant, so calls with other temperature are evaluated by the edge itself
+        :param cache_kwargs: LazySplineCache kwargs, see default_cache_kwargs
+        '''
+        self.obj = obj
+        self.T_C = T_C
+        self.cache_kwargs = dict(default_cache_kwargs)
+        self.cache_kwargs.update(cache_kwargs)
+        self.signature = None
+        self.forward = None
+        self.backward = None
+        self.refresh()
+
+    def get_signature(self):
+        obj = self.obj
+        if isinstance(obj, HE2_WellPump):
+            return tuple(obj.fluid.oil_params), obj.frequency, obj.stages_ratio, obj.state
+        obj.check_geometry()
+        return tuple(obj.fluid.oil_params), obj.geometry.tobytes()
+
+    def refresh(self):
+        '''
+        Caches are dropped, if edge fluid or parameters are changed
+        '''
+        signature = self.get_signature()
+        if signature == self.signature:
+            return
+        self.signature = signature
+        self.forward = LazySplineCache(lambda p, x: self.obj.perform_calc_forward(p, self.T_C, x)[0], **self.cache_kwargs)
+        self.backward = LazySplineCache(lambda p, x: self.obj.perform_calc_backward(p, self.T_C, x)[0], **self.cache_kwargs)
+
+    def perform_calc_forward(self, P_bar, T_C, X_kgsec):
+        if T_C != self.T_C:
+            return self.obj.perform_calc_forward(P_bar, T_C, X_kgsec)
+        return self.forward(P_bar, X_kgsec), T_C
+
+    def perform_calc_backward(self, P_bar, T_C, X_kgsec):
+        if T_C != self.T_C:
+            return self.obj.perform_calc_backward(P_bar, T_C, X_kgsec)
+        return self.backward(P_bar, X_kgsec), T_C
+
+    def perform_calc_forward_with_derivative(self, P_bar, T_C, X_kgsec):
+        if T_C != self.T_C:
+            return self.obj.perform_calc_forward_with_derivative(P_bar, T_C, X_kgsec)
+        p, dpdx = self.forward.value_and_derivative(P_bar, X_kgsec)
+        return p, T_C, dpdx
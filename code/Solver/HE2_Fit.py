@@ -4,8 +4,12 @@ import numpy as np
 import pandas as pd
 import os
 from Solver.HE2_Solver import HE2_Solver
-from Tools.HE2_schema_maker import make_oilpipe_schema_from_OT_dataset, make_calc_df
+from Solver.HE2_ScenarioRunner import HE2_ScenarioRunner, apply_params_to_graph, gimme_original_diams
+from Solver.HE2_ChainSolver import HE2_ChainSolver
+from Solver.HE2_PrefitRunner import HE2_PrefitRunner, gimme_pads_chunks
+from Tools.HE2_schema_maker import make_oilpipe_schema_from_OT_dataset, make_calc_df, make_multigraph_schema_from_OISPipe_dataframes
 from Tools.HE2_tools import check_solution, print_solution, print_wells_pressures, cut_single_well_subgraph
+from Tools.HE2_tools import split_input_df_to_pipes_and_boundaries
 import logging
 import GraphNodes.HE2_Vertices as vrtx
 import matplotlib.pyplot as plt
@@ -17,7 +21,12 @@ from datetime import datetime
 from Tools.HE2_tools import check_solution
 
 class HE2_PMNetwork_Model():
-    def __init__(self, input_df, method=None, use_bounds=False, fit_version=None):
+    def __init__(self, input_df, method=None, use_bounds=False, fit_version=None, use_jac=False, persistent=False):
+        '''
+        :param use_jac: give jac() to gradient based minimizers, instead of finite differences by target()
+        :param persistent: build graph and solver once, and change pipes in place on target() calls, see predict_in_place().
+        Otherwise graph is built from weighted dataframe on every call, see HE2_DateframeWrapper.do_predict()
+        '''
         # 1750023893
         # 1750024074
         # 1750040926
@@ -51,6 +60,7 @@ class HE2_PMNetwork_Model():
         self.reg_r_dispersion_keff = 1
         self.reg_total_keff = 1
         self.target_columns = {'start_P': 'result_start_P', 'end_P': 'result_end_P'}
+        self.target_nodes_columns = {'start_P': 'node_id_start', 'end_P': 'node_id_end'}
         self.max_it = 100
         self.it = 0
         self.y0 = 0
@@ -60,6 +70,13 @@ class HE2_PMNetwork_Model():
         self.use_bounds = use_bounds
         self.fit_version = fit_version
         self.best_rez_df = None
+        self.use_jac = use_jac
+        self.last_solve = None
+        self.persistent = persistent
+        self.G = None
+        self.solver = None
+        self.network_edges = None
+        self.result_values = None
 
     def regularizator(self):
         N = self.row_count
@@ -70,6 +87,21 @@ class HE2_PMNetwork_Model():
         terms[3] = np.std(self.r_weights) * self.reg_r_dispersion_keff
         return np.sum(terms) * self.reg_total_keff
 
+    def regularizator_gradient(self):
+        '''
+        :return: regularizator() gradient by diameters weights. Roughness weights are not fitted, see apply_weights_to_model()
+        '''
+        N = self.row_count
+        d_dev = np.ones(N) - self.d_weights
+        grad = np.zeros(N)
+        norm = np.linalg.norm(d_dev)
+        if norm > 0:
+            grad -= d_dev / norm * self.reg_d_deviation_keff
+        std = np.std(self.d_weights)
+        if std > 0:
+            grad += (self.d_weights - np.mean(self.d_weights)) / (N * std) * self.reg_d_dispersion_keff
+        return grad * self.reg_total_keff
+
     def apply_weights_to_model_long(self, x):
         N = self.row_count
         d_w = x[:N]
@@ -89,7 +121,7 @@ class HE2_PMNetwork_Model():
         df.roughness = df.roughness * r_w
         return df
 
-    def apply_weights_to_model(self, x):
+    def clip_weights(self, x):
         N = self.row_count
         d_w = x
 
@@ -99,8 +131,10 @@ class HE2_PMNetwork_Model():
         self.d_weights = d_w
         self.r_weights = np.ones(N)
 
+    def apply_weights_to_model(self, x):
+        self.clip_weights(x)
         df = self.input_df.copy()
-        df.D = df.D * d_w
+        df.D = df.D * self.d_weights
         return df
 
     def evaluate_y(self, df):
@@ -114,12 +148,106 @@ class HE2_PMNetwork_Model():
             y += np.linalg.norm(known_y - result_y)
         return y
 
+    def evaluate_y_gradient(self, df):
+        '''
+        :return: dict node -> d(evaluate_y)/dP on the node
+        '''
+        rez = dict()
+        for col_known, col_rez in self.target_columns.items():
+            mask = ~df.loc[:, col_known].isna()
+            known_y = df.loc[mask, col_known].values
+            result_y = df.loc[mask, col_rez].values
+            norm = np.linalg.norm(known_y - result_y)
+            if norm == 0:
+                continue
+            nodes = df.loc[mask, self.target_nodes_columns[col_known]].values
+            for n, value in zip(nodes, (result_y - known_y) / norm):
+                rez[n] = rez.get(n, 0) + value
+        return rez
+
+    def evaluate_pipes_sensitivities(self):
+        '''
+        Sensitivities of evaluate_y() by pipes parameters on the last target() solution. Measured pressures sensitivities
+        are given by adjoint method for all the pipes at once, see HE2_Solver.evaluate_adjoint_sensitivities(), and pipes
+        pressure drops derivatives by parameters are exact, see perform_calc_forward_with_parameters_derivatives() of pipes
+        :return: dy/dD and dy/droughness arrays in input_df rows order, for pipes inner diameters and roughness in meters
+        '''
+        N = self.row_count
+        dy_dD, dy_dR = np.zeros(N), np.zeros(N)
+        _, rez_df, G, solver = self.last_solve
+        if rez_df is None:
+            return dy_dD, dy_dR
+        dy_dp = self.evaluate_y_gradient(rez_df)
+        dy_ddp = solver.evaluate_adjoint_sensitivities(dy_dp)
+        rows = {idx: i for i, idx in enumerate(self.input_df.index)}
+        for (u, v, k), value in dy_ddp.items():
+            obj = G[u][v][k]['obj']
+            u_result = G.nodes[u]['obj'].result
+            p, t, ders = obj.perform_calc_forward_with_parameters_derivatives(u_result['P_bar'], u_result['T_C'], obj.result['x'])
+            i = rows[G[u][v][k]['idx_for_result']]
+            dy_dD[i] += value * ders['inner_diam_m']
+            dy_dR[i] += value * ders['roughness_m']
+        return dy_dD, dy_dR
+
+    def build_network(self):
+        '''
+        Builds graph and solver once, the same way as HE2_DateframeWrapper.do_predict() does. Graph edges are mapped
+        to input_df rows, so pipes are changed in place by weights, and results are written by rows
+        '''
+        df = self.input_df.copy()
+        df.columns = model.do_upcase_columns_adhoc(df.columns)
+        df = model.transform_measure_units(df)
+        df_pipes, df_bnds = split_input_df_to_pipes_and_boundaries(df)
+        self.G = make_multigraph_schema_from_OISPipe_dataframes(df_pipes, df_bnds)
+        self.solver = HE2_Solver(self.G)
+        rows = {idx: i for i, idx in enumerate(self.input_df.index)}
+        self.network_edges = []
+        for u, v, k in self.G.edges:
+            obj = self.G[u][v][k]['obj']
+            roughness = [seg.roughness_m for seg in obj.segments]
+            self.network_edges += [(rows[self.G[u][v][k]['idx_for_result']], obj, self.G.nodes[u]['obj'], self.G.nodes[v]['obj'], roughness)]
+        self.result_values = np.zeros((self.row_count, len(model.result_cols)))
+
+    def predict_in_place(self):
+        '''
+        Sets current weights to the pipes and solves the network. Solver is warm started by the last solution
+        :return: result dataframe, the same as HE2_DateframeWrapper.do_predict() returns. None, if solution is not found
+        '''
+        if self.G is None:
+            self.build_network()
+        # Inner diameter is D * weight - 2 * S, in millimeters
+        inner_diams = (self.input_df.D.values * self.d_weights - 2 * self.input_df.S.values) / 1000
+        for i, obj, u_obj, v_obj, roughness in self.network_edges:
+            for seg, rgh in zip(obj.segments, roughness):
+                seg.inner_diam_m = inner_diams[i]
+                seg.roughness_m = rgh * self.r_weights[i]
+
+        self.solver.solve(threshold=1e-4, method='newton')
+        if self.solver.op_result.fun > 1e-3:
+            return None
+        # Solver keeps warm start for converged solves only, but solution is accepted with larger residual too
+        self.solver.update_parameters(edges_x=self.solver.edges_x.copy())
+
+        values = self.result_values
+        for i, obj, u_obj, v_obj, roughness in self.network_edges:
+            x = obj.result['x']
+            values[i] = abs(x), np.sign(x), u_obj.result['P_bar'], u_obj.result['T_C'], v_obj.result['P_bar'], v_obj.result['T_C']
+        # Measured values are taken from input_df, they can be changed between calls
+        rez_df = self.input_df.copy()
+        rez_df[model.result_cols] = values
+        return rez_df
+
     def target(self, x):
         self.it += 1
         if self.it > self.max_it:
             raise Exception()
-        df = self.apply_weights_to_model(x)
-        rez_df = model.do_predict(df)
+        if self.persistent:
+            self.clip_weights(x)
+            rez_df, G, solver = self.predict_in_place(), self.G, self.solver
+        else:
+            df = self.apply_weights_to_model(x)
+            rez_df, G, solver = model.do_predict(df, return_solver=True)
+        self.last_solve = (np.array(x), rez_df, G, solver)
         y_term = self.evaluate_y(rez_df)
         reg_term = self.regularizator()
         rez = reg_term + y_term
@@ -131,6 +259,20 @@ class HE2_PMNetwork_Model():
             self.best_rez_df = rez_df
         return rez
 
+    def jac(self, x):
+        '''
+        Gradient of target() by diameters weights. It is evaluated on target(x) solution, which is usually done
+        by minimizer just before jac(x) call, so the gradient costs no network solves.
+        Target clips weights to bounds, so gradient is taken on clipped x. It is not zeroed out of bounds,
+        so minimizer, which is out of bounds, moves back inside
+        '''
+        x = np.clip(x, self.d_min, self.d_max)
+        if self.last_solve is None or not np.array_equal(np.clip(self.last_solve[0], self.d_min, self.d_max), x):
+            self.target(x)
+        dy_dD, _ = self.evaluate_pipes_sensitivities()
+        # Inner diameter is D * weight - 2 * S, in millimeters
+        return dy_dD * self.input_df.D.values / 1000 + self.regularizator_gradient()
+
     def fit_v0(self):
         N = self.row_count
         self.it = 0
@@ -165,7 +307,8 @@ class HE2_PMNetwork_Model():
                        0.91255343, 0.94552903])
 
         try:
-            op_result = scop.minimize(target, x0, method=self.minimize_method, bounds=bnds, options=dict(nfev=100500))
+            jac = self.jac if self.use_jac else None
+            op_result = scop.minimize(target, x0, method=self.minimize_method, jac=jac, bounds=bnds, options=dict(nfev=100500))
         except:
             op_result = scop.OptimizeResult(success=True, fun=self.best_y, x=self.best_x, nfev=self.it)
         return op_result
@@ -197,7 +340,8 @@ class HE2_PMNetwork_Model():
         # x0 = np.ones(self.row_count) * 0.87
 
         try:
-            op_result = scop.basinhopping(target, x0, 100500, T=100)
+            minimizer_kwargs = dict(jac=self.jac) if self.use_jac else None
+            op_result = scop.basinhopping(target, x0, 100500, T=100, minimizer_kwargs=minimizer_kwargs)
         except:
             op_result = scop.OptimizeResult(success=True, fun=self.best_y, x=self.best_x, nfev=self.it)
         return op_result
@@ -387,6 +531,9 @@ class HE2_OilGatheringNetwork_Model():
         self.original_diams = dict()
         self.last_it_count = 0
         self.ignore_watercut = False
+        self.scenario_runner = None
+        self.prefit_grid_size = 15
+        self.chain_solver = True # Single well subgraphs are solved by HE2_ChainSolver
 
 
     def gimme_original_df(self, i):
@@ -521,7 +668,7 @@ class HE2_OilGatheringNetwork_Model():
         for i in range(self.N):
             solver = self.gimme_solver(i)
             if (0, 0, i) in self.initial_x:
-                solver.initial_edges_x = self.initial_x[(0, 0, i)]
+                solver.update_parameters(edges_x=self.initial_x[(0, 0, i)])
             solver.solve(threshold=0.5, mix_fluids=True)
             validity = check_solution(solver.schema)
             print(validity)
@@ -530,6 +677,64 @@ class HE2_OilGatheringNetwork_Model():
             self.initial_x[(0, 0, i)] = solver.edges_x.copy()
         return success
 
+    def gimme_scenario_runner(self, processes=None):
+        if self.scenario_runner is None:
+            graphs = {i: self.gimme_graph(i) for i in range(self.N)}
+            self.scenario_runner = HE2_ScenarioRunner(graphs, processes, self.outlayers.get('freq', None))
+        return self.scenario_runner
+
+    def solve_em_all_parallel(self, params_sets, processes=None):
+        '''
+        Parallel version of apply_params() + solve_em_all(), for several params sets at once
+        :param params_sets: dict scenario key -> params (see apply_params), each params set is solved for all the datasets
+        :return: dict (scenario key, dataset index) -> result, see HE2_ScenarioRunner.run()
+        '''
+        runner = self.gimme_scenario_runner(processes)
+        scenarios = [(i, key, params) for key, params in params_sets.items() for i in range(self.N)]
+        results = runner.run(scenarios, threshold=0.5, mix_fluids=True)
+        self.last_it_count = sum([rez['nfev'] for rez in results])
+        return {(rez['key'], rez['i']): rez for rez in results}
+
+    def grab_scenarios_results(self, results, key):
+        '''
+        The same as grab_results(), but from solve_em_all_parallel() results of one params set
+        :param results: dict (scenario key, dataset index) -> result, see solve_em_all_parallel()
+        '''
+        runner = self.gimme_scenario_runner()
+        pad_wells_dict = self.gimme_wells()
+        rez = {name: dict() for name in ('p_zab', 'p_intake', 'p_head', 'q_well')}
+        for name in rez:
+            for pad in pad_wells_dict:
+                for well in pad_wells_dict[pad]:
+                    rez[name][(pad, well)] = np.zeros(self.N)
+        for i in range(self.N):
+            scenario = results[(key, i)]
+            nodes_idx = {n: j for j, n in enumerate(runner.nodes[i])}
+            edges_idx = {e[:2]: j for j, e in enumerate(runner.edges[i])}
+            for pad in pad_wells_dict:
+                for well in pad_wells_dict[pad]:
+                    zab_name = f"PAD_{pad}_WELL_{well}_zaboi"
+                    pump_name = f"PAD_{pad}_WELL_{well}_pump_intake"
+                    head_name = f"PAD_{pad}_WELL_{well}_wellhead"
+                    rez['p_zab'][(pad, well)][i] = scenario['P'][nodes_idx[zab_name]]
+                    rez['p_intake'][(pad, well)][i] = scenario['P'][nodes_idx[pump_name]]
+                    rez['p_head'][(pad, well)][i] = scenario['P'][nodes_idx[head_name]]
+                    j = edges_idx[(zab_name, pump_name)]
+                    rez['q_well'][(pad, well)][i] = 86400 * scenario['x'][j] / scenario['rho'][j]
+        return rez
+
+    def score_scenarios_results(self, results, key):
+        '''
+        The same score as greed_optimization() target, for one params set of solve_em_all_parallel() results
+        '''
+        if not all([results[(key, i)]['success'] for i in range(self.N)]):
+            return 100500
+        rez = self.grab_scenarios_results(results, key)
+        score = np.zeros((len(self.pad_well_list), self.N))
+        for i, (pad, well) in enumerate(self.pad_well_list):
+            score[i] = self.calc_well_score2(pad, well, rez)
+        return np.average(score)
+
     def plot_fact_and_results(self, keys_to_plot=('head', 'intake', 'bottom', 'debit'), wells=(), pads=()):
         fig = plt.figure(constrained_layout=True, figsize=(8, 8))
         ax = fig.add_subplot(1, 1, 1)
@@ -593,65 +798,125 @@ class HE2_OilGatheringNetwork_Model():
 
         return score
 
-    def prefit_all(self):
-        rez = []
+    def gimme_well_nodes(self, pad, well):
+        nodes = [f'PAD_{pad}_WELL_{well}']
+        nodes += [f'PAD_{pad}_WELL_{well}_zaboi']
+        nodes += [f'PAD_{pad}_WELL_{well}_pump_intake']
+        nodes += [f'PAD_{pad}_WELL_{well}_pump_outlet']
+        nodes += [f'PAD_{pad}_WELL_{well}_wellhead']
+        return nodes
+
+    def prefit_well(self, pad, well):
+        '''
+        Fits well productivity and pump stages ratio on single well subgraph, by grid search and then scop.minimize
+        :return: dict with best_x, fun, results before and after fit, grid and path, warm start flows of the well,
+        and well edges params, which are left by the fit, see apply_prefit_params()
+        '''
+        G0 = self.gimme_graph(0)
+        nodes = self.gimme_well_nodes(pad, well)
+        well_G, _ = cut_single_well_subgraph(G0, pad, well, nodes)
+        solver = HE2_ChainSolver(well_G) if self.chain_solver else HE2_Solver(well_G)
+        pump_obj = well_G[nodes[2]][nodes[3]]['obj']
+        plast_obj = well_G[nodes[0]][nodes[1]]['obj']
+        bounds = ((0.1, 3 * plast_obj.Productivity), (0, 1.2))
+        path = []
+        target_cnt, not_solved = self.total_target_cnt, self.not_solved
+        def target_fit(x):
+            nonlocal pump_obj, plast_obj, solver, well_G, pad, well, nodes, bounds, path
+            path += [x]
+            productivity = x[0]
+            plast_obj.Productivity = productivity
+            pump_keff = x[1]
+            pump_obj.change_stages_ratio(pump_keff)
+            score = self.score_well(solver, well_G, pad, well, nodes)
+            # print(x, score)
+            return score
+
+        x0 = np.array([plast_obj.Productivity, 1])
+        target_fit(x0)
+        well_res_before = self.last_well_result.copy()
+
+        xs = np.linspace(start=bounds[0][0], stop=bounds[0][1], num=self.prefit_grid_size)
+        ys = np.linspace(start=bounds[1][0], stop=bounds[1][1], num=self.prefit_grid_size)
+        zs = np.zeros((len(xs), len(ys)))
+
+        for i, x in enumerate(xs):
+            for j, y in enumerate(ys):
+                zs[i, j] = target_fit(np.array([x, y]))
+
+        i, j = np.unravel_index(np.argmin(zs, axis=None), zs.shape)
+        x0 = np.array([xs[i], ys[j]])
+        op_result = scop.minimize(target_fit, x0)
+        best_x = op_result.x
+        target_fit(best_x)
+        well_res_after = self.last_well_result.copy()
+
+        zs[zs==100500] = -1
+        initial_x = {key: x for key, x in self.initial_x.items() if key[:2] == (pad, well)}
+        params = dict(Productivity=plast_obj.Productivity, stages_ratio=pump_obj.stages_ratio, frequency=pump_obj.frequency)
+        return dict(pad=pad, well=well, best_x=best_x, fun=op_result.fun, op_result=op_result, before=well_res_before,
+                    after=well_res_after, xs=xs, ys=ys, zs=zs, path=path, initial_x=initial_x, params=params,
+                    target_cnt=self.total_target_cnt - target_cnt, not_solved=self.not_solved - not_solved)
+
+    def apply_prefit_params(self, pad, well, params):
+        '''
+        Sets well edges params, fitted by prefit_well(), to the main graph. Pool workers fit wells on their own graph copies
+        :param params: dict with Productivity, stages_ratio and frequency
+        '''
+        G0 = self.gimme_graph(0)
+        nodes = self.gimme_well_nodes(pad, well)
+        well_G, _ = cut_single_well_subgraph(G0, pad, well, nodes)
+        plast_obj = well_G[nodes[0]][nodes[1]]['obj']
+        pump_obj = well_G[nodes[2]][nodes[3]]['obj']
+        plast_obj.Productivity = params['Productivity']
+        pump_obj.change_stages_ratio(params['stages_ratio'])
+        pump_obj.changeFrequency(params['frequency'])
+
+    def prefit_all(self, processes=None, checkpoint_filename=None, plot=False):
+        '''
+        Wells are independent, so they are fitted by HE2_PrefitRunner process pool, pad by pad
+        :param processes: pool size, cpu count by default. If 1, wells are fitted by this process
+        :param checkpoint_filename: csv file, wells results are appended to it as soon as pad is fitted. Wells from this file
+        are not fitted again, so interrupted prefit can be resumed
+        :param plot: plot single well charts, when well is fitted
+        :return: list of (well, pad, best_x, fun), in pad_well_list order
+        '''
         self.gimme_wells()
-        pad_well_list = self.pad_well_list
-        for it, (pad, well) in enumerate(pad_well_list):
-            if (well, pad) in self.bad_wells:
-                continue
-            # if not (pad, well) == ('39', 619):
-            #     continue
+        done = read_prefit_checkpoint(checkpoint_filename)
+        pad_well_list = [(pad, well) for pad, well in self.pad_well_list if not (well, pad) in self.bad_wells]
+        todo = [(pad, well) for pad, well in pad_well_list if not (str(pad), int(well)) in done]
+
+        if processes == 1:
+            chunks = ([self.prefit_well(pad, well) for well in wells] for pad, wells in gimme_pads_chunks(todo))
+            self.handle_prefit_chunks(chunks, done, checkpoint_filename, plot)
+        elif todo:
             G0 = self.gimme_graph(0)
-            nodes = [f'PAD_{pad}_WELL_{well}']
-            nodes += [f'PAD_{pad}_WELL_{well}_zaboi']
-            nodes += [f'PAD_{pad}_WELL_{well}_pump_intake']
-            nodes += [f'PAD_{pad}_WELL_{well}_pump_outlet']
-            nodes += [f'PAD_{pad}_WELL_{well}_wellhead']
-            well_G, _ = cut_single_well_subgraph(G0, pad, well, nodes)
-            solver = HE2_Solver(well_G)
-            pump_obj = well_G[nodes[2]][nodes[3]]['obj']
-            plast_obj = well_G[nodes[0]][nodes[1]]['obj']
-            bounds = ((0.1, 3 * plast_obj.Productivity), (0, 1.2))
-            path = []
-            def target_fit(x):
-                nonlocal pump_obj, plast_obj, solver, well_G, pad, well, nodes, bounds, path
-                path += [x]
-                productivity = x[0]
-                plast_obj.Productivity = productivity
-                pump_keff = x[1]
-                pump_obj.change_stages_ratio(pump_keff)
-                score = self.score_well(solver, well_G, pad, well, nodes)
-                # print(x, score)
-                return score
-
-            x0 = np.array([plast_obj.Productivity, 1])
-            target_fit(x0)
-            well_res_before = self.last_well_result.copy()
-
-            xs = np.linspace(start=bounds[0][0], stop=bounds[0][1], num=15)
-            ys = np.linspace(start=bounds[1][0], stop=bounds[1][1], num=15)
-            zs = np.zeros((len(xs), len(ys)))
-
-            for i, x in enumerate(xs):
-                for j, y in enumerate(ys):
-                    zs[i, j] = target_fit(np.array([x, y]))
-
-            i, j = np.unravel_index(np.argmin(zs, axis=None), zs.shape)
-            x0 = np.array([xs[i], ys[j]])
-            op_result = scop.minimize(target_fit, x0)
-            best_x = op_result.x
-            target_fit(best_x)
-            well_res_after = self.last_well_result.copy()
-
-            zs[zs==100500] = -1
-            self.plot_single_well_chart(pad, well, well_res_before, well_res_after, well_G, nodes, op_result, xs, ys, zs, path)
-            rez += [(well, pad, best_x, op_result.fun)]
-            print(well, pad, best_x, op_result.fun)
+            with HE2_PrefitRunner(G0, processes, self.fact, self.outlayers, self.N, self.prefit_grid_size, self.chain_solver) as runner:
+                self.handle_prefit_chunks(runner.prefit(todo, self.initial_x), done, checkpoint_filename, plot)
 
+        rez = []
+        for pad, well in pad_well_list:
+            best_x, fun = done[(str(pad), int(well))]
+            rez += [(well, pad, best_x, fun)]
         return rez
 
-
+    def handle_prefit_chunks(self, chunks, done, checkpoint_filename, plot):
+        for chunk in chunks:
+            for well_rez in chunk:
+                pad, well = well_rez['pad'], well_rez['well']
+                done[(str(pad), int(well))] = (well_rez['best_x'], well_rez['fun'])
+                self.apply_prefit_params(pad, well, well_rez['params'])
+                self.last_well_result = well_rez['after']
+                self.initial_x.update(well_rez['initial_x'])
+                self.total_target_cnt += well_rez['target_cnt']
+                self.not_solved += well_rez['not_solved']
+                print(well, pad, well_rez['best_x'], well_rez['fun'])
+                if plot:
+                    nodes = self.gimme_well_nodes(pad, well)
+                    well_G, _ = cut_single_well_subgraph(self.gimme_graph(0), pad, well, nodes)
+                    self.plot_single_well_chart(pad, well, well_rez['before'], well_rez['after'], well_G, nodes, well_rez['op_result'],
+                                                well_rez['xs'], well_rez['ys'], well_rez['zs'], well_rez['path'])
+            append_prefit_checkpoint(checkpoint_filename, [(r['well'], r['pad'], r['best_x'], r['fun']) for r in chunk])
 
     def score_well(self, solver, well_G, pad, well, nodes):
         weights = dict(p_head=1, p_intake=1, p_zab=1, q_well=1)
@@ -673,9 +938,7 @@ class HE2_OilGatheringNetwork_Model():
                 freq = freqs[i]
             pump_obj.changeFrequency(freq) # Set last non-outlayer frequency
 
-            well_G.nodes[nodes[-1]]['obj'].value = fact_phs[i]
-            if (pad, well, i) in self.initial_x:
-                solver.initial_edges_x = self.initial_x[(pad, well, i)]
+            solver.update_parameters(nodes_values={nodes[-1]: fact_phs[i]}, edges_x=self.initial_x.get((pad, well, i), None))
 
             solver.solve(mix_fluids=True, threshold=0.5, it_limit=30)
             self.total_target_cnt += solver.op_result.nfev
@@ -780,7 +1043,7 @@ class HE2_OilGatheringNetwork_Model():
         x, y1, y2, y3 = np.zeros(N), np.zeros(N), np.zeros(N), np.zeros(N)
         prev, it_num = 0, 0
         for i, record in enumerate(fit_log):
-            it_num, seconds, it_count, best_y = record
+            it_num, seconds, it_count, best_y = record[:4]
             x[i] = seconds
             y1[i] = seconds - prev
             prev = seconds
@@ -864,58 +1127,14 @@ class HE2_OilGatheringNetwork_Model():
 
     def save_original_diams(self):
         solver = self.gimme_solver(0)
-        G = solver.graph
-        for edge in G.edges:
-            u, v = edge
-            if 'PAD' in u or 'PAD' in v:
-                continue
-            obj = G[u][v]['obj']
-            if not isinstance(obj, HE2_OilPipe):
-                continue
-            ds = []
-            for seg in obj.segments:
-                ds += [seg.inner_diam_m]
-                self.original_diams[edge] = ds
-        pass
+        self.original_diams = gimme_original_diams(solver.graph)
 
 
     def apply_params(self, params):
         self.gimme_wells()
-
-        if (0, 0) in params:
-            network_params = params[(0, 0)]
-            diam_keff = network_params['diam_keff']
-            for (u, v) in self.original_diams:
-                for i in range(self.N):
-                    solver = self.gimme_solver(i)
-                    G = solver.graph
-                    obj = G[u][v]['obj']
-                    ds = self.original_diams[(u, v)]
-                    for seg, d in zip(obj.segments, ds):
-                        seg.inner_diam_m = d * diam_keff
-
-        pad_well_list = self.pad_well_list
-        for (pad, well) in pad_well_list:
-            if not (pad, well) in params:
-                continue
-
-            prms = params[(pad, well)]
-            nodes = [f'PAD_{pad}_WELL_{well}']
-            nodes += [f'PAD_{pad}_WELL_{well}_zaboi']
-            nodes += [f'PAD_{pad}_WELL_{well}_pump_intake']
-            nodes += [f'PAD_{pad}_WELL_{well}_pump_outlet']
-
-            ol_freq = self.outlayers['freq'][(pad, well)]
-
-            for i in range(self.N):
-                solver = self.gimme_solver(i)
-                G = solver.graph
-                pump_obj = G[nodes[2]][nodes[3]]['obj']
-                plast_obj = G[nodes[0]][nodes[1]]['obj']
-                pump_obj.change_stages_ratio(prms['K_pump'])
-                plast_obj.Productivity = prms['K_prod']
-                if ol_freq[i]:
-                    pump_obj.changeFrequency(prms['Freq_0'])
+        for i in range(self.N):
+            solver = self.gimme_solver(i)
+            apply_params_to_graph(solver.graph, params, self.original_diams, self.outlayers['freq'], i)
 
     def dump_x(self, x, fitlog):
         f = open('x.txt', 'w')
@@ -1029,15 +1248,148 @@ class HE2_OilGatheringNetwork_Model():
                 continue
             print()
 
+    def greed_optimization_parallel(self, x=None, processes=None, batch_size=None, step=0.01, rounds=10, seed=42, dump=True):
+        '''
+        Parallel version of greed_optimization() coordinate descent. Coordinates are taken by batches of independent
+        ones (wells of different pads, see gimme_independent_batches()), both steps directions of all the batch
+        coordinates are solved at once by scenario runner workers. Improvements are accepted in coordinates order,
+        and if several of them are accepted, they are checked together, cause wells are independent approximately only
+        :param x: start params, see apply_params(). Prefit params by default
+        :param processes: scenario runner pool size
+        :param batch_size: max coordinates count in batch, half of pool size by default, cause of two directions
+        :param rounds: how many times all the coordinates are passed, in shuffled order
+        :param dump: save x and fitlog by dump_x() on improvements, every 50 coordinates
+        :return: best params, best score, fitlog. Fitlog records are (coordinates done, seconds, solver iterations per
+        params set, best score, params sets evaluations per second)
+        '''
+        self.gimme_wells()
+        if x is None:
+            x = self.gimme_prefit_params()
+            for key in x:
+                if self.outlayers['freq'][key].any():
+                    x[key]['Freq_0'] = 50
+            x[(0, 0)] = dict(diam_keff=0.85)
+        x = {key: dict(prms) for key, prms in x.items()}
+        batch_size = batch_size or max(1, (processes or os.cpu_count()) // 2)
+
+        coords = [(pad, well, param) for (pad, well), prms in x.items() for param in prms]
+        rnd = random.Random(seed)
+        order = []
+        for i in range(rounds):
+            rnd.shuffle(coords)
+            order += coords
+        batches = gimme_independent_batches(order, batch_size)
+
+        def shifted(params, pad, well, param, keff):
+            rez = {key: dict(prms) for key, prms in params.items()}
+            rez[(pad, well)][param] = rez[(pad, well)][param] * keff
+            return rez
+
+        start_time = datetime.now()
+        evals_cnt, done, next_dump = 0, 0, 50
+        try:
+            results = self.solve_em_all_parallel({'x': x}, processes)
+            evals_cnt += 1
+            best_y = self.score_scenarios_results(results, 'x')
+            fitlog = [(0, 0, self.last_it_count / self.N, best_y, 0)]
+            for batch in batches:
+                params_sets = dict()
+                for j, (pad, well, param) in enumerate(batch):
+                    params_sets[(j, 1)] = shifted(x, pad, well, param, 1 + step)
+                    params_sets[(j, -1)] = shifted(x, pad, well, param, 1 - step)
+                results = self.solve_em_all_parallel(params_sets, processes)
+                it_count = self.last_it_count
+                evals_cnt += len(params_sets)
+
+                # The same preference as sequential version: step up first, then step down
+                accepted = []
+                for j, (pad, well, param) in enumerate(batch):
+                    for sign in (1, -1):
+                        y = self.score_scenarios_results(results, (j, sign))
+                        if y < best_y:
+                            accepted += [(y, (pad, well, param), params_sets[(j, sign)][(pad, well)][param])]
+                            break
+
+                if len(accepted) == 1:
+                    best_y, (pad, well, param), value = accepted[0]
+                    x[(pad, well)][param] = value
+                elif accepted:
+                    x_all = {key: dict(prms) for key, prms in x.items()}
+                    for y, (pad, well, param), value in accepted:
+                        x_all[(pad, well)][param] = value
+                    results = self.solve_em_all_parallel({'x': x_all}, processes)
+                    it_count += self.last_it_count
+                    evals_cnt += 1
+                    y_all = self.score_scenarios_results(results, 'x')
+                    if y_all < best_y:
+                        best_y, x = y_all, x_all
+                    else:
+                        best_y, (pad, well, param), value = min(accepted, key=lambda item: item[0])
+                        x[(pad, well)][param] = value
+
+                done += len(batch)
+                seconds = (datetime.now() - start_time).total_seconds()
+                fitlog += [(done, seconds, it_count / (self.N * len(params_sets)), best_y, evals_cnt / seconds)]
+                print(f'{done:#4}/{len(order)}  {len(batch):#2} coords  {len(accepted):#2} accepted  {best_y:3.7}  {evals_cnt / seconds:.2f} evals/sec')
+                if dump and accepted and done >= next_dump:
+                    self.dump_x(x, fitlog)
+                    next_dump = done + 50
+        finally:
+            if self.scenario_runner is not None:
+                self.scenario_runner.close()
+                self.scenario_runner = None
+        return x, best_y, fitlog
+
     def save_prefit_results_to_csv(self, rez, filename):
-        df = pd.DataFrame(columns=['wellNum','padNum','K_prod','K_pump'])
-        for item in rez:
-            x = item[2]
-            row = dict(wellNum=item[0],padNum=item[1],K_prod=x[0],K_pump=x[1])
-            df = df.append(row, ignore_index=True)
+        rows = [dict(wellNum=item[0],padNum=item[1],K_prod=item[2][0],K_pump=item[2][1]) for item in rez]
+        df = pd.DataFrame(rows, columns=['wellNum','padNum','K_prod','K_pump'])
         df.to_csv(filename, index=False)
 
 
+def gimme_independent_batches(order, batch_size):
+    '''
+    Splits coordinates order to batches of consecutive coordinates of different pads. Network pipes diameters
+    coefficient (0, 0, 'diam_keff') changes all the wells, so it is always a batch alone
+    :param order: list of (pad, well, param)
+    :return: list of batches, coordinates order is kept
+    '''
+    batches, batch, pads = [], [], set()
+    for pad, well, param in order:
+        is_network = (pad, well) == (0, 0)
+        if batch and (is_network or (0, 0) in pads or pad in pads or len(batch) >= batch_size):
+            batches += [batch]
+            batch, pads = [], set()
+        batch += [(pad, well, param)]
+        pads.add((0, 0) if is_network else pad)
+    if batch:
+        batches += [batch]
+    return batches
+
+
+def read_prefit_checkpoint(filename):
+    '''
+    :return: dict (pad as str, well as int) -> (best_x, fun)
+    '''
+    if not filename or not os.path.exists(filename):
+        return dict()
+    df = pd.read_csv(filename, dtype=dict(padNum=str))
+    rez = dict()
+    for well, pad, prod, stages, fun in df[['wellNum', 'padNum', 'K_prod', 'K_pump', 'fun']].itertuples(index=False):
+        rez[(pad, int(well))] = (np.array([prod, stages]), fun)
+    return rez
+
+
+def append_prefit_checkpoint(filename, rez):
+    '''
+    :param rez: list of (well, pad, best_x, fun)
+    '''
+    if not filename or not rez:
+        return
+    rows = [dict(wellNum=well, padNum=pad, K_prod=x[0], K_pump=x[1], fun=fun) for well, pad, x, fun in rez]
+    df = pd.DataFrame(rows, columns=['wellNum', 'padNum', 'K_prod', 'K_pump', 'fun'])
+    df.to_csv(filename, mode='a', header=not os.path.exists(filename), index=False)
+
+
 # bad_wells = [(738, 33), (567, 39), (4532, 49), (2630, 49), (1579, 57), (3118, 57)]
 
 
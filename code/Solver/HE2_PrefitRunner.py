@@ -0,0 +1,127 @@
+import multiprocessing
+import networkx as nx
+from Solver.HE2_Solver import HE2_Solver
+from Solver.HE2_ChainSolver import HE2_ChainSolver
+from Tools.HE2_tools import cut_single_well_subgraph
+from Tools.HE2_Logger import getLogger
+logger = getLogger(__name__)
+
+'''
+Process pool runner for independent single well tasks: prefit of well parameters (HE2_OilGatheringNetwork_Model.prefit_well)
+and single well solves. Graph is shipped to workers once, by pool initializer. Each worker keeps its own model instance,
+so wells subgraphs are cut from worker graph copy, and wells parameters changes are not visible for other workers.
+Pool tasks are pads, wells of a pad are evaluated by one worker one by one
+'''
+
+worker_state = dict()
+
+
+def init_worker(G, fact, outlayers, N, prefit_grid_size, chain_solver):
+    from Solver.HE2_Fit import HE2_OilGatheringNetwork_Model
+    model = HE2_OilGatheringNetwork_Model()
+    model.graphs[0] = G
+    model.fact, model.outlayers, model.N = fact, outlayers, N
+    model.prefit_grid_size = prefit_grid_size
+    model.chain_solver = chain_solver
+    worker_state.clear()
+    worker_state.update(G=G, model=model, chain_solver=chain_solver)
+
+
+def prefit_pad(task):
+    '''
+    Worker function
+    :param task: (pad, wells list, warm start dict (pad, well, dataset index) -> edges flows)
+    :return: list of prefit_well() results, in wells order
+    '''
+    pad, wells, initial_x = task
+    model = worker_state['model']
+    model.initial_x.update(initial_x)
+    return [model.prefit_well(pad, well) for well in wells]
+
+
+def solve_pad_wells(task):
+    '''
+    Worker function
+    :param task: (pad, wells list, solve() kwargs)
+    :return: list of dicts with pad, well, solve status, and results of well subgraph nodes and edges. Pad node is not
+    in nodes results, cause it is a boundary node of subgraph only
+    '''
+    pad, wells, solve_kwargs = task
+    rez = []
+    for well in wells:
+        subG, nodes = cut_single_well_subgraph(worker_state['G'], pad, well)
+        solver = HE2_ChainSolver(subG) if worker_state['chain_solver'] else HE2_Solver(subG)
+        solver.solve(**solve_kwargs)
+        nodes_result = {n: getattr(subG.nodes[n]['obj'], 'result', None) for n in nodes[:-1]}
+        edges_result = {(u, v): getattr(subG[u][v]['obj'], 'result', None) for u, v in subG.edges}
+        rez += [dict(pad=pad, well=well, success=bool(solver.op_result.success), fun=solver.op_result.fun,
+                     nodes_result=nodes_result, edges_result=edges_result)]
+    return rez
+
+
+def attach_wells_results(G, results):
+    '''
+    Sets solve_wells() results to graph nodes and edges objects, the same way as well subgraph solve does in this process
+    '''
+    for rez in results:
+        for n, result in rez['nodes_result'].items():
+            if result is not None:
+                G.nodes[n]['obj'].result = result
+        for (u, v), result in rez['edges_result'].items():
+            if result is None:
+                continue
+            obj = G[u][v][0]['obj'] if isinstance(G, nx.MultiDiGraph) else G[u][v]['obj']
+            obj.result = result
+
+
+def gimme_pads_chunks(pad_well_list):
+    '''
+    :return: list of (pad, wells list), pads are in order of first appearance
+    '''
+    chunks = dict()
+    for pad, well in pad_well_list:
+        chunks[pad] = chunks.get(pad, []) + [well]
+    return list(chunks.items())
+
+
+class HE2_PrefitRunner():
+    def __init__(self, G, processes=None, fact=None, outlayers=None, N=1, prefit_grid_size=15, chain_solver=True):
+        '''
+        :param G: network graph, wells subgraphs are cut from it. It is pickled to every worker once
+        :param processes: pool size, cpu count by default
+        :param fact, outlayers, N, prefit_grid_size: HE2_OilGatheringNetwork_Model fields, which are needed for prefit
+        :param chain_solver: solve wells subgraphs by HE2_ChainSolver, instead of HE2_Solver
+        '''
+        self.pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(G, fact, outlayers, N, prefit_grid_size, chain_solver))
+
+    def prefit(self, pad_well_list, initial_x=None):
+        '''
+        :param pad_well_list: list of (pad, well)
+        :param initial_x: warm start dict (pad, well, dataset index) -> edges flows, see HE2_OilGatheringNetwork_Model.initial_x
+        :return: iterator over results lists, one list per pad, as soon as pads are fitted. Pads order is not determined
+        '''
+        initial_x = initial_x or dict()
+        tasks = []
+        for pad, wells in gimme_pads_chunks(pad_well_list):
+            pad_x = {key: x for key, x in initial_x.items() if key[0] == pad and key[1] in wells}
+            tasks += [(pad, wells, pad_x)]
+        return self.pool.imap_unordered(prefit_pad, tasks)
+
+    def solve_wells(self, pad_well_list, **solve_kwargs):
+        '''
+        :param solve_kwargs: HE2_Solver.solve() kwargs
+        :return: results list, in pad_well_list order, see solve_pad_wells()
+        '''
+        tasks = [(pad, wells, solve_kwargs) for pad, wells in gimme_pads_chunks(pad_well_list)]
+        results = {(rez['pad'], rez['well']): rez for chunk in self.pool.map(solve_pad_wells, tasks, chunksize=1) for rez in chunk}
+        return [results[(pad, well)] for pad, well in pad_well_list]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
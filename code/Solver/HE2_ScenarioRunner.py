@@ -0,0 +1,200 @@
+import multiprocessing
+import numpy as np
+import networkx as nx
+from Solver.HE2_Solver import HE2_Solver
+from GraphEdges.HE2_Pipe import HE2_OilPipe
+from GraphEdges.HE2_Plast import HE2_Plast
+from GraphEdges.HE2_WellPump import HE2_WellPump
+from Tools.HE2_Logger import getLogger
+logger = getLogger(__name__)
+
+'''
+Process pool runner for independent (dataset index, parameter set) solves of HE2_OilGatheringNetwork_Model.
+Graphs are shipped to workers once, by pool initializer. Each worker keeps its own solvers, one per dataset index,
+so solver structures are prepared once per worker. Workers return compact results only - nodes pressures and edges flows
+arrays, and chordes warm start vector
+'''
+
+worker_state = dict()
+
+
+def gimme_original_diams(G):
+    '''
+    :return: dict edge -> segments diameters, for network pipes (not wells ones)
+    '''
+    rez = dict()
+    for u, v in G.edges:
+        if 'PAD' in u or 'PAD' in v:
+            continue
+        obj = G[u][v]['obj']
+        if not isinstance(obj, HE2_OilPipe):
+            continue
+        rez[(u, v)] = [seg.inner_diam_m for seg in obj.segments]
+    return rez
+
+
+def gimme_base_params(G):
+    '''
+    :return: list of (edge obj, its params, which are changed by apply_params_to_graph())
+    '''
+    rez = []
+    for u, v, obj in G.edges(data='obj'):
+        if isinstance(obj, HE2_OilPipe):
+            rez += [(obj, obj.geometry.copy())]
+        elif isinstance(obj, HE2_WellPump):
+            rez += [(obj, (obj.frequency, obj.stages_ratio))]
+        elif isinstance(obj, HE2_Plast):
+            rez += [(obj, obj.Productivity)]
+    return rez
+
+
+def restore_base_params(base_params):
+    '''
+    Restores edges params, saved by gimme_base_params()
+    '''
+    for obj, prms in base_params:
+        if isinstance(obj, HE2_OilPipe):
+            # Segments geometry is a view into pipe geometry, so it is restored in place
+            obj.geometry[:] = prms
+        elif isinstance(obj, HE2_WellPump):
+            obj.changeFrequency(prms[0])
+            obj.change_stages_ratio(prms[1])
+        else:
+            obj.Productivity = prms
+
+
+def apply_params_to_graph(G, params, original_diams, freq_outlayers, i):
+    '''
+    Applies fit params to i-th dataset solver graph
+    :param params: dict (pad, well) -> dict(K_pump, K_prod, [Freq_0]), and (0, 0) -> dict(diam_keff) for network pipes
+    :param original_diams: see gimme_original_diams()
+    :param freq_outlayers: dict (pad, well) -> mask of datasets with invalid frequency, Freq_0 is used for them
+    '''
+    if (0, 0) in params:
+        diam_keff = params[(0, 0)]['diam_keff']
+        for (u, v), ds in original_diams.items():
+            obj = G[u][v]['obj']
+            for seg, d in zip(obj.segments, ds):
+                seg.inner_diam_m = d * diam_keff
+
+    for key, prms in params.items():
+        if key == (0, 0):
+            continue
+        pad, well = key
+        nodes = [f'PAD_{pad}_WELL_{well}']
+        nodes += [f'PAD_{pad}_WELL_{well}_zaboi']
+        nodes += [f'PAD_{pad}_WELL_{well}_pump_intake']
+        nodes += [f'PAD_{pad}_WELL_{well}_pump_outlet']
+        if not nodes[0] in G.nodes:
+            continue
+        pump_obj = G[nodes[2]][nodes[3]]['obj']
+        plast_obj = G[nodes[0]][nodes[1]]['obj']
+        pump_obj.change_stages_ratio(prms['K_pump'])
+        plast_obj.Productivity = prms['K_prod']
+        if freq_outlayers[(pad, well)][i]:
+            pump_obj.changeFrequency(prms['Freq_0'])
+
+
+def init_worker(graphs, freq_outlayers, solver_kwargs):
+    worker_state.clear()
+    worker_state.update(graphs=graphs, freq_outlayers=freq_outlayers, solver_kwargs=solver_kwargs)
+    worker_state.update(solvers=dict(), original_diams=dict(), cold_x=dict(), base_params=dict(), base_fluids=dict())
+
+
+def gimme_worker_solver(i):
+    solvers = worker_state['solvers']
+    if i in solvers:
+        return solvers[i]
+    solver = HE2_Solver(worker_state['graphs'][i], **worker_state['solver_kwargs'])
+    solver.prepare_for_solve()
+    solvers[i] = solver
+    worker_state['original_diams'][i] = gimme_original_diams(solver.graph)
+    worker_state['cold_x'][i] = solver.initial_edges_x.copy()
+    worker_state['base_params'][i] = gimme_base_params(solver.graph)
+    worker_state['base_fluids'][i] = None if solver.fluid_table is None else solver.fluid_table.rows.copy()
+    return solver
+
+
+def restore_worker_solver(i, solver):
+    '''
+    Every scenario starts from the same base state of worker graph, so results do not depend on previous scenarios of the worker
+    '''
+    restore_base_params(worker_state['base_params'][i])
+    rows = worker_state['base_fluids'][i]
+    if rows is not None:
+        solver.fluid_table.set_rows(np.arange(len(rows)), rows)
+        solver.mixer_state, solver.last_mixed = dict(), None
+
+
+def solve_scenario(task):
+    '''
+    Worker function
+    :param task: (dataset index, scenario key, params or None, warm start vector or None, solve() kwargs)
+    :return: dict with scenario key, solve status, P (schema nodes order), x and liquid density (schema edges order)
+    and warm start vector (solver edge_list order)
+    '''
+    i, key, params, initial_x, solve_kwargs = task
+    solver = gimme_worker_solver(i)
+    restore_worker_solver(i, solver)
+    if params:
+        apply_params_to_graph(solver.graph, params, worker_state['original_diams'][i], worker_state['freq_outlayers'], i)
+    # Without warm start solver would start from the previous scenario solution of this worker, so results would depend on tasks order
+    edges_x = worker_state['cold_x'][i]
+    if initial_x is not None and len(initial_x) == len(solver.edge_list):
+        edges_x = dict(zip(solver.edge_list, initial_x))
+    solver.update_parameters(edges_x=edges_x)
+    solver.solve(**solve_kwargs)
+
+    rez = dict(i=i, key=key, success=bool(solver.op_result.success), nfev=solver.op_result.nfev, fun=solver.op_result.fun)
+    G = solver.schema
+    P, x, warm_x = np.full(len(G.nodes), np.nan), np.full(len(G.edges), np.nan), None
+    rho = np.full(len(G.edges), np.nan)
+    if solver.pt_on_tree is not None:
+        P = np.array([solver.pt_on_tree[n][0] for n in G.nodes])
+        if isinstance(G, nx.MultiDiGraph):
+            x = np.array([solver.edges_x[solver.result_edges_mapping[e]] for e in G.edges])
+        else:
+            x = np.array([solver.edges_x[e] for e in G.edges])
+        results = [getattr(obj, 'result', None) or dict() for u, v, obj in G.edges(data='obj')]
+        rho = np.array([result.get('liquid_density', np.nan) for result in results])
+    if rez['success']:
+        warm_x = np.array([solver.edges_x[e] for e in solver.edge_list])
+    rez.update(P=P, x=x, rho=rho, initial_x=warm_x)
+    return rez
+
+
+class HE2_ScenarioRunner():
+    def __init__(self, graphs, processes=None, freq_outlayers=None, **solver_kwargs):
+        '''
+        :param graphs: dict dataset index -> schema. Graphs are pickled to every worker once
+        :param processes: pool size, cpu count by default
+        :param freq_outlayers: see apply_params_to_graph()
+        :param solver_kwargs: HE2_Solver constructor kwargs
+        '''
+        self.nodes = {i: list(G.nodes) for i, G in graphs.items()}
+        self.edges = {i: list(G.edges) for i, G in graphs.items()}
+        self.initial_x = dict()
+        self.pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(graphs, freq_outlayers or dict(), solver_kwargs))
+
+    def run(self, scenarios, **solve_kwargs):
+        '''
+        :param scenarios: list of (dataset index, scenario key, params). Params dict is the same as for apply_params_to_graph(), or None
+        :param solve_kwargs: HE2_Solver.solve() kwargs
+        :return: results list, in scenarios order. Converged scenarios keep their flows to warm start the next run
+        '''
+        tasks = [(i, key, params, self.initial_x.get((key, i), None), solve_kwargs) for i, key, params in scenarios]
+        results = self.pool.map(solve_scenario, tasks, chunksize=1)
+        for rez in results:
+            if rez['initial_x'] is not None:
+                self.initial_x[(rez['key'], rez['i'])] = rez['initial_x']
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,9 +1,16 @@
+import hashlib
 import numpy as np
 import networkx as nx
 import scipy.optimize as scop
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+import scipy.linalg as sla
+from numba import njit
 
 from GraphEdges.HE2_SpecialEdges import HE2_MockEdge
 from GraphEdges.HE2_WellPump import HE2_WellPump
+from Solver.HE2_CompiledNetwork import HE2_CompiledNetwork
+from Solver.HE2_EdgeSurrogates import HE2_EdgeSurrogate, edge_can_have_surrogate
 from GraphNodes import HE2_Vertices as vrtxs
 from GraphNodes.HE2_Vertices import is_source
 from Tools import HE2_ABC as abc
@@ -20,10 +27,157 @@ from Tools.HE2_SolverInternalViewer import plot_all, plot_all_wo_root
 
 logger = getLogger(__name__)
 
+
+@njit(cache=True)
+def accumulate_tree_flows(Q, x_chordes, chord_u, chord_v, child, parent, edge, sign):
+    '''
+    Linear time replacement for A_tree_inv @ (Q - A_chordes @ x_chordes)
+    Nodes imbalances are accumulated from leafs to root, and each subtree imbalance leaves subtree by its root edge
+    :param child, parent, edge, sign: tree edges in post-order (reverted BFS order), see build_tree_flow_index()
+    '''
+    S = np.zeros(len(Q) + 1) # The last one is for Root
+    S[:-1] = Q
+    for i in range(len(x_chordes)):
+        S[chord_u[i]] -= x_chordes[i]
+        S[chord_v[i]] += x_chordes[i]
+    x_tree = np.zeros(len(edge))
+    for k in range(len(child)):
+        c = child[k]
+        x_tree[edge[k]] = sign[k] * S[c]
+        S[parent[k]] += S[c]
+    return x_tree
+
+
+@njit(cache=True)
+def accumulate_tree_flows_batch(Q, x_chordes, active, chord_u, chord_v, child, parent, edge, sign):
+    '''
+    accumulate_tree_flows() for scenarios batch, Q and x_chordes have leading scenario axis. Rows of inactive scenarios are zeros
+    '''
+    x_tree = np.zeros((len(Q), len(edge)))
+    for k in range(len(Q)):
+        if active[k]:
+            x_tree[k] = accumulate_tree_flows(Q[k], x_chordes[k], chord_u, chord_v, child, parent, edge, sign)
+    return x_tree
+
+
+armijo_c = 1e-4
+min_line_search_step = 1 / 64
+# Loop matrix damping after line search fails, relative to max edge derivative
+min_damping, max_damping = 1e-3, 10
+
+
+class LoopMatrixInverse():
+    '''
+    Inverse of loop matrix B @ F @ Bt, as factorization and Broyden rank one updates in product form:
+    H_k+1 = (I + (s_k - H_k y_k) s_k^T / (s_k^T H_k y_k)) H_k
+    '''
+    def __init__(self, solve_func):
+        self.solve_func = solve_func
+        self.items = []
+
+    @property
+    def updates(self):
+        return len(self.items)
+
+    def solve(self, b):
+        w = self.solve_func(b)
+        for u, s, d in self.items:
+            w = w + u * (s @ w) / d
+        return w
+
+    def update(self, s, y):
+        '''
+        :param s: chordes flows step
+        :param y: chordes pressure residuals change
+        :return: False, if update is degenerate
+        '''
+        Hy = self.solve(y)
+        d = s @ Hy
+        if not np.isfinite(d) or abs(d) < 1e-12 * np.linalg.norm(s) * np.linalg.norm(Hy):
+            return False
+        self.items += [(s - Hy, s, d)]
+        return True
+
+
+def gimme_convergence_stats(ys):
+    '''
+    :return: residual norms by iterations, their ratios and order of convergence estimation (1 - linear, 2 - quadratic)
+    '''
+    ys = np.array(ys, dtype=float)
+    rates = ys[1:] / ys[:-1] if len(ys) > 1 else np.zeros(0)
+    order = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        orders = np.log(rates[1:]) / np.log(rates[:-1])
+    orders = orders[np.isfinite(orders) & (rates[1:] < 1) & (rates[:-1] < 1)]
+    if len(orders):
+        order = orders[-1]
+    return dict(y_history=ys, rates=rates, order=order)
+
+
+# Structural artifacts of solved graphs (spanning tree, incidence and circuit matrices factorizations, fluid mixer),
+# keyed by topology fingerprint. They do not depend on edges objects and boundary values, so solvers of the same
+# topology share them. Artifacts are read only, nobody should change them inplace
+structure_cache = dict()
+structure_cache_size = 32
+
+# How HE2_Solver.split_graph() chooses spanning tree, so the chordes and fundamental loops:
+# default - minimum spanning tree of unweighted graph, chordes are arbitrary
+# bfs - breadth first search tree from Root, loop of chord (u, v) is not longer than depth(u) + depth(v) + 1
+# resistance - minimum spanning tree weighted by edges |dP/dx| on initial flows, so high resistance edges become chordes,
+# and loop matrix B*D*Bt is closer to diagonal dominance
+spanning_tree_strategies = ['default', 'bfs', 'resistance']
+
+structure_fields = ['span_tree', 'chordes', 'edge_list', 'node_list', 'tree_travers', 'tree_flow_index', 'A_tree', 'A_chordes',
+                    'A_inv', 'A_tree_lu', 'B', 'Bt', 'core_travers', 'branches_travers', 'core_edges_mask', 'core_nodes_idx']
+
+
+def topology_fingerprint(G, use_sparse=False, spanning_tree='default'):
+    '''
+    :return: hash of graph structure - nodes and edges in graph order, nodes kinds. Edges objects and boundary values are ignored
+    '''
+    h = hashlib.sha1(repr((use_sparse, spanning_tree)).encode())
+    for n in G.nodes:
+        obj = G.nodes[n]['obj']
+        h.update(repr((n, type(obj).__name__, getattr(obj, 'kind', None), getattr(obj, 'is_source', None))).encode())
+    for u, v in G.edges:
+        h.update(repr((u, v)).encode())
+    return h.hexdigest()
+
+
 class HE2_Solver():
-    def __init__(self, schema):
+    def __init__(self, schema, use_sparse=False, compiled=False, use_structure_cache=True, surrogates=False, surrogates_exact_y=1.,
+                 spanning_tree='default', decompose=False):
+        '''
+        :param use_sparse: keep incidence and circuit matrices in scipy.sparse form, and use sparse factorizations
+        instead of explicit inverses. Dense path is kept as default, cause it is faster on small networks
+        :param compiled: evaluate pressures on the tree and chordes residuals by numba kernel, see HE2_CompiledNetwork
+        :param use_structure_cache: take structural artifacts from structure_cache, if the same topology was solved before
+        :param surrogates: evaluate oil pipes and pumps by spline surrogates on early iterations, see HE2_EdgeSurrogates.
+        Surrogates are kept between solves, and are dropped if edge fluid or parameters are changed
+        :param surrogates_exact_y: edges are evaluated exactly, when residual is less than this
+        :param spanning_tree: spanning tree strategy, see spanning_tree_strategies. Tree is chosen once per topology, so with
+        structure cache 'resistance' tree is built by the edges of the first solved graph
+        :param decompose: evaluate only the looped core of the graph on iterations, and pure tree branches once after solve,
+        see split_tree_travers()
+        '''
         logger.debug('New solver instance created')
+        if not spanning_tree in spanning_tree_strategies:
+            logger.error(f'Unknown spanning tree strategy {spanning_tree}, expected one of {spanning_tree_strategies}')
+            raise ValueError(spanning_tree)
         self.schema = schema
+        self.use_sparse = use_sparse
+        self.compiled = compiled
+        self.compiled_network = None
+        self.batch_network = None
+        self.batch_boundaries = None
+        self.batch_X = None
+        self.batch_residuals = None
+        self.use_structure_cache = use_structure_cache
+        self.spanning_tree = spanning_tree
+        self.decompose = decompose
+        self.fingerprint = None
+        self.initial_x_operator = None
+        self.fluid_mixer = None
         self.graph = None
         self.op_result = None
         self.span_tree = None
@@ -33,10 +187,16 @@ class HE2_Solver():
         self.A_tree = None
         self.A_chordes = None
         self.A_inv = None
+        self.A_tree_lu = None
         self.Q_static = None
         self.edges_x = None
         self.pt_on_tree = None
         self.tree_travers = None
+        self.core_travers = None
+        self.branches_travers = None
+        self.core_edges_mask = None
+        self.core_nodes_idx = None
+        self.tree_flow_index = None
         self.mock_nodes = []
         self.mock_edges = []
         self.result_edges_mapping = dict()
@@ -52,6 +212,13 @@ class HE2_Solver():
         self.derivatives = None
         self.forward_edge_functions = dict()
         self.backward_edge_functions = dict()
+        self.forward_derivative_functions = dict()
+        self.exact_edge_functions = (self.forward_edge_functions, self.backward_edge_functions, self.forward_derivative_functions)
+        self.surrogate_edge_functions = None
+        self.use_surrogates = surrogates
+        self.surrogates_exact_y = surrogates_exact_y
+        self.surrogates_on = False
+        self.edge_surrogates = dict()
 
         self.fluids_move_rate = 0.2
         self.sources_fluids = None
@@ -60,11 +227,21 @@ class HE2_Solver():
         self.actual_dx = None
 
         self.it_num = 0
+        self.y_history = []
+        self.solve_stats = dict(ntarget=0, njev=0, backtracks=0, broyden=0, damping=0)
         self.random_steps = []
         self.last_forward_call = dict()
-        self.last_cocktail = dict()
+        self.last_forward_derivative = dict()
         self.last_src = []
-        self.last_fluidA = dict()
+        self.last_src_vectors = None
+        self.fluids_mixing_rtol = 1e-6 # see FluidMixer.evaluate_network_cocktails_incremental()
+        self.mixer_state = dict()
+        self.last_mixed = None
+        self.last_rows_A = None
+        self.fluid_table = None
+        self.fluid_table_keys_idx = None
+        self.fluid_table_mask = None
+        self.fluid_table_views = []
 
     def set_known_Q(self, Q_dict):
         self.known_Q = Q_dict
@@ -149,58 +326,116 @@ class HE2_Solver():
         self.known_Q.update(known_snk)
 
 
-    def make_initial_approximation(self):
+    def evaluate_initial_edges_x(self):
         G = self.graph
-        self.fill_known_Q()
         Q_dict = self.known_Q
         nodelist = [n for n in G.nodes()]
         assert not (Root in nodelist), 'better call this method before Root add'
         edgelist = [(u, v) for (u, v) in G.edges()]
         A_full = nx.incidence_matrix(G, nodelist=nodelist, edgelist=edgelist, oriented=True)
-        A_full = -1 * A_full.toarray()
         q_vec = np.zeros((len(nodelist), 1))
         for i, node in enumerate(nodelist):
             if node in Q_dict:
                 q_vec[i] = Q_dict[node]
 
         logger.debug(f'q_vec = {q_vec.flatten()}')
-        A_inv = np.linalg.pinv(A_full)
-        xs = np.matmul(A_inv, q_vec)
-        self.initial_edges_x = dict(zip(edgelist, xs.flatten()))
-
-        cocktails, srcs = mixer.evalute_network_fluids_with_root(G, self.initial_edges_x, have_to_reduce=True)
-        # if self.test_mixer:
-        #     cocktails2, srcs2 = mixer2.evalute_network_fluids_with_root(G, self.initial_edges_x)
-        #     self.compare_cocktails(srcs, cocktails, srcs2, cocktails2)
+        if self.initial_x_operator is None:
+            self.initial_x_operator = self.build_initial_x_operator(A_full)
+        if self.use_sparse:
+            A, L_lu = self.initial_x_operator
+            xs = self.evaluate_min_norm_flows_sparse(A, q_vec, L_lu)
+        else:
+            xs = np.matmul(self.initial_x_operator, q_vec)
+        return dict(zip(edgelist, xs.flatten()))
+
+    def build_initial_x_operator(self, A_full):
+        '''
+        :return: pseudo inverse of incidence matrix for dense mode, and (incidence matrix, grounded laplacian factorization)
+        for sparse one. It depends on topology only, so it is kept in structure cache
+        '''
+        if self.use_sparse:
+            A = -1 * A_full.tocsc()
+            L = (A @ A.T).tocsc()
+            L_lu = spla.splu(L[:-1, :-1]) if L.shape[0] > 1 else None
+            return A, L_lu
+        return np.linalg.pinv(-1 * A_full.toarray())
+
+    def evaluate_min_norm_flows_sparse(self, A, q_vec, L_lu=None):
+        '''
+        The same as pinv(A) @ q, but without dense pseudo inverse.
+        Min norm solution is x = At @ y, where y is a solution of laplacian system A @ At @ y = q.
+        Laplacian of connected graph is singular, so we project q to its range and ground the last node
+        :param L_lu: grounded laplacian factorization, see build_initial_x_operator()
+        '''
+        q = q_vec.flatten()
+        q = q - q.mean()
+        y = np.zeros(len(q))
+        if len(q) > 1:
+            if L_lu is None:
+                L_lu = spla.splu((A @ A.T).tocsc()[:-1, :-1])
+            y[:-1] = L_lu.solve(q[:-1])
+        xs = A.T @ y
+        return xs.reshape((len(xs), 1))
+
+    def make_initial_approximation(self):
+        G = self.graph
+        self.fill_known_Q()
+        edgelist = [(u, v) for (u, v) in G.edges()]
+        self.initial_edges_x = self.evaluate_initial_edges_x()
+
+        if self.fluid_mixer is None:
+            self.fluid_mixer = mixer.FluidMixer(G)
+        nodelist = list(G.nodes)
+        keys_idx = self.fluid_mixer.reduced_edges_index(edgelist + nodelist)
+        cocktails, has_cocktail, srcs = self.fluid_mixer.evaluate_network_cocktails(self.initial_edges_x, keys_idx)
         self.last_src = srcs
-        # src_fluids = [G.nodes[n]['obj'].fluid for n in srcs]
         src_fluids = []
         for n in srcs:
             if not is_source(G, n):
                 logger.error(f'{n} is not a source node!')
                 raise ValueError
             src_fluids += [G.nodes[n]['obj'].fluid]
+        self.sources_fluids = dict(zip(srcs, src_fluids))
+        if not srcs:
+            return
 
         # fieldlist = ['sat_P_bar', 'plastT_C', 'gasFactor', 'oildensity_kg_m3', 'waterdensity_kg_m3', 'gasdensity_kg_m3',
         #              'oilviscosity_Pa_s', 'volumewater_percent', 'volumeoilcoeff']
-
-        zf = src_fluids[0].oil_params
-        constants = dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)
-        fl_vec = fl.make_fluid_vectors(src_fluids)
-        for key, cktl in cocktails.items():
-            initial_fluid = fl.dot_product(cktl, src_fluids, fl_vec, **constants)
-            self.last_cocktail[key] = cktl
-            self.last_fluidA[key] = initial_fluid
-            if key in edgelist:
-                u, v = key
-                obj = G[u][v]['obj']
-            else:
-                obj = G.nodes[key]['obj']
-            obj.fluid = initial_fluid
-        self.sources_fluids = dict(zip(srcs, src_fluids))
+        self.last_src_vectors = None
+        self.mixer_state, self.last_mixed = dict(), None
+        src_fluids, fl_vec, constants = self.gimme_sources_vectors(srcs)
+        rows = fl.dot_product_batch(cocktails, src_fluids, fl_vec, **constants)
+
+        # Edges fluids are rows of solver fluid table, so they are mixed in place on iterations
+        E = len(edgelist)
+        table = fl.HE2_FluidTable(E)
+        objs = [G[u][v]['obj'] for u, v in edgelist]
+        has_fluid = np.array([obj.fluid is not None for obj in objs], dtype=bool) | has_cocktail[:E]
+        old_idx = np.flatnonzero(has_fluid & ~has_cocktail[:E])
+        if len(old_idx):
+            table.set_rows(old_idx, np.array([objs[i].fluid.oil_params for i in old_idx], dtype=float))
+        mixed_idx = np.flatnonzero(has_cocktail)
+        table.set_rows(mixed_idx[mixed_idx < E], rows[mixed_idx < E])
+        self.fluid_table_views = [(objs[i], fl.HE2_TableFluid(table, i)) for i in np.flatnonzero(has_fluid)]
+        self.bind_fluid_table()
+        self.fluid_table = table
+        self.fluid_table_keys_idx = keys_idx[:E]
+        self.fluid_table_mask = has_fluid
+
+        for i, row in zip(mixed_idx[mixed_idx >= E], rows[mixed_idx >= E]):
+            G.nodes[nodelist[i - E]]['obj'].fluid = fl.HE2_BlackOil(abc.oil_params(*row.tolist()))
 
         logger.debug(f'initial_edges_x = {self.initial_edges_x}')
 
+    def bind_fluid_table(self):
+        '''
+        Sets edges fluids to rows of this solver fluid table. Edges objects can be shared with other solvers (subgraphs
+        of the same schema, for example), which bind them to their own tables, so edges are bound again before every solve
+        '''
+        for obj, fluid in self.fluid_table_views:
+            if obj.fluid is not fluid:
+                obj.fluid = fluid
+
     def get_initial_approximation(self):
         x0 = np.zeros((len(self.chordes), 1))
         if self.initial_edges_x is None:
@@ -215,10 +450,73 @@ class HE2_Solver():
 
     def prepare_for_solve(self):
         logger.debug('is started')
+        self.mock_nodes, self.mock_edges, self.result_edges_mapping = [], [], dict()
         self.graph = self.transform_multi_di_graph_to_equal_di_graph(self.schema)
+        cached = None
+        if self.use_structure_cache:
+            self.fingerprint = topology_fingerprint(self.graph, self.use_sparse, self.spanning_tree)
+            cached = structure_cache.get(self.fingerprint, None)
+        if cached is not None:
+            logger.debug(f'Structure is taken from cache, fingerprint {self.fingerprint}')
+            self.initial_x_operator, self.fluid_mixer = cached['initial_x_operator'], cached['fluid_mixer']
         self.make_initial_approximation()
 
         self.graph = self.add_root_to_graph(self.graph)
+        if cached is not None:
+            for key in structure_fields:
+                setattr(self, key, cached[key])
+        else:
+            self.build_structures()
+            if self.use_structure_cache:
+                self.save_structures_to_cache()
+        self.Q_static = self.build_static_Q_vec(self.graph)
+        for (u, v) in self.edge_list:
+            obj = self.graph[u][v]['obj']
+            if not isinstance(obj, abc.HE2_ABC_GraphEdge):
+                assert False
+            self.forward_edge_functions[(u, v)] = obj.perform_calc_forward
+            self.backward_edge_functions[(u, v)] = obj.perform_calc_backward
+            self.forward_derivative_functions[(u, v)] = getattr(obj, 'perform_calc_forward_with_derivative', None)
+        if self.use_surrogates:
+            self.build_surrogates()
+        if self.compiled:
+            tree_travers = self.core_travers if self.decompose else self.tree_travers
+            self.compiled_network = self.build_compiled_network(tree_travers)
+
+        self.ready_for_solve = True
+
+    def build_compiled_network(self, tree_travers):
+        fwd, bwd, der = self.exact_edge_functions
+        return HE2_CompiledNetwork(self.graph, self.node_list, self.edge_list, tree_travers, self.chordes, fwd, bwd, der, Root)
+
+    def build_surrogates(self):
+        fwd, bwd, der = [dict(d) for d in self.exact_edge_functions]
+        for (u, v) in self.edge_list:
+            obj = self.graph[u][v]['obj']
+            if not edge_can_have_surrogate(obj):
+                continue
+            surrogate = self.edge_surrogates.get((u, v), None)
+            if surrogate is None or surrogate.obj is not obj:
+                surrogate = HE2_EdgeSurrogate(obj)
+                self.edge_surrogates[(u, v)] = surrogate
+            fwd[(u, v)] = surrogate.perform_calc_forward
+            bwd[(u, v)] = surrogate.perform_calc_backward
+            der[(u, v)] = surrogate.perform_calc_forward_with_derivative
+        self.surrogate_edge_functions = (fwd, bwd, der)
+
+    def switch_surrogates(self, on):
+        self.surrogates_on = on
+        if on:
+            self.refresh_surrogates()
+        edge_functions = self.surrogate_edge_functions if on else self.exact_edge_functions
+        self.forward_edge_functions, self.backward_edge_functions, self.forward_derivative_functions = edge_functions
+
+    def refresh_surrogates(self):
+        # Fluids are changed while solving, so surrogates of edges with new fluids are dropped
+        for surrogate in self.edge_surrogates.values():
+            surrogate.refresh()
+
+    def build_structures(self):
         self.span_tree, self.chordes = self.split_graph(self.graph)
         self.edge_list = self.span_tree + self.chordes
         self.node_list = list(self.graph.nodes())
@@ -226,22 +524,109 @@ class HE2_Solver():
             logger.error(f'Something wrong with graph restructure, Root should be last node in node_list')
             assert False
         self.tree_travers = self.build_tree_travers(self.span_tree, Root)
+        self.core_travers, self.branches_travers, self.core_edges_mask, self.core_nodes_idx = self.split_tree_travers()
+        self.tree_flow_index = self.build_tree_flow_index()
+        self.build_linear_structures()
+
+    def save_structures_to_cache(self):
+        if len(structure_cache) >= structure_cache_size:
+            structure_cache.pop(next(iter(structure_cache)))
+        cached = {key: getattr(self, key) for key in structure_fields}
+        cached.update(initial_x_operator=self.initial_x_operator, fluid_mixer=self.fluid_mixer)
+        structure_cache[self.fingerprint] = cached
+
+    def update_parameters(self, nodes_values=None, known_Q=None, edges_x=None):
+        '''
+        Changes boundary conditions of already prepared solver. Graph structures are kept, and next solve starts
+        from the previous converged solution (or from given edges_x)
+        :param nodes_values: dict node -> new P or Q value of boundary node, kind of node is not changed
+        :param known_Q: dict node -> Q, see set_known_Q(). It is used for initial approximation, so it makes sense before the first solve only
+        :param edges_x: edges flows to start from, instead of previous solution
+        '''
+        for n, value in (nodes_values or dict()).items():
+            obj = self.schema.nodes[n]['obj']
+            if not isinstance(obj, vrtxs.HE2_Boundary_Vertex):
+                logger.error(f'{n} is not a boundary node, cannot set value {value}')
+                raise ValueError
+            if obj.kind == 'Q':
+                obj.value = obj.Q = abs(value)
+            else:
+                obj.value = obj.P = value
+        if known_Q is not None:
+            self.set_known_Q(known_Q)
+        if edges_x is not None:
+            self.initial_edges_x = edges_x
+        if not self.ready_for_solve:
+            return
+
+        for u, v in self.mock_edges:
+            if u == Root:
+                self.graph[u][v]['obj'].dP = self.schema.nodes[v]['obj'].value
+        self.Q_static = self.build_static_Q_vec(self.graph)
+
+    def build_linear_structures(self):
         self.A_tree, self.A_chordes = self.build_incidence_matrices()
         if self.A_tree.shape != (len(self.node_list)-1, len(self.node_list)-1):
             logger.error(f'Invalid spanning tree, inc.matrix shape is {self.A_tree.shape}, check graph structure.')
             assert False
-        self.A_inv = np.linalg.inv(self.A_tree)
-        self.B = self.build_circuit_matrix()
-        self.Bt = np.transpose(self.B)
-        self.Q_static = self.build_static_Q_vec(self.graph)
-        for (u, v) in self.edge_list:
-            obj = self.graph[u][v]['obj']
-            if not isinstance(obj, abc.HE2_ABC_GraphEdge):
-                assert False
-            self.forward_edge_functions[(u, v)] = obj.perform_calc_forward
-            self.backward_edge_functions[(u, v)] = obj.perform_calc_backward
-
-        self.ready_for_solve = True
+        if self.use_sparse:
+            self.A_tree_lu = spla.splu(self.A_tree)
+            self.B = self.build_circuit_matrix_sparse()
+            self.Bt = None if self.B is None else self.B.T.tocsr()
+        else:
+            self.A_inv = np.linalg.inv(self.A_tree)
+            self.B = self.build_circuit_matrix()
+            self.Bt = np.transpose(self.B)
+
+    def build_tree_flow_index(self):
+        '''
+        :return: index arrays for accumulate_tree_flows(). Tree edges are listed from leafs to root (reverted tree_travers),
+        sign is +1 if tree edge is directed from child to parent, -1 otherwise
+        '''
+        node_idx = {n: i for i, n in enumerate(self.node_list)}
+        edge_idx = {e: i for i, e in enumerate(self.span_tree)}
+        K = len(self.tree_travers)
+        child, parent = np.zeros(K, dtype=np.int64), np.zeros(K, dtype=np.int64)
+        edge, sign = np.zeros(K, dtype=np.int64), np.zeros(K)
+        for k, (u, v, direction) in enumerate(self.tree_travers[::-1]):
+            p, c = (u, v) if direction == 1 else (v, u)
+            child[k], parent[k] = node_idx[c], node_idx[p]
+            edge[k] = edge_idx[(u, v)]
+            sign[k] = -direction
+        chord_u = np.array([node_idx[u] for u, v in self.chordes], dtype=np.int64)
+        chord_v = np.array([node_idx[v] for u, v in self.chordes], dtype=np.int64)
+        return child, parent, edge, sign, chord_u, chord_v
+
+    def evaluate_tree_flows(self, Q, x_chordes=None):
+        '''
+        :param Q: nodes inflows vector, Root excluded
+        :param x_chordes: chordes flows. If it is given, tree flows are evaluated for Q - A_chordes @ x_chordes
+        '''
+        child, parent, edge, sign, chord_u, chord_v = self.tree_flow_index
+        if x_chordes is None:
+            x_chordes = np.zeros(len(self.chordes))
+        x_tree = accumulate_tree_flows(Q.flatten(), x_chordes.flatten(), chord_u, chord_v, child, parent, edge, sign)
+        return x_tree.reshape((len(x_tree), 1))
+
+    def solve_loop_equations(self, der_vec, p_residuals):
+        '''
+        :return: chordes flows increment, solution of (B @ F @ Bt) @ dx = -p_residuals, F = diag(der_vec)
+        '''
+        dx = -1 * self.factorize_loop_matrix(der_vec)(p_residuals)
+        check_for_nan(dx=dx)
+        return np.atleast_1d(dx)
+
+    def factorize_loop_matrix(self, der_vec):
+        '''
+        :return: function, which solves (B @ F @ Bt) @ x = b by factorization of loop matrix. Matrix is not inverted
+        '''
+        if self.use_sparse:
+            B_F_Bt = (self.B @ sp.diags(der_vec) @ self.Bt).tocsc()
+            return spla.splu(B_F_Bt).solve
+
+        B_F_Bt = (self.B * der_vec) @ self.Bt
+        lu = sla.lu_factor(B_F_Bt, check_finite=False)
+        return lambda b: sla.lu_solve(lu, b, check_finite=False)
 
     def target(self, x_chordes):
         check_for_nan(x_chordes=x_chordes)
@@ -249,35 +634,51 @@ class HE2_Solver():
         Q = self.Q_static
         check_for_nan(Q_static=Q)
 
-        x = x_chordes.reshape((len(x_chordes), 1))
-        Q_dynamic = np.matmul(self.A_chordes, x)
-        Q = Q - Q_dynamic
-        check_for_nan(Q_dynamic=Q)
-
-        x_tree = np.matmul(self.A_inv, Q)
+        x_tree = self.evaluate_tree_flows(Q, x_chordes)
         self.edges_x = dict(zip(self.span_tree, x_tree.flatten()))
         self.edges_x.update(dict(zip(self.chordes, x_chordes.flatten())))
 
         self.last_forward_call = dict()
-        self.pt_on_tree = self.evalute_pressures_by_tree()
-        self.pt_residual_vec, self.pt_on_chords_ends = self.evalute_chordes_pressure_residual()
+        self.last_forward_derivative = dict()
+        if self.compiled_network is not None and not self.save_intermediate_results and not self.surrogates_on:
+            self.pt_on_tree, self.pt_residual_vec, self.pt_on_chords_ends = self.evaluate_compiled_network(x_tree, x_chordes)
+        else:
+            self.pt_on_tree = self.evalute_pressures_by_tree()
+            self.pt_residual_vec, self.pt_on_chords_ends = self.evalute_chordes_pressure_residual()
         check_for_nan(chordes_pt_residual_vec=self.pt_residual_vec)
 
         rez = np.linalg.norm(self.pt_residual_vec)
+        self.solve_stats['ntarget'] += 1
 
         return rez
 
-    def solve(self, threshold=0.05, it_limit=100, step=1, mix_fluids=True):
+    def solve(self, threshold=0.05, it_limit=100, step=1, mix_fluids=True, method='heuristic', broyden_updates=0):
+        '''
+        :param method: 'heuristic' - Newton direction and step_heuristic() step length, 'newton' - Newton direction
+        and backtracking line search, see newton_loop()
+        :param broyden_updates: for 'newton' method, how many iterations loop matrix is updated by Broyden formula,
+        instead of derivatives evaluation
+        '''
         logger.info('is started')
+        if method not in ('heuristic', 'newton'):
+            logger.error(f'Unknown solve method {method}')
+            raise ValueError
         y, y_best, x_best, self.it_num = 100500100500, 100500100500, None, 0
+        self.y_history = []
+        self.solve_stats = dict(ntarget=0, njev=0, backtracks=0, broyden=0, damping=0)
         try:
             if not self.ready_for_solve:
                 self.prepare_for_solve()
+            self.bind_fluid_table()
 
             x_chordes = self.get_initial_approximation()
             dx = np.zeros(x_chordes.shape)
+            self.switch_surrogates(self.use_surrogates)
 
-            while True:
+            if method == 'newton':
+                y_best, x_best = self.newton_loop(x_chordes, threshold, it_limit, mix_fluids, broyden_updates)
+
+            while method == 'heuristic':
                 self.it_num += 1
                 self.actual_x = x_chordes
                 self.actual_dx = dx
@@ -289,7 +690,15 @@ class HE2_Solver():
                 # plot_nghbs(self, ['1750018916'], deep=5, keys_to_plot=('name', 'P', 'Q'))
 
                 x_chordes = x_chordes + step * dx
+                if self.surrogates_on and y < max(self.surrogates_exact_y, threshold):
+                    # Near convergence edges are evaluated exactly, so y_best is evaluated again
+                    logger.info(f'Surrogates are switched off, y = {y}')
+                    self.switch_surrogates(False)
+                    y_best = 100500100500
+                elif self.surrogates_on:
+                    self.refresh_surrogates()
                 y, y_prev = self.target(x_chordes), y
+                self.y_history += [y]
                 logger.debug(f'X = {x_chordes.flatten()}')
                 logger.info(f'Y = {y}')
                 logger.info(f'it_num = {self.it_num}, y = {y}, step = {step}')
@@ -301,58 +710,396 @@ class HE2_Solver():
                     logger.info(f'y {y} is better than y_best {y_best}')
                     y_best, x_best = y, x_chordes
 
-                if (y_best < threshold) or (self.it_num > it_limit):
+                if (y_best < threshold and not self.surrogates_on) or (self.it_num > it_limit):
                     break
 
                 step = self.step_heuristic(y, y_prev, self.it_num, step)
 
                 self.derivatives, der_vec = self.evaluate_derivatives_on_edges()
+                self.solve_stats['njev'] += 1
                 check_for_nan(der_vec=der_vec)
 
-                F_ = np.diag(der_vec)
-                B_F_Bt = np.dot(np.dot(self.B, F_), self.Bt)
-                # det_B_F_Bt = np.linalg.det(B_F_Bt)
                 p_residuals = self.pt_residual_vec[:,0]
-                # logger.debug(f'det B = {det_B_F_Bt}')
-
-                inv_B_F_Bt = np.linalg.inv(B_F_Bt)
-                check_for_nan(inv_B_F_Bt=inv_B_F_Bt)
                 check_for_nan(p_residuals=p_residuals)
+                dx = self.solve_loop_equations(der_vec, p_residuals).reshape((len(dx), 1))
 
-                dx = -1 * np.matmul(inv_B_F_Bt, p_residuals).reshape((len(dx), 1))
-                check_for_nan(dx=dx)
-
+            self.evaluate_pressures_on_branches()
             self.attach_results_to_schema()
         except Exception as e:
             logger.error(e, exc_info=True)
 
+        if self.surrogates_on:
+            # Iterations limit is exceed while surrogates are used, so y_best is approximate
+            self.switch_surrogates(False)
+            y_best = 100500100500
         if y_best < threshold:
             logger.info(f'Solution is found, cause threshold {threshold} is touched')
         if self.it_num > it_limit:
             logger.error(f'Solution is NOT found, iterations limit {it_limit} is exceed. y_best = {y_best} threshold = {threshold}')
 
         self.op_result = scop.OptimizeResult(success=y_best < threshold, fun=y_best, x=x_best, nfev=self.it_num)
+        self.op_result.update(self.solve_stats)
+        self.op_result.update(gimme_convergence_stats(self.y_history))
         if self.op_result.success:
             self.initial_edges_x = self.edges_x.copy()
         logger.info(f'Gradient descent result is {scop.OptimizeResult(success=y_best < threshold, fun=y_best, x=None, nfev=self.it_num)}')
         logger.debug(f'Gradient descent best x is {x_best.flatten()}')
 
 
+    def newton_loop(self, x_chordes, threshold, it_limit, mix_fluids, broyden_updates):
+        '''
+        Globalized Newton method for loop equations. Step along Newton direction is chosen by backtracking line search,
+        with Armijo condition on residual norm. Loop matrix is factorized once per derivatives evaluation, and can be
+        reused by Broyden updates of its inverse. If line search fails on exact derivatives, loop matrix is damped
+        (Levenberg-Marquardt) and point is searched again from the same flows
+        :return: y_best, x_best
+        '''
+        y_best, x_best = 100500100500, None
+        y = self.target(x_chordes)
+        jac, damping = None, 0.
+        while True:
+            self.it_num += 1
+            self.actual_x = x_chordes
+            if self.surrogates_on and y < max(self.surrogates_exact_y, threshold):
+                logger.info(f'Surrogates are switched off, y = {y}')
+                self.switch_surrogates(False)
+                y, y_best, jac = self.target(x_chordes), 100500100500, None
+            self.y_history += [y]
+            logger.info(f'it_num = {self.it_num}, y = {y}')
+
+            if mix_fluids and y < y_best:
+                self.evaluate_and_set_new_fluids()
+
+            if y < y_best:
+                y_best, x_best = y, x_chordes
+
+            if (y_best < threshold and not self.surrogates_on) or (self.it_num > it_limit):
+                break
+
+            p_residuals = self.pt_residual_vec[:, 0].copy()
+            if jac is None:
+                self.derivatives, der_vec = self.evaluate_derivatives_on_edges()
+                self.solve_stats['njev'] += 1
+                jac = LoopMatrixInverse(self.factorize_loop_matrix(der_vec - damping))
+            dx = -1 * jac.solve(p_residuals).reshape(x_chordes.shape)
+            check_for_nan(dx=dx)
+
+            if self.surrogates_on:
+                self.refresh_surrogates()
+            step = 1.
+            while True:
+                x_new = x_chordes + step * dx
+                y_new = self.target(x_new)
+                if y_new <= (1 - armijo_c * step) * y or step < min_line_search_step:
+                    break
+                # Minimum of quadratic model of residual norm along dx, its derivative at zero is -y
+                a = (y_new - y + y * step) / step ** 2
+                step = np.clip(y / (2 * a), 0.1 * step, 0.5 * step)
+                self.solve_stats['backtracks'] += 1
+
+            if y_new > (1 - armijo_c * step) * y:
+                if jac.updates > 0:
+                    # Direction by updated matrix is bad, so derivatives are evaluated again
+                    y, jac = self.target(x_chordes), None
+                    continue
+                if self.surrogates_on:
+                    logger.info(f'Line search fails on surrogates, they are switched off, y = {y}')
+                    self.switch_surrogates(False)
+                    y, y_best, jac = self.target(x_chordes), 100500100500, None
+                    continue
+                scale = np.abs(der_vec).max()
+                if damping < max_damping * scale:
+                    # Loop matrix is near singular, as on dead end loops with zero flows. Edges derivatives are shifted,
+                    # as if every edge had extra linear resistance, so step is shorter and closer to residual descent
+                    damping = max(10 * damping, min_damping * scale)
+                    self.solve_stats['damping'] += 1
+                    logger.info(f'Line search fails, loop matrix is damped by {damping}, y = {y}')
+                    y = self.target(x_chordes)
+                    jac = LoopMatrixInverse(self.factorize_loop_matrix(der_vec - damping))
+                    continue
+                # Damped derivatives do not give descent too. Solve stops on the best point
+                logger.error(f'Solution is NOT found, line search fails. y_best = {y_best} threshold = {threshold}')
+                self.target(x_best)
+                break
+
+            p_residuals_new = self.pt_residual_vec[:, 0]
+            if jac.updates < broyden_updates and jac.update(step * dx.flatten(), p_residuals_new - p_residuals):
+                self.solve_stats['broyden'] += 1
+            else:
+                jac = None
+            x_chordes, y, damping = x_new, y_new, damping / 10
+        return y_best, x_best
+
+    def evaluate_compiled_network(self, x_tree, x_chordes):
+        '''
+        The same as evalute_pressures_by_tree() and evalute_chordes_pressure_residual(), but by HE2_CompiledNetwork
+        '''
+        net = self.compiled_network
+        X = np.concatenate((x_tree.flatten(), x_chordes.flatten()))
+        net.evaluate(X)
+        P, T = net.P, net.T
+        # Branches nodes are not evaluated, if graph is decomposed
+        idx = self.core_nodes_idx if self.decompose else np.arange(len(self.node_list))
+        if np.isnan(P[idx]).any():
+            logger.warning(f'Compiled network returns NaN pressures')
+        P_, T_ = P.tolist(), T.tolist()
+        pt = {self.node_list[i]: (P_[i], T_[i]) for i in idx}
+
+        K = len(self.span_tree)
+        chord_u, chord_v = self.tree_flow_index[4:]
+        pt_residual_vec = np.column_stack((net.P_end[K:] - P[chord_v], net.T_end[K:] - T[chord_v]))
+        d = dict(zip(self.chordes, zip(net.P_end[K:].tolist(), net.T_end[K:].tolist())))
+
+        for i in np.flatnonzero(~np.isnan(net.dpdx)):
+            self.last_forward_derivative[self.edge_list[i]] = net.dpdx[i]
+        self.last_forward_call.update(net.python_forward_calls)
+        return pt, pt_residual_vec, d
+
+    def gimme_batch_network(self):
+        '''
+        Batch mode evaluates the whole tree, so compiled network of decomposed solver is not used for it
+        '''
+        if self.compiled_network is not None and not self.decompose:
+            return self.compiled_network
+        if self.batch_network is None:
+            self.batch_network = self.build_compiled_network(self.tree_travers)
+        return self.batch_network
+
+    def build_batch_boundaries(self, nodes_values_list):
+        '''
+        :param nodes_values_list: list of dicts node -> new P or Q value of boundary node, see update_parameters()
+        :return: Q_static rows (K, nodes count), mock edges indexes in edge_list and their dP (K, mock edges count)
+        '''
+        K = len(nodes_values_list)
+        node_idx = {n: i for i, n in enumerate(self.node_list)}
+        edge_idx = {e: i for i, e in enumerate(self.edge_list)}
+        Q = np.tile(self.Q_static.flatten(), (K, 1))
+        mock_idx = [edge_idx[(u, v)] for u, v in self.mock_edges if u == Root]
+        mock_col = {v: j for j, (u, v) in enumerate([e for e in self.mock_edges if e[0] == Root])}
+        dP = np.tile(np.array([self.graph[u][v]['obj'].dP for u, v in self.mock_edges if u == Root], dtype=float), (K, 1))
+        for k, nodes_values in enumerate(nodes_values_list):
+            for n, value in nodes_values.items():
+                obj = self.schema.nodes[n]['obj']
+                if not isinstance(obj, vrtxs.HE2_Boundary_Vertex):
+                    logger.error(f'{n} is not a boundary node, cannot set value {value}')
+                    raise ValueError
+                if obj.kind == 'P':
+                    dP[k, mock_col[n]] = value
+                else:
+                    Q[k, node_idx[n]] = abs(value) if obj.is_source else -abs(value)
+        return Q, np.array(mock_idx, dtype=np.int64), dP
+
+    def target_batch(self, x_chordes, active):
+        '''
+        target() for scenarios batch, only active scenarios are evaluated
+        :param x_chordes: (K, chordes count)
+        :return: (K,) residuals norms, nan for inactive scenarios
+        '''
+        net = self.gimme_batch_network()
+        Q, mock_idx, dP = self.batch_boundaries
+        child, parent, edge, sign, chord_u, chord_v = self.tree_flow_index
+        x_tree = accumulate_tree_flows_batch(Q, x_chordes, active, chord_u, chord_v, child, parent, edge, sign)
+        X = np.concatenate((x_tree, x_chordes), axis=1)
+        self.batch_X[active] = X[active]
+        net.evaluate_batch(self.batch_X, active, mock_idx, dP)
+        residuals = net.batch_P_end[:, len(self.span_tree):] - net.batch_P[:, chord_v]
+        self.batch_residuals[active] = residuals[active]
+        y = np.full(len(active), np.nan)
+        y[active] = np.linalg.norm(residuals[active], axis=1)
+        return y
+
+    def evaluate_batch_derivatives(self, active):
+        '''
+        :return: (K, E) edges derivatives. Python edges without derivative function, which were evaluated backward, are
+        evaluated forward once more
+        '''
+        net = self.gimme_batch_network()
+        D = net.batch_dpdx.copy()
+        dx = 1e-3
+        for k, e in zip(*np.nonzero(np.isnan(D) & active[:, None])):
+            u, v = self.edge_list[e]
+            i = self.node_list.index(u)
+            p, t, x = net.batch_P[k, i], net.batch_T[k, i], self.batch_X[k, e]
+            der_func = self.forward_derivative_functions[(u, v)]
+            if der_func is not None:
+                D[k, e] = der_func(p, t, x)[2]
+            else:
+                edge_func = self.forward_edge_functions[(u, v)]
+                D[k, e] = (edge_func(p, t, x + dx)[0] - edge_func(p, t, x)[0]) / dx
+        return D
+
+    def solve_loop_equations_batch(self, D, residuals):
+        '''
+        :return: (K, chordes count) chordes flows increments, see solve_loop_equations(). Rows are nan, if loop matrix is singular
+        '''
+        if not self.use_sparse:
+            B_F_Bt = (self.B[None, :, :] * D[:, None, :]) @ self.Bt
+            try:
+                return -1 * np.linalg.solve(B_F_Bt, residuals[:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                pass
+        dx = np.full(residuals.shape, np.nan)
+        for k in range(len(D)):
+            try:
+                dx[k] = self.solve_loop_equations(D[k], residuals[k])
+            except Exception as e:
+                logger.warning(f'Loop matrix of scenario {k} is singular: {e}')
+        return dx
+
+    def solve_batch(self, nodes_values_list, threshold=0.05, it_limit=100, initial_x=None):
+        '''
+        Solves the same network for K boundary conditions sets at once. Chordes flows, tree flows, pressures and residuals
+        have leading scenario axis, and edges are evaluated by HE2_CompiledNetwork batch kernel, one call for all the scenarios.
+        Method is newton_loop() with line search, scenario by scenario: converged scenarios are masked out and are not evaluated.
+        Fluids are not mixed, edges keep their current fluids, so solve() with mix_fluids can be called before.
+        Solver state (edges_x, pt_on_tree, schema results) is not changed
+        :param nodes_values_list: list of dicts node -> P or Q value of boundary node, see update_parameters(). Boundary nodes
+        which are not in dict keep their current values
+        :param initial_x: (K, chordes count) chordes flows to start from. Default is solver initial approximation
+        :return: list of dicts with solve status, P (schema nodes order) and x (schema edges order), like HE2_ScenarioRunner does
+        '''
+        if not self.ready_for_solve:
+            self.prepare_for_solve()
+        self.bind_fluid_table()
+        K, C = len(nodes_values_list), len(self.chordes)
+        self.batch_boundaries = self.build_batch_boundaries(nodes_values_list)
+        self.batch_X = np.zeros((K, len(self.edge_list)))
+        self.batch_residuals = np.zeros((K, C))
+        x = np.tile(self.get_initial_approximation().flatten(), (K, 1)) if initial_x is None else np.array(initial_x, dtype=float)
+        active = np.ones(K, dtype=bool)
+        nfev, ntarget = np.ones(K, dtype=np.int64), np.ones(K, dtype=np.int64)
+        y = self.target_batch(x, active)
+        y_best, x_best = y.copy(), x.copy()
+        it_num = 0
+        active = np.isfinite(y) & (y >= threshold)
+        failed, damping = np.zeros(K, dtype=bool), np.zeros(K)
+        while active.any() and it_num < it_limit:
+            it_num += 1
+            nfev += active
+            D = self.evaluate_batch_derivatives(active)
+            residuals = self.batch_residuals.copy()
+            dx = np.zeros((K, C))
+            dx[active] = self.solve_loop_equations_batch(D[active] - damping[active, None], residuals[active])
+            active &= np.isfinite(dx).all(axis=1)
+
+            step = np.ones(K)
+            y_new = y.copy()
+            searching, rejected = active.copy(), np.zeros(K, dtype=bool)
+            while searching.any():
+                y_new[searching] = self.target_batch(x + step[:, None] * dx, searching)[searching]
+                ntarget += searching
+                accepted = y_new <= (1 - armijo_c * step) * y
+                rejected |= searching & ~accepted & (step < min_line_search_step)
+                searching &= ~accepted & ~rejected
+                # Minimum of quadratic model of residual norm along dx, see newton_loop()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    a = (y_new - y + y * step) / step ** 2
+                    new_step = np.clip(y / (2 * a), 0.1 * step, 0.5 * step)
+                step = np.where(searching, np.nan_to_num(new_step, nan=0.5 * step), step)
+
+            # Line search fails, scenario keeps its point and loop matrix is damped, or scenario stops, see newton_loop()
+            scale = np.abs(np.nan_to_num(D)).max(axis=1)
+            retry = rejected & (damping < max_damping * scale)
+            damping[retry] = np.maximum(10 * damping[retry], min_damping * scale[retry])
+            failed |= rejected & ~retry
+            active &= ~failed
+            moved = active & ~rejected
+            x[moved] = x[moved] + step[moved, None] * dx[moved]
+            y[moved], damping[moved] = y_new[moved], damping[moved] / 10
+            if retry.any():
+                # Derivatives are evaluated on the kept point again
+                self.target_batch(x, retry)
+                ntarget += retry
+            better = active & (y < y_best)
+            y_best[better], x_best[better] = y[better], x[better]
+            active &= np.isfinite(y) & (y_best >= threshold)
+
+        # Pressures of not converged scenarios are evaluated again, for their best flows. Failed scenarios were evaluated
+        # last time on rejected line search point
+        again = ~np.all(x == x_best, axis=1) | failed
+        if again.any():
+            self.target_batch(x_best, again)
+            ntarget += again
+        return self.gimme_batch_results(y_best, x_best, nfev, ntarget, threshold)
+
+    def gimme_batch_results(self, y_best, x_best, nfev, ntarget, threshold):
+        net = self.gimme_batch_network()
+        G = self.schema
+        node_idx = {n: i for i, n in enumerate(self.node_list)}
+        edge_idx = {e: i for i, e in enumerate(self.edge_list)}
+        nodes_idx = [node_idx[n] for n in G.nodes]
+        if isinstance(G, nx.MultiDiGraph):
+            edges_idx = [edge_idx[self.result_edges_mapping[e]] for e in G.edges]
+        else:
+            edges_idx = [edge_idx[e] for e in G.edges]
+        rez = []
+        for k in range(len(y_best)):
+            success = bool(y_best[k] < threshold)
+            rez += [dict(success=success, nfev=int(nfev[k]), ntarget=int(ntarget[k]), fun=y_best[k], x_chordes=x_best[k],
+                         P=net.batch_P[k, nodes_idx], x=self.batch_X[k, edges_idx])]
+        return rez
+
+    def evaluate_adjoint_sensitivities(self, dy_dp):
+        '''
+        Adjoint sensitivities of some function y(P) of nodes pressures by edges pressure drops, on the last solution.
+        If edge outlet pressure is shifted by eps, chordes flows are changed to keep loop equations solved, so
+        dP = (I - F @ Bt @ (B @ F @ Bt)^-1 @ B) @ eps on the edges, and it is propagated to the nodes by the tree.
+        Loop matrix is symmetric, so all the edges sensitivities are given by one loop equations solve
+        :param dy_dp: dict node -> dy/dP_bar on the node
+        :return: dict schema edge -> dy/d(edge outlet pressure), inlet pressure and flow of the edge are fixed
+        '''
+        if self.pt_on_tree is None:
+            logger.error('Cannot evaluate sensitivities before solve')
+            raise ValueError
+        node_idx = {n: i for i, n in enumerate(self.node_list)}
+        w = np.zeros(len(self.node_list) - 1)
+        for n, value in dy_dp.items():
+            w[node_idx[n]] += value
+
+        # Node pressure is the sum of tree edges pressure drops on the path from Root, so dy/d(dP) on the tree edge is
+        # the sum of dy/dP over its subtree. It is the same accumulation as tree flows, with opposite sign
+        child, parent, edge, sign, chord_u, chord_v = self.tree_flow_index
+        x_tree = accumulate_tree_flows(w, np.zeros(len(self.chordes)), chord_u, chord_v, child, parent, edge, sign)
+        lam = np.zeros(len(self.edge_list))
+        lam[:len(self.span_tree)] = -1 * x_tree
+        if len(self.chordes) > 0:
+            self.derivatives, der_vec = self.evaluate_derivatives_on_edges()
+            check_for_nan(der_vec=der_vec)
+            mu = self.factorize_loop_matrix(der_vec)(self.B @ (der_vec * lam))
+            lam = lam - self.Bt @ np.atleast_1d(mu)
+
+        G = self.schema
+        edge_idx = {e: i for i, e in enumerate(self.edge_list)}
+        if isinstance(G, nx.MultiDiGraph):
+            return {e: lam[edge_idx[self.result_edges_mapping[e]]] for e in G.edges}
+        return {e: lam[edge_idx[e]] for e in G.edges}
+
     def evaluate_derivatives_on_edges(self):
         rez = dict()
         rez_vec = np.zeros(len(self.edge_list))
         for i, (u, v) in enumerate(self.edge_list):
+            if self.decompose and not self.core_edges_mask[i]:
+                # Branches edges are not in loops, so loop matrix does not depend on them
+                rez[(u, v)] = 0
+                continue
             p, t = self.pt_on_tree[u]
             x = self.edges_x[(u, v)]
             dx = 1e-3
 
-            edge_func = self.forward_edge_functions[(u, v)]
-            if (u, v) in self.last_forward_call:
-                p_, t_ = self.last_forward_call[(u, v)]
+            # Edges which can evaluate derivative by themselves, did it while pressures evaluation on the tree
+            der_func = self.forward_derivative_functions[(u, v)]
+            if (u, v) in self.last_forward_derivative:
+                dpdx = self.last_forward_derivative[(u, v)]
+            elif der_func is not None:
+                p_, t_, dpdx = der_func(p, t, x)
             else:
-                p_, t_ =  edge_func(p, t, x)
-            p__, t__ =  edge_func(p, t, x + dx)
-            dpdx =  (p__ - p_) / dx
+                edge_func = self.forward_edge_functions[(u, v)]
+                if (u, v) in self.last_forward_call:
+                    p_, t_ = self.last_forward_call[(u, v)]
+                else:
+                    p_, t_ =  edge_func(p, t, x)
+                p__, t__ =  edge_func(p, t, x + dx)
+                dpdx =  (p__ - p_) / dx
             # if abs(dpdx) > 1000 and str(type(edge_func.__self__)) == "<class 'GraphEdges.HE2_Pipe.HE2_OilPipe'>":
             #     logger.warning(f'edge func derivative is too high! {u}, {v}, {dpdx:.4f}')
             #     dpdx = 1000 * dpdx/abs(dpdx)
@@ -392,6 +1139,80 @@ class HE2_Solver():
 
         return B
 
+    def build_circuit_matrix_sparse(self):
+        '''
+        Sparse analog of build_circuit_matrix. Instead of A_tree inversion, we walk tree paths between chord ends.
+        Row of B for chord (u, v) is a tree flow, induced by unit flow on this chord, so it is nonzero only on the chord cycle
+        '''
+        c = len(self.chordes)
+        if c==0:
+            logger.debug('is finished, graph is a tree')
+            return None
+        m = len(self.edge_list)
+        edge_idx = {e: i for i, e in enumerate(self.span_tree)}
+        parent, depth, up_sign, up_edge = {Root: None}, {Root: 0}, dict(), dict()
+        for u, v, direction in self.tree_travers:
+            parent_node, child = (u, v) if direction == 1 else (v, u)
+            parent[child] = parent_node
+            depth[child] = depth[parent_node] + 1
+            up_edge[child] = edge_idx[(u, v)]
+            up_sign[child] = -direction # +1 if tree edge is directed from child to parent
+
+        rows, cols, vals = [], [], []
+        for i, (u, v) in enumerate(self.chordes):
+            rows += [i]
+            cols += [m - c + i]
+            vals += [1]
+            # Unit flow goes u->v by chord, so it returns v->u by the tree
+            a, b = v, u
+            while a != b:
+                if depth[a] >= depth[b]:
+                    rows += [i]
+                    cols += [up_edge[a]]
+                    vals += [up_sign[a]]
+                    a = parent[a]
+                else:
+                    rows += [i]
+                    cols += [up_edge[b]]
+                    vals += [-up_sign[b]]
+                    b = parent[b]
+        B = sp.csr_matrix((vals, (rows, cols)), shape=(c, m), dtype=float)
+        return B
+
+    def split_tree_travers(self):
+        '''
+        Pure tree branches are left, when graph leafs are cut off again and again. They are bridges, so they are not in
+        any loop, and their flows do not depend on chordes flows - branch is an equivalent inflow of its attachment node,
+        and it is in Q_static already. So chordes residuals need pressures on the looped core only, and branches pressures
+        are evaluated by one pass after solve, see evaluate_pressures_on_branches()
+        :return: core tree travers, branches tree travers (both in tree_travers order), core edges mask (edge_list order),
+        core nodes indices (node_list order)
+        '''
+        G = self.graph
+        degree = dict(G.degree)
+        leafs = [n for n, d in degree.items() if d <= 1 and n != Root]
+        branches_nodes = set()
+        while leafs:
+            n = leafs.pop()
+            branches_nodes.add(n)
+            for m in list(G.successors(n)) + list(G.predecessors(n)):
+                if m in branches_nodes:
+                    continue
+                degree[m] -= 1
+                if degree[m] == 1 and m != Root:
+                    leafs += [m]
+        core_travers = [(u, v, d) for u, v, d in self.tree_travers if not (u in branches_nodes or v in branches_nodes)]
+        branches_travers = [(u, v, d) for u, v, d in self.tree_travers if u in branches_nodes or v in branches_nodes]
+        core_edges_mask = np.array([not (u in branches_nodes or v in branches_nodes) for u, v in self.edge_list], dtype=bool)
+        core_nodes_idx = np.array([i for i, n in enumerate(self.node_list) if not n in branches_nodes], dtype=np.int64)
+        logger.debug(f'{len(branches_travers)} of {len(self.tree_travers)} tree edges are in pure tree branches')
+        return core_travers, branches_travers, core_edges_mask, core_nodes_idx
+
+    def evaluate_pressures_on_branches(self):
+        if not self.decompose or self.pt_on_tree is None:
+            return
+        self.pt_on_tree.update(self.evalute_pressures_by_tree(self.branches_travers, self.pt_on_tree))
+
     def build_tree_travers(self, di_tree, root):
         di_edges = set(di_tree)
         undirected_tree = nx.Graph(di_tree)
@@ -409,8 +1230,21 @@ class HE2_Solver():
     def split_graph(self, graph):
         G = nx.Graph(graph)
 
-        t_ = nx.minimum_spanning_tree(G)
+        if self.spanning_tree == 'bfs':
+            t_ = nx.bfs_tree(G, Root)
+        elif self.spanning_tree == 'resistance':
+            resistance = self.estimate_edges_resistance(graph)
+            chains, _ = self.gimme_graph_chains(graph)
+            for chain in chains:
+                w = sum(resistance[e] for e in chain)
+                for u, v in chain:
+                    G[u][v]['resistance'] = w
+            t_ = nx.minimum_spanning_tree(G, weight='resistance')
+        else:
+            t_ = nx.minimum_spanning_tree(G)
         te_ = set(t_.edges())
+        if self.spanning_tree != 'default':
+            te_ = self.move_chordes_to_chains_ends(graph, te_)
 
         tl, cl = [], []
         for e in self.graph.edges():
@@ -425,6 +1259,72 @@ class HE2_Solver():
             assert False
         return tl, cl
 
+    def gimme_graph_chains(self, graph):
+        '''
+        :return: list of chains and set of chains internal nodes. Chain is a list of graph edges joined by nodes of degree 2,
+        lone edge is a chain too
+        '''
+        G = nx.Graph(graph)
+        internal = {n for n in G.nodes if n != Root and G.degree(n) == 2}
+        parent = {e: e for e in graph.edges}
+        def find(e):
+            while parent[e] != e:
+                parent[e] = parent[parent[e]]
+                e = parent[e]
+            return e
+        node_edges = dict()
+        for u, v in graph.edges:
+            for n in (u, v):
+                if n in internal:
+                    node_edges[n] = node_edges.get(n, []) + [(u, v)]
+        for n, (e1, e2) in node_edges.items():
+            parent[find(e1)] = find(e2)
+        chains = dict()
+        for e in graph.edges:
+            chains.setdefault(find(e), []).append(e)
+        return list(chains.values()), internal
+
+    def move_chordes_to_chains_ends(self, graph, te_):
+        '''
+        Fundamental loop of chord is the same, whichever chain edge is the chord. So chord is moved to the chain downstream end,
+        and pressures are propagated along the chain forward, cause edges evaluate backward pressure drop less accurate
+        :param te_: spanning tree edges set, as pairs of nodes in any order
+        :return: new tree edges set
+        '''
+        te_ = {(u, v) if graph.has_edge(u, v) else (v, u) for u, v in te_}
+        chains, internal = self.gimme_graph_chains(graph)
+        for chain in chains:
+            chordes = [e for e in chain if not e in te_]
+            if not chordes:
+                continue
+            ends = [(u, v) for u, v in chain if not v in internal]
+            chord = ends[-1] if ends else chain[-1]
+            te_ = (te_ | set(chordes)) - {chord}
+        return te_
+
+    def estimate_edges_resistance(self, graph):
+        '''
+        :return: dict edge -> |dP/dx| on initial flows. Pressure is not known yet, so edges are evaluated on mean pressure of
+        pressure constrained nodes. Edges with NaN dP/dx are treated as the most resistant ones
+        '''
+        mock_edges = [(u, v) for u, v in graph.edges if isinstance(graph[u][v]['obj'], HE2_MockEdge)]
+        p = np.mean([graph[u][v]['obj'].dP for u, v in mock_edges]) if mock_edges else 0
+        t, dx = 20, 1e-3
+        rez = dict()
+        for u, v in graph.edges:
+            obj = graph[u][v]['obj']
+            x = self.initial_edges_x.get((u, v), 0)
+            p_, t_ = obj.perform_calc_forward(p, t, x)
+            p__, t__ = obj.perform_calc_forward(p, t, x + dx)
+            rez[(u, v)] = abs(p__ - p_) / dx
+        ws = np.array(list(rez.values()), dtype=float)
+        finite = np.isfinite(ws)
+        w_max = ws[finite].max() if finite.any() else 1
+        for e, w in rez.items():
+            if not np.isfinite(w):
+                rez[e] = w_max
+        return rez
+
     def transform_multi_di_graph_to_equal_di_graph(self, zzzz):
         MDG = nx.MultiDiGraph(zzzz, data=True)
         if type(zzzz) == nx.DiGraph:
@@ -502,21 +1402,29 @@ class HE2_Solver():
         tree_edgelist = self.span_tree
         chordes_edgelist = self.chordes
 
-        A_full = nx.incidence_matrix(self.span_tree, nodelist=nodelist, edgelist=tree_edgelist, oriented=True)
-        A_full = -1 * A_full.toarray()
+        A_full = -1 * nx.incidence_matrix(self.span_tree, nodelist=nodelist, edgelist=tree_edgelist, oriented=True).tocsc()
+        A_chordes_full = -1 * nx.incidence_matrix(self.chordes, nodelist=nodelist, edgelist=chordes_edgelist, oriented=True).tocsc()
+        if not self.use_sparse:
+            A_full = A_full.toarray()
+            A_chordes_full = A_chordes_full.toarray()
         A_truncated = A_full[:-1]
-
-        A_chordes_full = nx.incidence_matrix(self.chordes, nodelist=nodelist, edgelist=chordes_edgelist, oriented=True)
-        A_chordes_full = -1 * A_chordes_full.toarray()
         A_chordes_truncated = A_chordes_full[:-1]
         logger.debug('is finished')
         return A_truncated, A_chordes_truncated
 
-    def evalute_pressures_by_tree(self):
+    def evalute_pressures_by_tree(self, tree_travers=None, pt_known=None):
+        '''
+        :param tree_travers: edges to evaluate, tree_travers or core_travers by default
+        :param pt_known: pressures on nodes, known before tree_travers evaluation
+        '''
+        if tree_travers is None:
+            tree_travers = self.core_travers if self.decompose else self.tree_travers
         pt = dict()
-        pt[Root] = (0, 20)  # TODO: get initial T from some source
+        pt[Root] = (0, abc.Root_T_C)  # TODO: get initial T from some source
+        if pt_known is not None:
+            pt.update(pt_known)
 
-        for u, v, direction in self.tree_travers:
+        for u, v, direction in tree_travers:
             obj = self.graph[u][v]['obj']
             if not isinstance(obj, abc.HE2_ABC_GraphEdge):
                 logger.error(f'({u}, {v}) graph edge cannot evaluate its pressure drop, so we cannot evaluate pressures on the tree')
@@ -533,11 +1441,15 @@ class HE2_Solver():
                 logger.warning(f'P_known is NaN! Edge is ({u}, {v}), known is {known}')
 
             x = self.edges_x[(u, v)]
-            if u == known:
+            der_func = self.forward_derivative_functions.get((u, v), None)
+            if u == known and der_func is not None:
+                p_unk, t_unk, self.last_forward_derivative[(u, v)] = der_func(p_kn, t_kn, x)
+            elif u == known:
                 edge_func = self.forward_edge_functions[(u, v)]
+                p_unk, t_unk = edge_func(p_kn, t_kn, x)
             else:
                 edge_func = self.backward_edge_functions[(u, v)]
-            p_unk, t_unk = edge_func(p_kn, t_kn, x)
+                p_unk, t_unk = edge_func(p_kn, t_kn, x)
             if u == known:
                 self.last_forward_call[(u, v)] = (p_unk, t_unk)
 
@@ -563,7 +1475,11 @@ class HE2_Solver():
                 logger.error(f'{obj} on ({u}, {v}) graph edge cannot evaluate its pressure drop, so we cannot evaluate pressures on the tree')
                 assert False
             p_u, t_u = self.pt_on_tree[u]
-            p_v, t_v = obj.perform_calc_forward(p_u, t_u, x)
+            der_func = self.forward_derivative_functions.get((u, v), None)
+            if der_func is not None:
+                p_v, t_v, self.last_forward_derivative[(u, v)] = der_func(p_u, t_u, x)
+            else:
+                p_v, t_v = obj.perform_calc_forward(p_u, t_u, x)
             self.last_forward_call[(u, v)] = p_v, t_v
 
             if self.save_intermediate_results:
@@ -606,6 +1522,9 @@ class HE2_Solver():
                 obj = self.schema[u][v][k]['obj']
                 _u, _v = self.result_edges_mapping[(u, v, k)]
                 x = self.edges_x[(_u, _v)]
+                if type(obj) == HE2_WellPump and self.compiled_network is not None:
+                    # Kernel doesnt set pump power, so pump is evaluated once more
+                    obj.perform_calc_forward(*self.pt_on_tree[_u], x)
                 obj.result = dict(x=x, WC=obj.fluid.oil_params.volumewater_percent, liquid_density=obj.fluid.CurrentLiquidDensity_kg_m3)
                 if type(obj) == HE2_WellPump:
                     obj.result.update(power=obj.power)
@@ -653,46 +1572,45 @@ class HE2_Solver():
             residual += abs(p - p_v)
         return residual
 
+    def gimme_sources_vectors(self, srcs):
+        '''
+        :return: sources fluids, make_fluid_vectors() and dot_product() constants for them. They are kept while sources are the same
+        '''
+        if self.last_src_vectors is None or srcs != self.last_src_vectors[0]:
+            src_fluids = [self.sources_fluids[n] for n in srcs]
+            zf = src_fluids[0].oil_params
+            constants = dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)
+            self.last_src_vectors = (srcs, src_fluids, fl.make_fluid_vectors(src_fluids), constants)
+        return self.last_src_vectors[1:]
+
     def evaluate_and_set_new_fluids(self):
-        G = self.graph
-        mr = self.fluids_move_rate
-        mrates = np.array([1 - mr, mr])
-        cocktails, srcs = mixer.evalute_network_fluids_with_root(G, self.edges_x)
-        # if self.test_mixer:
-        #     cocktails2, srcs2 = mixer2.evalute_network_fluids_with_root(G, self.edges_x)
-        #     self.compare_cocktails(srcs, cocktails, srcs2, cocktails2)
+        if self.fluid_table is None:
+            return
+        mixed = self.fluid_mixer.evaluate_network_cocktails_incremental(self.edges_x, self.fluid_table_keys_idx, self.mixer_state,
+                                                                         self.fluids_mixing_rtol)
+        cocktails, has_cocktail, srcs = mixed
 
         incorrect_sources = set(srcs) - set(self.sources_fluids.keys())
         if len(incorrect_sources) > 0:
             logger.info('Cannot evaluate fluids on this iteration, cause some sink nodes reverts')
             return
-
-        sources_are_the_same = (srcs == self.last_src)
-        src_fluids = [self.sources_fluids[n] for n in srcs]
-        zf = src_fluids[0].oil_params
-        constants = dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)
-        fl_vec = fl.make_fluid_vectors(src_fluids)
-        for key, cktl in cocktails.items():
-            if key in self.node_list:
-                pass
-                #TODO Здесь нужно будет ставить флюид на узлах стоках
-            else:
-                u, v = key
-                obj = G[u][v]['obj']
-                fluidA = None
-                if sources_are_the_same and key in self.last_cocktail:
-                    cktl2 = self.last_cocktail[key]
-                    if (cktl.shape == cktl2.shape) and (np.linalg.norm(cktl - cktl2) < 1e-6):
-                        fluidA = self.last_fluidA[key]
-                if fluidA is None:
-                    fluidA = fl.dot_product(cktl, src_fluids, fl_vec, **constants)
-                    self.last_fluidA[key] = fluidA
-                fluidB = obj.fluid
-                if fluidA.oil_params != fluidB.oil_params:
-                    fluidC = fl.dot_product(mrates, [fluidA, fluidB], **constants)
-                    obj.fluid = fluidC
+        #TODO Здесь нужно будет ставить флюид на узлах стоках
+
+        src_fluids, fl_vec, constants = self.gimme_sources_vectors(srcs)
+        if self.last_mixed is not mixed:
+            # Mixer returns the same result, if flows are not changed
+            self.last_mixed = mixed
+            self.last_rows_A = fl.dot_product_batch(cocktails, src_fluids, fl_vec, **constants)
+        rows_A = self.last_rows_A
+        idx = np.flatnonzero(has_cocktail)
+        keep = self.fluid_table_mask[idx]
+        rows_A, idx = rows_A[keep], idx[keep]
+        rows_B = self.fluid_table.rows[idx]
+        changed = np.any(rows_A != rows_B, axis=1)
+        if np.any(changed):
+            rows_C = fl.blend_fluid_rows(rows_A[changed], rows_B[changed], self.fluids_move_rate, **constants)
+            self.fluid_table.set_rows(idx[changed], rows_C)
         self.last_src = srcs
-        pass
 
     def step_heuristic(self, y, y_prev, it_num, step):
         if not self.random_steps:
@@ -0,0 +1,624 @@
+import time
+import numpy as np
+import networkx as nx
+from Solver.HE2_Solver import HE2_Solver
+from Tools import HE2_tools as tools
+from Tools.HE2_ABC import Root
+from GraphEdges.HE2_Pipe import HE2_OilPipe
+import Hydraulics.Properties.Mishenko as msch
+from numba import njit
+
+'''
+Benchmarks are not unit tests, so pytest/unittest do not collect them. Run this file as a script from code/Tests folder
+'''
+
+def prepare_solver_structure(G, **solver_kwargs):
+    '''
+    Performs all the linear algebra of HE2_Solver.prepare_for_solve(), skipping edge functions and fluids mixing
+    :return: solver instance and dict of timings
+    '''
+    timings = dict()
+    solver = HE2_Solver(G, **solver_kwargs)
+    t0 = time.time()
+    solver.graph = solver.transform_multi_di_graph_to_equal_di_graph(solver.schema)
+    solver.fill_known_Q()
+    t1 = time.time()
+    solver.initial_edges_x = solver.evaluate_initial_edges_x()
+    t2 = time.time()
+    solver.graph = solver.add_root_to_graph(solver.graph)
+    solver.span_tree, solver.chordes = solver.split_graph(solver.graph)
+    solver.edge_list = solver.span_tree + solver.chordes
+    solver.node_list = list(solver.graph.nodes())
+    solver.tree_travers = solver.build_tree_travers(solver.span_tree, Root)
+    solver.tree_flow_index = solver.build_tree_flow_index()
+    t3 = time.time()
+    solver.build_linear_structures()
+    solver.Q_static = solver.build_static_Q_vec(solver.graph)
+    t4 = time.time()
+    if solver.chordes:
+        der_vec = np.ones(len(solver.edge_list))
+        p_residuals = np.ones(len(solver.chordes))
+        solver.solve_loop_equations(der_vec, p_residuals)
+    t5 = time.time()
+    timings.update(initial_x=t2-t1, split=t3-t2, matrices=t4-t3, loop_solve=t5-t4)
+    return solver, timings
+
+
+def bench_sparse_linear_algebra(sizes=(100, 300, 1000, 3000, 10000, 50000), max_dense_N=3000, loops_rate=0.05):
+    print(f'{"N":>7} {"C":>5} {"mode":>7} {"initial_x":>10} {"split":>8} {"matrices":>9} {"loop_solve":>11}')
+    for N in sizes:
+        E = N - 1 + max(1, int(N * loops_rate))
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, SRC=N//10, SNK=N//10, P_CNT=2, randseed=42)
+        for use_sparse in [False, True]:
+            if not use_sparse and N > max_dense_N:
+                continue
+            solver, tms = prepare_solver_structure(G, use_sparse=use_sparse)
+            mode = 'sparse' if use_sparse else 'dense'
+            print(f'{N:>7} {len(solver.chordes):>5} {mode:>7} {tms["initial_x"]:>10.3f} {tms["split"]:>8.3f} {tms["matrices"]:>9.3f} {tms["loop_solve"]:>11.3f}')
+
+
+def bench_tree_flows(sizes=(100, 300, 1000, 3000, 10000, 50000), max_dense_N=3000, loops_rate=0.05, repeats=20, solve_N=300, solve_seeds=3):
+    '''
+    Compares per iteration tree flows evaluation: A_inv matmul (dense), splu solve (sparse) and post-order accumulator
+    '''
+    print(f'{"N":>7} {"C":>5} {"A_inv, ms":>10} {"splu, ms":>9} {"accum, ms":>10} {"max diff":>9}')
+    for N in sizes:
+        E = N - 1 + max(1, int(N * loops_rate))
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, SRC=N//10, SNK=N//10, P_CNT=2, randseed=42)
+        solver, tms = prepare_solver_structure(G, use_sparse=True)
+        x = np.random.RandomState(42).randn(len(solver.chordes))
+        Q = solver.Q_static - solver.A_chordes @ x.reshape((len(x), 1))
+        solver.evaluate_tree_flows(solver.Q_static, x) # numba compilation
+
+        t0 = time.time()
+        for i in range(repeats):
+            x_acc = solver.evaluate_tree_flows(solver.Q_static, x)
+        t_acc = (time.time() - t0) / repeats * 1000
+        t0 = time.time()
+        for i in range(repeats):
+            x_lu = solver.A_tree_lu.solve(Q)
+        t_lu = (time.time() - t0) / repeats * 1000
+        diff = np.max(np.abs(x_acc - x_lu))
+        t_inv = float('nan')
+        if N <= max_dense_N:
+            A_inv = np.linalg.inv(solver.A_tree.toarray())
+            t0 = time.time()
+            for i in range(repeats):
+                x_inv = np.matmul(A_inv, Q)
+            t_inv = (time.time() - t0) / repeats * 1000
+            diff = max(diff, np.max(np.abs(x_acc - x_inv)))
+        print(f'{N:>7} {len(solver.chordes):>5} {t_inv:>10.3f} {t_lu:>9.3f} {t_acc:>10.3f} {diff:>9.1e}')
+
+    print(f'{"N":>7} {"seed":>5} {"A_inv solve, s":>15} {"accum solve, s":>15} {"iterations":>11}')
+    for seed in range(solve_seeds):
+        G, n_dict = tools.generate_random_net_v1(N=solve_N, E=solve_N + solve_N // 10, P_CNT=2, randseed=seed)
+        tms, its = [], []
+        for solver_class in [MatmulTreeFlowsSolver, HE2_Solver]:
+            solver = solver_class(G)
+            t0 = time.time()
+            solver.solve()
+            tms += [time.time() - t0]
+            its += [solver.it_num]
+        print(f'{solve_N:>7} {seed:>5} {tms[0]:>15.3f} {tms[1]:>15.3f} {str(its):>11}')
+
+
+class MatmulTreeFlowsSolver(HE2_Solver):
+    '''
+    Solver with tree flows evaluated the old way, by A_tree inverse matrix
+    '''
+    def evaluate_tree_flows(self, Q, x_chordes=None):
+        if x_chordes is not None:
+            Q = Q - np.matmul(self.A_chordes, x_chordes.reshape((len(x_chordes), 1)))
+        return np.matmul(self.A_inv, Q)
+
+def split_pipe(pipe, n):
+    '''
+    :return: the same pipe, but every segment is splitted to n equal segments
+    '''
+    dxs, dys, diams, rghs = [], [], [], []
+    for seg in pipe.segments:
+        dxs += [seg.dx_m / n] * n
+        dys += [seg.uphill_m / n] * n
+        diams += [seg.inner_diam_m] * n
+        rghs += [seg.roughness_m] * n
+    return HE2_OilPipe(dxs, dys, diams, rghs, pipe.fluid)
+
+
+def bench_pipe_marcher(split_counts=(1, 10, 100), repeats=20):
+    '''
+    Compares compiled pipe marcher with segment by segment python calculation on DNS2 wells pipes (tubing and casing),
+    built by build_well_graph(). Pipes segments are splitted to get multi segment wells
+    '''
+    import test_low_pumps as tlp
+    from Tajlaki_DNS2_graph_example import build_well_graph
+    G = nx.DiGraph()
+    for pad_name in ['PAD_33', 'PAD_34']:
+        for well in tlp.new_pumps[pad_name]:
+            well_name = well[5:]
+            wellhead = f'Wellhead_{well_name}'
+            G.add_node(wellhead)
+            build_well_graph(G, wellhead, pad_name, well_name, tlp.pressures, tlp.plasts, tlp.new_pumps, tlp.pump_curves,
+                             tlp.fluid, tlp.inclination, 1e-5, 0.85)
+    pipes = [obj for u, v, obj in G.edges(data='obj') if isinstance(obj, HE2_OilPipe)]
+    print(f'{len(pipes)} well pipes')
+    print(f'{"segs":>5} {"direction":>10} {"python, ms":>11} {"marcher, ms":>12} {"speedup":>8} {"max diff":>9}')
+    for n in split_counts:
+        splitted = [split_pipe(pipe, n) for pipe in pipes]
+        for direction in [1, -1]:
+            t_py, t_jit, diff = 0, 0, 0
+            for pipe in splitted:
+                pipe.perform_calc_forward(50, 20, 3) # numba compilation
+                pipe.perform_calc_by_segments(50, 20, 3, direction)
+                for x in [1, 3, 10]:
+                    t0 = time.time()
+                    for i in range(repeats):
+                        p_py, t = pipe.perform_calc_by_segments(50, 20, x, direction)
+                    t1 = time.time()
+                    for i in range(repeats):
+                        p_jit, t = (pipe.perform_calc_forward if direction == 1 else pipe.perform_calc_backward)(50, 20, x)
+                    t2 = time.time()
+                    t_py, t_jit, diff = t_py + t1 - t0, t_jit + t2 - t1, max(diff, abs(p_py - p_jit))
+            calls = len(splitted) * 3 * repeats
+            print(f'{n:>5} {direction:>10} {t_py / calls * 1000:>11.3f} {t_jit / calls * 1000:>12.3f} {t_py / t_jit:>8.1f} {diff:>9.1e}')
+
+
+def bench_compiled_network(repeats=20, seeds=3):
+    '''
+    Compares per iteration pressures evaluation (target() call) of python and compiled network modes,
+    on DNS2 pads network and on random nets with oil pipes
+    '''
+    import test_low_pumps as tlp
+    import shame_on_me
+    from Tests.Optimization_test import gimme_DNS2_inlets_outlets_Q
+    cases = []
+    G, inlets, juncs, outlets = shame_on_me.build_DNS2_graph_pads33_34(pressures=tlp.pressures, plasts=tlp.plasts, pumps=tlp.new_pumps,
+        pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, DNS_pressure=4.8)
+    cases += [('DNS2 pads', G, gimme_DNS2_inlets_outlets_Q())]
+    for seed in range(seeds):
+        G, n_dict = tools.generate_random_net_v1(N=300, E=330, P_CNT=2, randseed=seed)
+        for u, v, k, obj in list(G.edges(keys=True, data='obj')):
+            seg = obj.segments[0]
+            G[u][v][k]['obj'] = HE2_OilPipe([seg.L_m], [seg.uphill_m], [seg.inner_diam_m], [seg.roughness_m])
+        cases += [(f'random {seed}', G, None)]
+
+    print(f'{"case":>10} {"E":>5} {"python, ms":>11} {"compiled, ms":>13} {"speedup":>8} {"max diff":>9}')
+    for name, G, known_Q in cases:
+        tms, pts = [], []
+        for compiled in [False, True]:
+            solver = HE2_Solver(G, compiled=compiled)
+            if known_Q is not None:
+                solver.set_known_Q(known_Q)
+            solver.prepare_for_solve()
+            x_chordes = solver.get_initial_approximation()
+            solver.target(x_chordes) # numba compilation
+            t0 = time.time()
+            for i in range(repeats):
+                solver.target(x_chordes)
+            tms += [(time.time() - t0) / repeats * 1000]
+            pts += [np.array([solver.pt_on_tree[n][0] for n in solver.node_list])]
+        diff = np.nanmax(np.abs(pts[0] - pts[1]))
+        print(f'{name:>10} {len(solver.edge_list):>5} {tms[0]:>11.3f} {tms[1]:>13.3f} {tms[0] / tms[1]:>8.1f} {diff:>9.1e}')
+
+
+def bench_fluids_mixing(sizes=(100, 300, 1000, 3000), max_dense_N=1000, loops_rate=0.1, repeats=5):
+    '''
+    Compares dense mixing matrix inverse (Fluids.HE2_MixFluids) with topological sweep and sparse LU (Fluids.HE2_MixFluids2)
+    on random nets min norm flows (they are acyclic) and on the same flows plus circulation around chordes
+    '''
+    import Fluids.HE2_MixFluids as dense_mixer
+    import Fluids.HE2_MixFluids2 as mixer
+    print(f'{"N":>7} {"flows":>7} {"dense, ms":>10} {"sparse, ms":>11} {"max diff":>9}')
+    for N in sizes:
+        E = N - 1 + max(1, int(N * loops_rate))
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, SRC=N//10, SNK=N//10, P_CNT=2, randseed=42)
+        solver, tms = prepare_solver_structure(G, use_sparse=True)
+        x0 = np.array([solver.initial_edges_x[e] for e in solver.edge_list])
+        x_circ = np.asarray(solver.Bt @ np.random.RandomState(42).uniform(50, 100, len(solver.chordes))).flatten()
+        for flows, x in [('acyclic', x0), ('cyclic', x0 + x_circ)]:
+            G2 = nx.DiGraph()
+            x_dict = dict()
+            for (u, v), x_e in zip(solver.edge_list, x):
+                if Root in (u, v):
+                    continue
+                e = (u, v) if x_e >= 0 else (v, u)
+                G2.add_edge(*e)
+                x_dict[e] = abs(x_e)
+            mixer.evalute_network_fluids_wo_root(G2, x_dict) # numba compilation
+            t0 = time.time()
+            for i in range(repeats):
+                cocktails, srcs = mixer.evalute_network_fluids_wo_root(G2, x_dict)
+            t_sparse = (time.time() - t0) / repeats * 1000
+            t_dense, diff = float('nan'), float('nan')
+            if N <= max_dense_N:
+                t0 = time.time()
+                for i in range(repeats):
+                    cocktails2, srcs2 = dense_mixer.evalute_network_fluids_wo_root(G2, x_dict)
+                t_dense = (time.time() - t0) / repeats * 1000
+                perm = [srcs.index(n) for n in srcs2]
+                diff = max(np.max(np.abs(cocktails[k][perm] - cocktails2[k])) for k in cocktails2)
+            print(f'{N:>7} {flows:>7} {t_dense:>10.2f} {t_sparse:>11.2f} {diff:>9.1e}')
+
+
+def bench_dot_product_batch(sizes=((100, 1000), (300, 3000), (1000, 10000)), sources_cnt=10, repeats=3):
+    '''
+    Compares per edge dot_product() calls with one dot_product_batch() call, on random sparse cocktails
+    '''
+    from Fluids import HE2_Fluid as fl
+    rs = np.random.RandomState(42)
+    print(f'{"sources":>8} {"edges":>7} {"loop, ms":>9} {"batch, ms":>10} {"max diff":>9}')
+    for S, E in sizes:
+        fluids = [fl.gimme_dummy_BlackOil(VolumeWater=wc) for wc in rs.uniform(0, 100, S)]
+        cocktails = np.zeros((E, S))
+        for row in cocktails:
+            idx = rs.choice(S, min(S, sources_cnt), replace=False)
+            row[idx] = rs.uniform(0, 1, len(idx))
+        cocktails /= cocktails.sum(axis=1).reshape((E, 1))
+        zf = fluids[0].oil_params
+        constants = dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)
+        fl_vec = fl.make_fluid_vectors(fluids)
+        t0 = time.time()
+        for i in range(repeats):
+            rez = [fl.dot_product(cktl, fluids, fl_vec, **constants) for cktl in cocktails]
+        t_loop = (time.time() - t0) / repeats * 1000
+        t0 = time.time()
+        for i in range(repeats):
+            rows = fl.dot_product_batch(cocktails, fluids, fl_vec, **constants)
+        t_batch = (time.time() - t0) / repeats * 1000
+        diff = np.max(np.abs(rows - np.array([fluid.oil_params for fluid in rez], dtype=float)))
+        print(f'{S:>8} {E:>7} {t_loop:>9.2f} {t_batch:>10.2f} {diff:>9.1e}')
+
+
+@njit
+def evaluate_pvt_direct(calc_params, Ps, Ts):
+    s = 0.
+    for P, T in zip(Ps, Ts):
+        if msch.is_two_phase_flow(P, T, calc_params):
+            s += msch.two_phase_pvt(P, T, calc_params).CurrentLiquidDensity_kg_m3
+        else:
+            s += msch.three_phase_pvt(P, T, calc_params).CurrentLiquidDensity_kg_m3
+    return s
+
+
+@njit
+def evaluate_pvt_by_table(calc_params, Ps, Ts, P_grid, T_grid, values, regimes):
+    s = 0.
+    for P, T in zip(Ps, Ts):
+        s += msch.pvt_by_table(P, T, calc_params, P_grid, T_grid, values, regimes)[0].CurrentLiquidDensity_kg_m3
+    return s
+
+
+def bench_pvt_table(points=3000, repeats=5):
+    '''
+    Compares PVT tables with direct Mishenko correlations: table build time, per call time from python (HE2_BlackOil.calc)
+    and from njit code, and accuracy on random (P, T, X) points. Errors are relative, except of VolumeGas_fraction one
+    '''
+    import test_low_pumps as tlp
+    from Fluids import HE2_Fluid
+    from Fluids.HE2_Fluid import HE2_BlackOil, gimme_dummy_oil_params
+    fields = ['CurrentLiquidDensity_kg_m3', 'CurrentOilViscosity_Pa_s', 'CurrentFreeGasDensity_kg_m3', 'Q_liq_and_gas_m3_s']
+    rs = np.random.RandomState(42)
+    Ps, Ts, Xs = rs.uniform(0.75, 300, points), rs.uniform(5, 100, points), rs.uniform(-20, 20, points)
+    for name, op in [('dummy', gimme_dummy_oil_params()), ('DNS2', tlp.fluid.oil_params)]:
+        msch.pvt_tables.clear()
+        msch.get_pvt_table(op)  # numba compilation
+        msch.pvt_tables.clear()
+        t0 = time.time()
+        table = msch.get_pvt_table(op)
+        t_build = (time.time() - t0) * 1000
+        print(f'{name}: table {table[2].shape}, build {t_build:.1f} ms')
+
+        errs = dict()
+        for P, T, X in zip(Ps, Ts, Xs):
+            a, b = msch.from_oil_params(P, T, X, op), msch.from_oil_params(P, T, X, op, use_table=True)
+            for f in fields:
+                errs[f] = max(errs.get(f, 0), abs(getattr(a, f) - getattr(b, f)) / max(abs(getattr(a, f)), 1e-12))
+            errs['VolumeGas_fraction'] = max(errs.get('VolumeGas_fraction', 0), abs(a.VolumeGas_fraction - b.VolumeGas_fraction))
+        for f, err in errs.items():
+            print(f'    {f:>30} {err:>9.1e}')
+
+        fluid = HE2_BlackOil(op)
+        for use_tables in [False, True]:
+            HE2_Fluid.use_pvt_tables = use_tables
+            fluid.calc(30, 20, 1)
+            t0 = time.time()
+            for P, T, X in zip(Ps, Ts, Xs):
+                fluid.calc(P, T, X)
+            print(f'    HE2_BlackOil.calc, tables {use_tables}: {(time.time() - t0) / points * 1e6:.2f} us')
+        HE2_Fluid.use_pvt_tables = False
+
+        for func, args in [(evaluate_pvt_direct, (op, Ps, Ts)), (evaluate_pvt_by_table, (op, Ps, Ts) + table)]:
+            func(*args)
+            t0 = time.time()
+            for i in range(repeats):
+                func(*args)
+            print(f'    njit {func.__name__}: {(time.time() - t0) / repeats / points * 1e9:.0f} ns')
+
+
+def bench_spanning_tree_strategies(seeds=5, N=100, E=110, methods=('heuristic', 'newton')):
+    '''
+    Compares HE2_Solver spanning tree strategies (see spanning_tree_strategies) on DNS2 networks and random nets with water
+    and oil pipes: mean fundamental loop length, solve iterations, per iteration (target() call) time and max pressure
+    difference with default strategy solution
+    '''
+    import test_low_pumps as tlp
+    import shame_on_me
+    from Tajlaki_DNS2_graph_example import build_DNS2_graph
+    from Tests.Optimization_test import gimme_DNS2_inlets_outlets_Q
+    from Solver.HE2_Solver import spanning_tree_strategies
+
+    def gimme_pads():
+        G, inlets, juncs, outlets = shame_on_me.build_DNS2_graph_pads33_34(pressures=tlp.pressures, plasts=tlp.plasts, pumps=tlp.new_pumps,
+            pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, DNS_pressure=4.8)
+        return G, gimme_DNS2_inlets_outlets_Q()
+
+    def gimme_dns2():
+        pumps = {pad: {w: ['ЭЦН5-125-2500', 41.7] for w in tlp.new_pumps[pad]} for pad in ['PAD_33', 'PAD_34']}
+        G, inlets, juncs, outlets = build_DNS2_graph(PAD_33='P=5.9', PAD_34='Q=12.7', pressures=tlp.pressures, plasts=tlp.plasts,
+            pumps=pumps, pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, inclination=tlp.inclination)
+        return G, None
+
+    def gimme_random(seed, oil):
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, P_CNT=2, randseed=seed)
+        if oil:
+            for u, v, k, obj in list(G.edges(keys=True, data='obj')):
+                seg = obj.segments[0]
+                G[u][v][k]['obj'] = HE2_OilPipe([seg.L_m], [seg.uphill_m], [seg.inner_diam_m], [seg.roughness_m])
+        return G, None
+
+    cases = [('DNS2 pads', gimme_pads), ('DNS2', gimme_dns2)]
+    cases += [(f'water {seed}', lambda seed=seed: gimme_random(seed, False)) for seed in range(seeds)]
+    cases += [(f'oil {seed}', lambda seed=seed: gimme_random(seed, True)) for seed in range(seeds)]
+
+    print(f'{"case":>10} {"method":>9} {"strategy":>10} {"loop len":>8} {"its":>4} {"calls":>5} {"ok":>3} {"ms/call":>8} {"max dP":>8}')
+    for name, builder in cases:
+        for method in methods:
+            P_default = None
+            for strategy in spanning_tree_strategies:
+                G, known_Q = builder()
+                solver = HE2_Solver(G, spanning_tree=strategy)
+                if known_Q is not None:
+                    solver.set_known_Q(known_Q)
+                t0 = time.time()
+                solver.solve(threshold=0.05, it_limit=100, method=method)
+                dt = time.time() - t0
+                loop_len = (solver.B != 0).sum() / max(len(solver.chordes), 1)
+                calls = solver.solve_stats['ntarget']
+                P = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+                P_default = P if P_default is None else P_default
+                dP = np.nanmax(np.abs(P - P_default))
+                print(f'{name:>10} {method:>9} {strategy:>10} {loop_len:>8.1f} {solver.it_num:>4} {calls:>5} {int(solver.op_result.success):>3} '
+                      f'{dt / max(calls, 1) * 1000:>8.2f} {dP:>8.1e}')
+
+
+def bench_graph_decomposition(sizes=((300, 310), (1000, 1020), (3000, 3030)), repeats=5, seed=5):
+    '''
+    Compares solver with and without decomposition to looped core and pure tree branches (see HE2_Solver.split_tree_travers)
+    on DNS2 pads network and random nets, which are mostly trees: per iteration time (target() and derivatives), solve time
+    with prepared structures, and max pressure difference
+    '''
+    import test_low_pumps as tlp
+    import shame_on_me
+    from Tests.Optimization_test import gimme_DNS2_inlets_outlets_Q
+    cases = []
+    G, inlets, juncs, outlets = shame_on_me.build_DNS2_graph_pads33_34(pressures=tlp.pressures, plasts=tlp.plasts, pumps=tlp.new_pumps,
+        pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, DNS_pressure=4.8)
+    cases += [('DNS2 pads', G, gimme_DNS2_inlets_outlets_Q())]
+    for N, E in sizes:
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, P_CNT=2, randseed=seed)
+        cases += [(f'water {N}', G, None)]
+        G, n_dict = tools.generate_random_net_v1(N=N, E=E, P_CNT=2, randseed=seed)
+        for u, v, k, obj in list(G.edges(keys=True, data='obj')):
+            seg = obj.segments[0]
+            G[u][v][k]['obj'] = HE2_OilPipe([seg.L_m], [seg.uphill_m], [seg.inner_diam_m], [seg.roughness_m])
+        cases += [(f'oil {N}', G, None)]
+
+    print(f'{"case":>10} {"core":>11} {"iter, ms":>9} {"decomp, ms":>11} {"solve, ms":>10} {"decomp, ms":>11} {"its":>4} {"ok":>3} {"max dP":>8}')
+    for name, G, known_Q in cases:
+        it_tms, solve_tms, its, oks, Ps = [], [], [], [], []
+        for decompose in [False, True]:
+            solver = HE2_Solver(G, decompose=decompose)
+            if known_Q is not None:
+                solver.set_known_Q(known_Q)
+            solver.prepare_for_solve()
+            x_chordes = solver.get_initial_approximation()
+            solver.target(x_chordes) # numba compilation
+            t0 = time.time()
+            for i in range(repeats):
+                solver.target(x_chordes)
+                solver.evaluate_derivatives_on_edges()
+            it_tms += [(time.time() - t0) / repeats * 1000]
+            t0 = time.time()
+            solver.solve(threshold=0.05, it_limit=100)
+            solve_tms += [(time.time() - t0) * 1000]
+            its += [solver.it_num]
+            oks += [solver.op_result.success]
+            Ps += [np.array([solver.pt_on_tree.get(n, (np.nan, np.nan))[0] for n in solver.node_list])]
+        core = f'{len(solver.core_travers)}/{len(solver.tree_travers)}'
+        diff = np.nanmax(np.abs(Ps[0] - Ps[1]))
+        print(f'{name:>10} {core:>11} {it_tms[0]:>9.2f} {it_tms[1]:>11.2f} {solve_tms[0]:>10.1f} {solve_tms[1]:>11.1f} {its[1]:>4} '
+              f'{int(all(oks)):>3} {diff:>8.1e}')
+
+
+def bench_chain_solver(p_heads=(5, 10, 15, 20), repeats=3):
+    '''
+    Compares HE2_Solver and HE2_ChainSolver on DNS2 pads single well subgraphs, the same way as HE2_OilGatheringNetwork_Model.score_well()
+    solves them: wellhead pressure is changed, and solve starts from the previous solution. Prints time per solve (solver
+    creation included), evaluations count, and max pressure difference
+    '''
+    import test_low_pumps as tlp
+    import shame_on_me
+    from Solver.HE2_ChainSolver import HE2_ChainSolver
+    G, inlets, juncs, outlets = shame_on_me.build_DNS2_graph_pads33_34(pressures=tlp.pressures, plasts=tlp.plasts, pumps=tlp.new_pumps,
+        pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, DNS_pressure=4.8)
+    wells = [(well.split('_')[1], well.split('_')[3]) for well in inlets if '_well_' in well]
+
+    print(f'{"solver":>16} {"solve, ms":>10} {"nfev":>6} {"failed":>7}')
+    Ps = []
+    for solver_class in (HE2_Solver, HE2_ChainSolver):
+        t0 = time.time()
+        nfev, failed, P = 0, 0, []
+        for r in range(repeats):
+            for pad, well in wells:
+                subG, nodes = tools.cut_single_well_subgraph(G, pad, well)
+                solver = solver_class(subG)
+                for p_head in p_heads:
+                    solver.update_parameters(nodes_values={nodes[-1]: p_head})
+                    solver.solve(threshold=0.05, it_limit=30)
+                    nfev += solver.op_result.nfev
+                    failed += not solver.op_result.success
+                    P += [subG.nodes[n]['obj'].result['P_bar'] for n in nodes]
+        solves = repeats * len(wells) * len(p_heads)
+        print(f'{solver_class.__name__:>16} {(time.time() - t0) / solves * 1000:>10.2f} {nfev / solves:>6.2f} {failed:>7}')
+        Ps += [np.array(P)]
+    print(f'max dP {np.max(np.abs(Ps[0] - Ps[1])):.3f}')
+
+
+def bench_batch_solver(Ks=(10, 30, 100), N=100, E=110, seed=5):
+    '''
+    Compares K sequential compiled Newton solves with one HE2_Solver.solve_batch() call, on DNS2 pads network (wells plast
+    pressures sweep) and random nets (boundary values sweep). Prints time per scenario, converged count and max pressure difference
+    '''
+    import test_low_pumps as tlp
+    import shame_on_me
+    from GraphNodes import HE2_Vertices as vrtxs
+    from Tests.Optimization_test import gimme_DNS2_inlets_outlets_Q
+    cases = []
+    G, inlets, juncs, outlets = shame_on_me.build_DNS2_graph_pads33_34(pressures=tlp.pressures, plasts=tlp.plasts, pumps=tlp.new_pumps,
+        pump_curves=tlp.pump_curves, fluid=tlp.fluid, roughness=1e-5, real_diam_coefficient=0.85, DNS_pressure=4.8)
+    cases += [('DNS2 pads', G, gimme_DNS2_inlets_outlets_Q(), [n for n in inlets if '_well_' in n])]
+    G, n_dict = tools.generate_random_net_v1(N=N, E=E, P_CNT=2, randseed=seed)
+    cases += [(f'water {N}', G, None, None)]
+    G, n_dict = tools.generate_random_net_v1(N=N, E=E, P_CNT=2, randseed=seed)
+    for u, v, k, obj in list(G.edges(keys=True, data='obj')):
+        seg = obj.segments[0]
+        G[u][v][k]['obj'] = HE2_OilPipe([seg.L_m], [seg.uphill_m], [seg.inner_diam_m], [seg.roughness_m])
+    cases += [(f'oil {N}', G, None, None)]
+
+    print(f'{"case":>10} {"K":>4} {"seq, ms":>8} {"batch, ms":>10} {"ok":>4} {"batch ok":>9} {"max dP":>8}')
+    for name, G, known_Q, nodes in cases:
+        if nodes is None:
+            nodes = [n for n in G.nodes if isinstance(G.nodes[n]['obj'], vrtxs.HE2_Boundary_Vertex)]
+        original = {n: G.nodes[n]['obj'].value for n in nodes}
+        solver = HE2_Solver(G, compiled=True)
+        if known_Q is not None:
+            solver.set_known_Q(known_Q)
+        solver.solve(threshold=0.05)
+        x0 = solver.initial_edges_x.copy()
+        solver.solve_batch([dict()], threshold=0.05) # numba compilation
+        rs = np.random.RandomState(seed)
+        for K in Ks:
+            scenarios = [{n: value * rs.uniform(0.95, 1.05) for n, value in original.items()} for k in range(K)]
+            t0 = time.time()
+            results = solver.solve_batch(scenarios, threshold=0.05)
+            batch_tm = (time.time() - t0) / K * 1000
+            t0 = time.time()
+            oks, Ps = 0, []
+            for nodes_values in scenarios:
+                solver.update_parameters(nodes_values=nodes_values, edges_x=x0)
+                solver.solve(threshold=0.05, mix_fluids=False, method='newton')
+                oks += solver.op_result.success
+                Ps += [np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])]
+            seq_tm = (time.time() - t0) / K * 1000
+            solver.update_parameters(nodes_values=original, edges_x=x0)
+            diff = np.nanmax([np.abs(rez['P'] - P) for rez, P in zip(results, Ps)])
+            batch_oks = sum(rez['success'] for rez in results)
+            print(f'{name:>10} {K:>4} {seq_tm:>8.2f} {batch_tm:>10.2f} {oks:>4} {batch_oks:>9} {diff:>8.1e}')
+
+
+def bench_adjoint_gradient(sizes=((30, 35), (100, 110), (300, 320)), seed=5):
+    '''
+    Compares HE2_PMNetwork_Model.jac() with target() on random OIS Pipe dataframes. Finite differences gradient costs
+    one target() per pipe, so its time is N * target time. Adjoint gradient is checked by finite differences on 3 pipes
+    '''
+    from Solver.HE2_Fit import HE2_PMNetwork_Model
+    print(f'{"N":>5} {"target, ms":>11} {"jac, ms":>8} {"FD grad, ms":>12} {"max rel err":>12}')
+    for N, E in sizes:
+        input_df = tools.generate_random_OISPipe_input_df(N=N, E=E, P_CNT=2, randseed=seed)
+        fitter = HE2_PMNetwork_Model(input_df)
+        fitter.max_it = 100500
+        fitter.target(np.ones(fitter.row_count))
+        rez_df = fitter.last_solve[1]
+        if rez_df is None:
+            print(f'{N:>5} solution is not found')
+            continue
+        mask = fitter.input_df.start_kind.isna()
+        fitter.input_df.loc[mask, 'start_P'] = rez_df.loc[mask, 'result_start_P'] + np.random.RandomState(seed).uniform(-1, 1, mask.sum())
+        x = np.random.RandomState(seed).uniform(0.8, 1.1, fitter.row_count)
+        t0 = time.time()
+        fitter.target(x)
+        target_tm = (time.time() - t0) * 1000
+        t0 = time.time()
+        grad = fitter.jac(x)
+        jac_tm = (time.time() - t0) * 1000
+        h, errs = 1e-6, []
+        for i in np.argsort(-np.abs(grad))[:3]:
+            e = np.eye(len(x))[i]
+            fd = (fitter.target(x + h * e) - fitter.target(x - h * e)) / (2 * h)
+            errs += [abs(grad[i] - fd) / max(abs(fd), 1e-9)]
+        print(f'{fitter.row_count:>5} {target_tm:>11.1f} {jac_tm:>8.1f} {target_tm * fitter.row_count:>12.1f} {max(errs):>12.1e}')
+
+
+def bench_persistent_model(sizes=((30, 35), (100, 110), (300, 320)), seed=5, evals=10):
+    '''
+    Compares HE2_PMNetwork_Model.target() time with graph rebuilding on every call and with persistent model, on
+    random OIS Pipe dataframes and small random weights changes, as minimizer makes them
+    '''
+    from Solver.HE2_Fit import HE2_PMNetwork_Model
+    print(f'{"N":>5} {"rebuild, ms":>12} {"persistent, ms":>15} {"max dy":>10}')
+    for N, E in sizes:
+        input_df = tools.generate_random_OISPipe_input_df(N=N, E=E, P_CNT=2, randseed=seed)
+        fitter = HE2_PMNetwork_Model(input_df)
+        fitter.target(np.ones(fitter.row_count))
+        rez_df = fitter.last_solve[1]
+        if rez_df is None:
+            print(f'{N:>5} solution is not found')
+            continue
+        mask = input_df.start_kind.isna()
+        input_df.loc[mask, 'start_P'] = rez_df.loc[mask, 'result_start_P'] + np.random.RandomState(seed).uniform(-1, 1, mask.sum())
+        times, ys = [], []
+        for persistent in (False, True):
+            fitter = HE2_PMNetwork_Model(input_df, persistent=persistent)
+            fitter.max_it = 100500
+            fitter.target(np.ones(fitter.row_count))
+            rs = np.random.RandomState(seed)
+            xs = [rs.uniform(0.95, 1.05, fitter.row_count) for i in range(evals)]
+            t0 = time.time()
+            ys += [np.array([fitter.target(x) for x in xs])]
+            times += [(time.time() - t0) * 1000 / evals]
+        print(f'{fitter.row_count:>5} {times[0]:>12.1f} {times[1]:>15.1f} {np.max(np.abs(ys[0] - ys[1])):>10.1e}')
+
+
+def bench_greed_optimization_parallel(pads=6, wells_per_pad=3, N=4, processes_list=(1, 2, 4), rounds=1):
+    '''
+    Runs HE2_OilGatheringNetwork_Model.greed_optimization_parallel() on synthetic pads network with different pool sizes.
+    Prints params sets evaluations per second, and best score, it has to be the same for all pool sizes with the same
+    batch size
+    '''
+    from HE2_tests import gimme_wells_model
+    pad_well_list = [(str(30 + p), p * wells_per_pad + w) for p in range(pads) for w in range(wells_per_pad)]
+    x0 = {key: dict(K_prod=0.5, K_pump=1.) for key in pad_well_list}
+    x0[(0, 0)] = dict(diam_keff=1.)
+    print(f'{"processes":>10} {"batch":>6} {"evals/sec":>10} {"time, s":>8} {"best y":>10}')
+    for processes in processes_list:
+        for batch_size in sorted({1, max(1, processes // 2), pads}):
+            model = gimme_wells_model(pad_well_list, N=N, network=True)
+            t0 = time.time()
+            x, best_y, fitlog = model.greed_optimization_parallel(x=x0, processes=processes, batch_size=batch_size, step=0.05, rounds=rounds, dump=False)
+            print(f'{processes:>10} {batch_size:>6} {fitlog[-1][4]:>10.1f} {time.time() - t0:>8.1f} {best_y:>10.4f}')
+
+
+if __name__ == '__main__':
+    bench_sparse_linear_algebra()
+    bench_tree_flows()
+    bench_pipe_marcher()
+    bench_compiled_network()
+    bench_fluids_mixing()
+    bench_dot_product_batch()
+    bench_pvt_table()
+    bench_spanning_tree_strategies()
+    bench_graph_decomposition()
+    bench_chain_solver()
+    bench_batch_solver()
+    bench_adjoint_gradient()
+    bench_persistent_model()
+    bench_greed_optimization_parallel()
@@ -1,20 +1,34 @@
 import unittest
 from GraphEdges.HE2_Pipe import HE2_WaterPipeSegment, HE2_OilPipeSegment, HE2_OilPipe
 from GraphEdges.HE2_Pipe import HE2_WaterPipe
+from GraphEdges.HE2_Plast import HE2_Plast
+from GraphEdges.HE2_SpecialEdges import HE2_MockEdge
 import uniflocpy.uTools.uconst as uc
 import Hydraulics.Methodics.Mukherjee_Brill as mb
 import Hydraulics.Properties.Mishenko as msch
 from Solver.HE2_Solver import HE2_Solver
+from Solver import HE2_Solver as solver_module
+from Solver.HE2_ScenarioRunner import HE2_ScenarioRunner
+from Solver.HE2_ChainSolver import HE2_ChainSolver, gimme_chain_nodes
+from Solver import HE2_PrefitRunner
 from GraphNodes import HE2_Vertices as vrtxs
 from itertools import product
 import networkx as nx
 import numpy as np
 import pandas as pd
 from Fluids import HE2_MixFluids as mixer
-from Fluids.HE2_Fluid import HE2_BlackOil
+from Fluids.HE2_Fluid import HE2_BlackOil, gimme_dummy_oil_params
+import Fluids.HE2_Fluid as fl
+from Tools.HE2_ABC import oil_params, Root
 from Solver import HE2_Fit
 from Tools import HE2_Visualize as vis, HE2_tools as tools
 from Tools.cachespline import create_lazy_spline_cache_f_wrapper
+from GraphEdges.HE2_WellPump import create_HE2_WellPump_instance_from_dataframe
+from Solver.HE2_CompiledNetwork import edge_calc, PUMP
+from scipy.interpolate import interp1d
+import tempfile
+import copy
+import os
 
 class TestWaterPipe(unittest.TestCase):
     def setUp(self):
@@ -456,6 +470,455 @@ class TestWaterNet(unittest.TestCase):
                     print(f'{u} -> {v}, {x1: .3f}, {x2: .3f}, ')
             print('-'*80)
 
+    def test_81(self):
+        # Any spanning tree strategy has to give a spanning tree and the same solution. Chordes are at chains downstream ends
+        with self.assertRaises(ValueError):
+            HE2_Solver(nx.DiGraph(), spanning_tree='dfs')
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            P = None
+            for strategy in solver_module.spanning_tree_strategies:
+                solver = HE2_Solver(G, spanning_tree=strategy)
+                solver.solve(threshold=1e-3)
+                self.assertTrue(solver.op_result.success)
+                tree = nx.Graph(solver.span_tree)
+                self.assertTrue(nx.is_tree(tree))
+                self.assertEqual(len(tree.nodes), len(solver.graph.nodes))
+                P_ = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+                P = P_ if P is None else P
+                np.testing.assert_allclose(P, P_, atol=0.01)
+                if strategy == 'default':
+                    continue
+                chains, internal = solver.gimme_graph_chains(solver.graph)
+                for chain in chains:
+                    if all(v in internal for u, v in chain):
+                        continue
+                    for u, v in chain:
+                        if (u, v) in solver.chordes:
+                            self.assertNotIn(v, internal)
+
+    def test_82(self):
+        # Decomposed solver has to give the same solution. Branches edges are not in loops, and they are evaluated after solve
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=40, E=44)
+            Ps = []
+            for kwargs in [dict(), dict(decompose=True), dict(decompose=True, compiled=True)]:
+                solver = HE2_Solver(G, **kwargs)
+                solver.solve(threshold=1e-3)
+                self.assertTrue(solver.op_result.success)
+                Ps += [np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])]
+                np.testing.assert_allclose(Ps[0], Ps[-1], atol=1e-6)
+            self.assertEqual(len(solver.core_travers) + len(solver.branches_travers), len(solver.tree_travers))
+            self.assertGreater(len(solver.branches_travers), 0)
+            self.assertTrue(solver.core_edges_mask[-len(solver.chordes):].all())
+            self.assertFalse(np.any(solver.B[:, ~solver.core_edges_mask]))
+
+
+class TestSparseSolver(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_64(self):
+        for rs in range(10):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            dense = HE2_Solver(G)
+            dense.prepare_for_solve()
+            sparse = HE2_Solver(G, use_sparse=True)
+            sparse.prepare_for_solve()
+
+            self.assertEqual(dense.chordes, sparse.chordes)
+            np.testing.assert_almost_equal(dense.B, sparse.B.toarray())
+            for key, x in dense.initial_edges_x.items():
+                self.assertAlmostEqual(x, sparse.initial_edges_x[key], 8)
+            x_tree_dense = np.matmul(dense.A_inv, dense.Q_static)
+            np.testing.assert_almost_equal(x_tree_dense, sparse.evaluate_tree_flows(sparse.Q_static))
+
+    def test_65(self):
+        G, n_dict = tools.generate_random_net_v1(randseed=0, P_CNT=2)
+        dense = HE2_Solver(G)
+        dense.solve()
+        sparse = HE2_Solver(G, use_sparse=True)
+        sparse.solve()
+        self.assertEqual(dense.it_num, sparse.it_num)
+        self.assertAlmostEqual(dense.op_result.fun, sparse.op_result.fun, 6)
+
+    def test_66(self):
+        for rs in range(10):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            solver = HE2_Solver(G)
+            solver.prepare_for_solve()
+            x_chordes = np.random.RandomState(rs).randn(len(solver.chordes))
+            Q = solver.Q_static - np.matmul(solver.A_chordes, x_chordes.reshape((len(x_chordes), 1)))
+            x_tree = np.matmul(solver.A_inv, Q)
+            np.testing.assert_almost_equal(x_tree, solver.evaluate_tree_flows(solver.Q_static, x_chordes))
+
+
+class TestStructureCache(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_70(self):
+        for rs in range(5):
+            solvers = []
+            for use_cache in [False, True, True]:
+                G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+                solver = HE2_Solver(G, use_structure_cache=use_cache)
+                solver.solve()
+                solvers += [solver]
+            s1, s2, s3 = solvers
+            self.assertIn(s3.fingerprint, solver_module.structure_cache)
+            self.assertIs(s2.A_inv, s3.A_inv)
+            self.assertIs(s2.initial_x_operator, s3.initial_x_operator)
+            self.assertEqual(s1.chordes, s3.chordes)
+            self.assertEqual(s1.it_num, s3.it_num)
+            self.assertAlmostEqual(s1.op_result.fun, s3.op_result.fun, 8)
+
+    def test_71(self):
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            p_node = [n for n in G.nodes if getattr(G.nodes[n]['obj'], 'kind', None) == 'P'][0]
+            solver = HE2_Solver(G)
+            solver.solve()
+            new_P = G.nodes[p_node]['obj'].value + 1
+            solver.update_parameters(nodes_values={p_node: new_P})
+            solver.solve()
+
+            G2, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            G2.nodes[p_node]['obj'].value = new_P
+            fresh = HE2_Solver(G2)
+            fresh.solve()
+            self.assertTrue(solver.op_result.success)
+            self.assertLessEqual(solver.it_num, fresh.it_num)
+            for n in G.nodes:
+                self.assertAlmostEqual(G.nodes[n]['obj'].result['P_bar'], G2.nodes[n]['obj'].result['P_bar'], delta=0.1)
+
+
+class TestScenarioRunner(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_72(self):
+        graphs = {rs: tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)[0] for rs in range(4)}
+        scenarios = [(i, 'base', None) for i in graphs]
+        with HE2_ScenarioRunner(graphs, processes=2) as runner:
+            results = runner.run(scenarios)
+            results2 = runner.run(scenarios)
+        for rez, rez2 in zip(results, results2):
+            G, n_dict = tools.generate_random_net_v1(randseed=rez['i'], P_CNT=2, N=30, E=40)
+            solver = HE2_Solver(G)
+            solver.solve()
+            self.assertTrue(rez['success'])
+            self.assertEqual(rez['nfev'], solver.op_result.nfev)
+            P = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+            np.testing.assert_almost_equal(rez['P'], P)
+            self.assertLess(rez2['nfev'], rez['nfev'])
+            np.testing.assert_allclose(rez2['P'], P, atol=0.1)
+
+    def test_90(self):
+        # Scenario without params is solved on base params, whatever scenarios the same worker solved before
+        pad_well_list = [('33', 1), ('33', 2), ('34', 3)]
+        model = gimme_wells_model(pad_well_list, N=1, network=True)
+        x = {key: dict(K_prod=0.3, K_pump=0.8) for key in pad_well_list}
+        x[(0, 0)] = dict(diam_keff=0.8)
+        rez = []
+        for scenarios in ([(0, 'a', x), (0, 'b', None)], [(0, 'b', None)]):
+            with HE2_ScenarioRunner(model.graphs, processes=1, freq_outlayers=model.outlayers['freq']) as runner:
+                rez += [runner.run(scenarios)]
+        (rez_a, rez_b), (fresh_b,) = rez
+        self.assertTrue(rez_b['success'] and fresh_b['success'])
+        self.assertGreater(np.abs(rez_a['P'] - fresh_b['P']).max(), 1)
+        np.testing.assert_almost_equal(rez_b['P'], fresh_b['P'])
+        np.testing.assert_almost_equal(rez_b['x'], fresh_b['x'])
+
+
+class TestBatchSolver(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_85(self):
+        # Batch solve has to give the same solutions as sequential solves, scenario by scenario
+        for rs in range(3):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            for u, v, k in list(G.edges(keys=True))[::2]:
+                G[u][v][k]['obj'] = HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+            boundaries = [n for n in G.nodes if isinstance(G.nodes[n]['obj'], vrtxs.HE2_Boundary_Vertex)]
+            original = {n: G.nodes[n]['obj'].value for n in boundaries}
+            rs_ = np.random.RandomState(rs)
+            scenarios = [{n: value * rs_.uniform(0.8, 1.2) for n, value in original.items()} for i in range(8)] + [dict()]
+            solver = HE2_Solver(G)
+            solver.solve(threshold=0.01)
+            x0 = solver.initial_edges_x.copy()
+            results = solver.solve_batch(scenarios, threshold=0.01)
+            self.assertEqual(len(results), len(scenarios))
+            for nodes_values, rez in zip(scenarios, results):
+                solver.update_parameters(nodes_values={**original, **nodes_values}, edges_x=x0)
+                solver.solve(threshold=0.01, mix_fluids=False, method='newton')
+                self.assertEqual(rez['success'], solver.op_result.success)
+                self.assertEqual(rez['nfev'], solver.op_result.nfev)
+                P = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+                np.testing.assert_allclose(rez['P'], P, atol=1e-6)
+                x = np.array([G[u][v][k]['obj'].result['x'] for u, v, k in G.edges])
+                np.testing.assert_allclose(rez['x'], x, atol=1e-6)
+
+
+class TestAdjointSensitivities(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_86(self):
+        # Adjoint gradient has to match finite differences of target, and has to cost no network solves
+        for rs in range(2):
+            input_df = tools.generate_random_OISPipe_input_df(N=20, E=26, P_CNT=2, randseed=rs)
+            fitter = HE2_Fit.HE2_PMNetwork_Model(input_df)
+            fitter.target(np.ones(fitter.row_count))
+            rez_df = fitter.last_solve[1]
+            mask = fitter.input_df.start_kind.isna()
+            noise = np.random.RandomState(rs).uniform(-1, 1, mask.sum())
+            fitter.input_df.loc[mask, 'start_P'] = rez_df.loc[mask, 'result_start_P'] + noise
+
+            x = np.random.RandomState(rs).uniform(0.8, 1.1, fitter.row_count)
+            fitter.target(x)
+            it = fitter.it
+            grad = fitter.jac(x)
+            self.assertEqual(fitter.it, it)
+            h = 1e-6
+            fd = np.array([(fitter.target(x + h * e) - fitter.target(x - h * e)) / (2 * h) for e in np.eye(len(x))])
+            np.testing.assert_allclose(grad, fd, rtol=1e-3, atol=1e-3 * np.max(np.abs(fd)))
+
+            # Out of bounds gradient is taken on clipped weights, and is not zeroed
+            i = np.argmax(np.abs(grad))
+            x_out = x.copy()
+            x_out[i] = fitter.d_max[i] + 0.5
+            x_in = np.clip(x_out, fitter.d_min, fitter.d_max)
+            grad_out = fitter.jac(x_out)
+            self.assertNotEqual(grad_out[i], 0)
+            np.testing.assert_allclose(grad_out, fitter.jac(x_in))
+
+
+class TestPersistentPMNetworkModel(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_88(self):
+        # Persistent model has to give the same results as graph rebuilding, with graph built once and warm started solves
+        input_df = tools.generate_random_OISPipe_input_df(N=20, E=26, P_CNT=2, randseed=3)
+        persistent = HE2_Fit.HE2_PMNetwork_Model(input_df, persistent=True)
+        rebuilding = HE2_Fit.HE2_PMNetwork_Model(input_df, persistent=False)
+        persistent.target(np.ones(persistent.row_count))
+        G = persistent.G
+        nfev0 = persistent.solver.op_result.nfev
+        rs = np.random.RandomState(3)
+        for i in range(5):
+            x = rs.uniform(0.95, 1.05, persistent.row_count)
+            y1, y2 = persistent.target(x), rebuilding.target(x)
+            self.assertAlmostEqual(y1, y2, delta=1e-3 * max(1, abs(y2)))
+            # Accepted solution is the next warm start, and iterations limit is not reached
+            self.assertEqual(persistent.solver.initial_edges_x, persistent.solver.edges_x)
+            self.assertLess(persistent.solver.op_result.nfev, 20)
+            df1, df2 = persistent.last_solve[1], rebuilding.last_solve[1]
+            for col in ['mass_flow', 'result_start_P', 'result_end_P']:
+                np.testing.assert_allclose(df1[col].values, df2[col].values, atol=1e-2)
+            self.assertIs(persistent.G, G)
+            self.assertLessEqual(persistent.solver.op_result.nfev, nfev0)
+
+
+class TestParametersDerivatives(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_87(self):
+        # Edges parameters derivatives have to match central differences by the same parameters
+        fluid = HE2_BlackOil(gimme_dummy_oil_params())
+        full_HPX = pd.read_csv('../../CommonData/PumpChart.csv')
+        def change_segments(attr):
+            def change(obj, step):
+                for seg in obj.segments:
+                    setattr(seg, attr, getattr(seg, attr) + step)
+            return change
+        pipe_params = dict(inner_diam_m=(change_segments('inner_diam_m'), 1e-6), roughness_m=(change_segments('roughness_m'), 1e-8))
+        plast_params = dict(Productivity=(lambda obj, step: setattr(obj, 'Productivity', obj.Productivity + step), 1e-5))
+        pump_params = dict(frequency=(lambda obj, step: obj.changeFrequency(obj.frequency + step), 1e-5),
+                           stages_ratio=(lambda obj, step: obj.change_stages_ratio(obj.stages_ratio + step), 1e-6))
+        cases = []
+        for X in (0.01, 5., -5.):
+            cases += [(HE2_WaterPipe([300, 200], [10, -5], [0.1, 0.12], [1e-5, 2e-5]), X, pipe_params, 1e-6)]
+            cases += [(HE2_OilPipe([300, 200], [10, -5], [0.1, 0.12], [1e-5, 2e-5]), X, pipe_params, 1e-5)]
+            cases += [(HE2_Plast(productivity=0.5, fluid=fluid), X, plast_params, 1e-6)]
+        for X in (0.1, 1.4, 3., 10.):
+            # Below, inside and above the pump curve
+            pump = create_HE2_WellPump_instance_from_dataframe(full_HPX, model='ЭЦН5-125-2500', fluid=fluid, frequency=48)
+            pump.change_stages_ratio(0.9)
+            cases += [(pump, X, pump_params, 1e-6)]
+
+        for obj, X, params, rtol in cases:
+            p, t, ders = obj.perform_calc_forward_with_parameters_derivatives(50, 20, X)
+            self.assertAlmostEqual(p, obj.perform_calc_forward(50, 20, X)[0])
+            self.assertEqual(set(ders.keys()), set(params.keys()))
+            for name, (change, step) in params.items():
+                change(obj, step)
+                p_plus = obj.perform_calc_forward(50, 20, X)[0]
+                change(obj, -2 * step)
+                p_minus = obj.perform_calc_forward(50, 20, X)[0]
+                change(obj, step)
+                fd = (p_plus - p_minus) / (2 * step)
+                self.assertAlmostEqual(ders[name], fd, delta=rtol * abs(fd) + 1e-6)
+
+
+def gimme_wells_model(pad_well_list, N=2, network=False):
+    '''
+    Oil gathering network model with synthetic wells and the same fact for all N datasets
+    :param network: wellheads are gathered by pads junctions to the common sink, otherwise wells are separate chains
+    '''
+    fluid = HE2_BlackOil(gimme_dummy_oil_params())
+    full_HPX = pd.read_csv('../../CommonData/PumpChart.csv')
+    model = HE2_Fit.HE2_OilGatheringNetwork_Model()
+    model.N = N
+    model.prefit_grid_size = 3
+    model.pad_well_list = pad_well_list
+    model.pad_wells_dict = dict(HE2_PrefitRunner.gimme_pads_chunks(pad_well_list))
+
+    inlets, outlets, juncs = dict(), dict(), dict()
+    for pad, well in pad_well_list:
+        nodes = model.gimme_well_nodes(pad, well)
+        inlets[nodes[0]] = vrtxs.HE2_Source_Vertex('P', 250, fluid, 20)
+        juncs.update({n: vrtxs.HE2_ABC_GraphVertex() for n in nodes[1:]})
+    if network:
+        outlets.update(sink=vrtxs.HE2_Boundary_Vertex('P', 5))
+        juncs.update({f'junction_{pad}': vrtxs.HE2_ABC_GraphVertex() for pad in model.pad_wells_dict})
+
+    G = nx.DiGraph() # Di = directed
+    for k, v in {**inlets, **outlets, **juncs}.items():
+        G.add_node(k, obj=v)
+
+    for pad, well in pad_well_list:
+        nodes = model.gimme_well_nodes(pad, well)
+        pump = create_HE2_WellPump_instance_from_dataframe(full_HPX, model='ЭЦН5-125-2500', fluid=fluid, frequency=50)
+        G.add_edge(nodes[0], nodes[1], obj=HE2_Plast(productivity=0.5, fluid=fluid))
+        G.add_edge(nodes[1], nodes[2], obj=HE2_OilPipe([300], [300], [0.127], [1e-5]))
+        G.add_edge(nodes[2], nodes[3], obj=pump)
+        G.add_edge(nodes[3], nodes[4], obj=HE2_OilPipe([1500], [1500], [0.062], [1e-5]))
+        if network:
+            G.add_edge(nodes[4], f'junction_{pad}', obj=HE2_OilPipe([500], [0], [0.1], [1e-5]))
+    if network:
+        for pad in model.pad_wells_dict:
+            G.add_edge(f'junction_{pad}', 'sink', obj=HE2_OilPipe([2000], [0], [0.15], [1e-5]))
+
+    model.graphs[0] = G
+    for i in range(1, N):
+        model.graphs[i] = copy.deepcopy(G)
+
+    fact = dict(q_well=dict(), p_head=dict(), freq=dict(), p_intake=dict(), p_zab=dict())
+    for pad, well in pad_well_list:
+        fact['q_well'][(pad, well)] = np.resize([40., 45.], N) + well
+        fact['p_head'][(pad, well)] = np.resize([10., 12.], N)
+        fact['freq'][(pad, well)] = np.resize([50., 50.], N)
+        fact['p_intake'][(pad, well)] = np.resize([60., 58.], N)
+        fact['p_zab'][(pad, well)] = np.resize([90., 88.], N)
+    model.fact = fact
+    model.outlayers = {key: {pad_well: np.zeros(N) == 1 for pad_well in pad_well_list} for key in ('freq', 'p_intake', 'q_well', 'p_head')}
+    return model
+
+
+class TestPrefitRunner(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_83(self):
+        # Parallel prefit has to give the same results in the same order, and has to be resumed from checkpoint
+        pad_well_list = [('33', 1), ('33', 2), ('34', 3)]
+        model1 = gimme_wells_model(pad_well_list)
+        rez1 = model1.prefit_all(processes=1)
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'prefit.csv')
+            model = gimme_wells_model(pad_well_list)
+            rez2 = model.prefit_all(processes=2, checkpoint_filename=filename)
+            target_cnt = model.total_target_cnt
+            rez3 = model.prefit_all(processes=2, checkpoint_filename=filename)
+            self.assertEqual(model.total_target_cnt, target_cnt)
+        self.assertEqual([(w, p) for w, p, x, f in rez1], [(w, p) for p, w in pad_well_list])
+        for r1, r2, r3 in zip(rez1, rez2, rez3):
+            self.assertEqual(r1[:2], r2[:2])
+            self.assertEqual(r1[:2], r3[:2])
+            np.testing.assert_allclose(r1[2], r2[2])
+            np.testing.assert_allclose(r2[2], r3[2])
+            self.assertAlmostEqual(r1[3], r2[3])
+            self.assertAlmostEqual(r2[3], r3[3])
+        # Fitted params are set to the main graph, by pool workers too
+        for (u, v, obj1), (u_, v_, obj2) in zip(model1.graphs[0].edges(data='obj'), model.graphs[0].edges(data='obj')):
+            for attr in ('Productivity', 'stages_ratio', 'frequency'):
+                if hasattr(obj1, attr):
+                    self.assertAlmostEqual(getattr(obj1, attr), getattr(obj2, attr))
+
+
+class TestGreedOptimizationParallel(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_89(self):
+        # Parallel greed optimization has to give the same results for any pool size, and has to report real score of its x
+        pad_well_list = [('33', 1), ('33', 2), ('34', 3), ('34', 4)]
+        x0 = {key: dict(K_prod=0.5, K_pump=1.) for key in pad_well_list}
+        x0[(0, 0)] = dict(diam_keff=1.)
+        order = [('33', 1, 'K_prod'), ('34', 3, 'K_pump'), ('34', 4, 'K_prod'), (0, 0, 'diam_keff'), ('33', 2, 'K_pump')]
+        batches = HE2_Fit.gimme_independent_batches(order, batch_size=4)
+        self.assertEqual(batches, [order[:2], order[2:3], order[3:4], order[4:]])
+
+        rez = []
+        for processes in (1, 2):
+            model = gimme_wells_model(pad_well_list, network=True)
+            rez += [model.greed_optimization_parallel(x=x0, processes=processes, batch_size=2, step=0.1, rounds=2, dump=False)]
+        (x1, y1, fitlog1), (x2, y2, fitlog2) = rez
+        self.assertEqual(x1, x2)
+        self.assertEqual(y1, y2)
+        self.assertEqual([record[3] for record in fitlog1], [record[3] for record in fitlog2])
+        self.assertLess(y1, fitlog1[0][3])
+        self.assertTrue(all([record[4] > 0 for record in fitlog1[1:]]))
+
+        model = gimme_wells_model(pad_well_list, network=True)
+        results = model.solve_em_all_parallel({'x': x1}, processes=1)
+        # Solves threshold is 0.5 bar, so cold started solve gives a bit different score
+        self.assertAlmostEqual(model.score_scenarios_results(results, 'x'), y1, delta=1e-2 * y1)
+        model.scenario_runner.close()
+
+
+class TestChainSolver(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_84(self):
+        # Chain solver has to find the same solution as HE2_Solver on single well subgraph
+        model = gimme_wells_model([('33', 1)])
+        nodes = model.gimme_well_nodes('33', 1)
+        rez = dict()
+        for solver_class in (HE2_Solver, HE2_ChainSolver):
+            G, _ = tools.cut_single_well_subgraph(model.gimme_graph(0), '33', 1, nodes)
+            solver = solver_class(G)
+            solver.set_known_Q({nodes[0]: 900 * 40 / 86400})
+            for p_head, stages_ratio in product([5, 20, 40], [0.5, 1, 1.2]):
+                G[nodes[2]][nodes[3]]['obj'].change_stages_ratio(stages_ratio)
+                solver.update_parameters(nodes_values={nodes[-1]: p_head})
+                solver.solve(threshold=0.01)
+                self.assertTrue(solver.op_result.success)
+                P = [G.nodes[n]['obj'].result['P_bar'] for n in nodes]
+                rez[(solver_class, p_head, stages_ratio)] = P, G[nodes[0]][nodes[1]]['obj'].result['x'], solver.op_result.nfev
+        for p_head, stages_ratio in product([5, 20, 40], [0.5, 1, 1.2]):
+            P, x, nfev = rez[(HE2_Solver, p_head, stages_ratio)]
+            P_, x_, nfev_ = rez[(HE2_ChainSolver, p_head, stages_ratio)]
+            np.testing.assert_allclose(P, P_, atol=0.05)
+            self.assertAlmostEqual(x, x_, 3)
+            self.assertLessEqual(nfev_, nfev)
+
+        G, _ = tools.cut_single_well_subgraph(model.gimme_graph(0), '33', 1, nodes)
+        G.nodes[nodes[-1]]['obj'] = vrtxs.HE2_Boundary_Vertex('Q', x)
+        solver = HE2_ChainSolver(G)
+        solver.solve()
+        self.assertEqual(solver.op_result.nfev, 1)
+        self.assertAlmostEqual(G.nodes[nodes[-1]]['obj'].result['P_bar'], p_head, delta=0.05)
+
+        G, n_dict = tools.generate_random_net_v1(randseed=0, P_CNT=2, N=30, E=40)
+        self.assertIsNone(gimme_chain_nodes(G))
+        self.assertRaises(ValueError, HE2_ChainSolver, G)
+
 
 class TestFluidMixer(unittest.TestCase):
     def setUp(self):
@@ -570,6 +1033,92 @@ class TestFluidMixer(unittest.TestCase):
             rez = tools.check_fluid_mixation(G, x_dict, cocktails, srcs)
             self.assertTrue(rez)
 
+    def test_77(self):
+        # Fluids table rows mixing has to be the same as dot_product() of fluids objects
+        np.random.seed(42)
+        src_fluids = [HE2_BlackOil(gimme_dummy_oil_params(volumeWater=wc)) for wc in [0, 10, 50, 97, 100]]
+        src_rows = np.array([fluid.oil_params for fluid in src_fluids], dtype=float)
+        zf = src_fluids[0].oil_params
+        constants = dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)
+        cocktails = np.random.uniform(0, 1, (20, len(src_fluids)))
+        cocktails /= cocktails.sum(axis=1).reshape((20, 1))
+        cocktails[:5] = np.eye(5)
+        rows = fl.mix_fluid_rows(cocktails, src_rows, **constants)
+        for cktl, row in zip(cocktails, rows):
+            fluid = fl.dot_product(cktl, src_fluids, **constants)
+            np.testing.assert_allclose(row, np.array(fluid.oil_params, dtype=float), rtol=1e-12)
+
+        blend = fl.blend_fluid_rows(rows[5:], rows[:-5], 0.2, **constants)
+        for row, row_a, row_b in zip(blend, rows[5:], rows[:-5]):
+            fluids = [HE2_BlackOil(oil_params(*row_a)), HE2_BlackOil(oil_params(*row_b))]
+            fluid = fl.dot_product(np.array([0.8, 0.2]), fluids, **constants)
+            np.testing.assert_allclose(row, np.array(fluid.oil_params, dtype=float), rtol=1e-12)
+
+        # Matrix form of mixer has to be the same as dict form
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs)
+            solver = HE2_Solver(G)
+            solver.solve()
+            edges = list(solver.edges_x.keys())
+            cocktails_dict, srcs = solver.fluid_mixer.evaluate_network_fluids(solver.edges_x)
+            keys_idx = solver.fluid_mixer.reduced_edges_index(edges)
+            cocktails, mask, srcs_ = solver.fluid_mixer.evaluate_network_cocktails(solver.edges_x, keys_idx)
+            self.assertEqual(srcs, srcs_)
+            keys = [e for e, m in zip(edges, mask) if m]
+            self.assertEqual(set(keys), set(edges) & set(cocktails_dict.keys()))
+            for key, cktl in zip(keys, cocktails):
+                np.testing.assert_array_equal(cktl, cocktails_dict[key])
+            table = solver.fluid_table
+            for u, v in solver.graph.edges:
+                if Root in (u, v):
+                    continue
+                fluid = solver.graph[u][v]['obj'].fluid
+                self.assertIs(fluid.table, table)
+                np.testing.assert_array_equal(np.array(fluid.oil_params), table.rows[fluid.idx])
+
+    def test_78(self):
+        # Batched dot product, with and without constant fields
+        rs = np.random.RandomState(42)
+        fluids = [HE2_BlackOil(oil_params(66.7, 84, gf, o_ro, w_ro, g_ro, 35e-3, wc, 1.015))
+                  for gf, o_ro, w_ro, g_ro, wc in zip([39, 50, 20], [826, 850, 800], [1015, 1010, 1020], [1, 0.8, 1.2], [10, 50, 90])]
+        cocktails = rs.uniform(0, 1, (10, len(fluids)))
+        cocktails /= cocktails.sum(axis=1).reshape((10, 1))
+        zf = fluids[0].oil_params
+        for constants in [dict(), dict(oil_ro=zf.oildensity_kg_m3, wat_ro=zf.waterdensity_kg_m3, gas_ro=zf.gasdensity_kg_m3, gf=zf.gasFactor)]:
+            fl_vec = fl.make_fluid_vectors(fluids)
+            rows = fl.dot_product_batch(cocktails, fluids, fl_vec, **constants)
+            for cktl, row in zip(cocktails, rows):
+                fluid = fl.dot_product(cktl, fluids, fl_vec, **constants)
+                np.testing.assert_allclose(row, np.array(fluid.oil_params, dtype=float), rtol=1e-12)
+
+    def test_79(self):
+        # Incremental mixing has to be the same as full one
+        rs = np.random.RandomState(42)
+        incremental_cnt = 0
+        for seed in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=seed)
+            solver = HE2_Solver(G)
+            solver.solve()
+            fluid_mixer, state = solver.fluid_mixer, dict()
+            edges = list(solver.edges_x.keys())
+            keys_idx = fluid_mixer.reduced_edges_index(edges)
+            x_dict = dict(solver.edges_x)
+            for i in range(10):
+                for e in rs.choice(len(edges), 3, replace=False):
+                    x_dict[edges[e]] *= rs.uniform(0.5, 1.5) if i % 3 else -1
+                cocktails, mask, srcs = fluid_mixer.evaluate_network_cocktails_incremental(x_dict, keys_idx, state)
+                cocktails_, mask_, srcs_ = fluid_mixer.evaluate_network_cocktails(x_dict, keys_idx)
+                np.testing.assert_array_equal(mask, mask_)
+                self.assertEqual(set(srcs), set(srcs_))
+                perm = [srcs.index(n) for n in srcs_]
+                np.testing.assert_allclose(cocktails[:, perm], cocktails_, atol=2e-6)
+                rez = fluid_mixer.evaluate_network_cocktails_incremental(x_dict, keys_idx, state)
+                self.assertIs(rez, state['result'])
+                self.assertIs(rez[0], cocktails)
+            self.assertEqual(state['skipped'], 10)
+            incremental_cnt += state.get('incremental', 0)
+        self.assertGreater(incremental_cnt, 0)
+
 class TestFit(unittest.TestCase):
     def setUp(self):
         pass
@@ -738,6 +1287,185 @@ class TestOilNet(unittest.TestCase):
         self.assertAlmostEqual(p_back_downhill + p_fwd_uphill, 2*p0_bar, 3)
         self.assertAlmostEqual(p_back_uphill + p_fwd_downhill, 2*p0_bar, 3)
 
+    def test_67(self):
+        edges = [HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5]), HE2_OilPipe([10], [1000], [0.062], [1e-5]),
+                 HE2_WaterPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5]),
+                 HE2_Plast(productivity=0.5, fluid=HE2_BlackOil(gimme_dummy_oil_params())), HE2_MockEdge(3)]
+        # Central differences with small step, cause pressure on the steep pipe is far from linear by flow
+        dx = 1e-6
+        for edge, p0_bar, x_kgs in product(edges, [3, 30, 80], [-5, 0.3, 2, 20]):
+            p, t = edge.perform_calc_forward(p0_bar, 20, x_kgs)
+            p_, t_, dpdx = edge.perform_calc_forward_with_derivative(p0_bar, 20, x_kgs)
+            self.assertAlmostEqual(p, p_, 8)
+            p_plus, t__ = edge.perform_calc_forward(p0_bar, 20, x_kgs + dx)
+            p_minus, t__ = edge.perform_calc_forward(p0_bar, 20, x_kgs - dx)
+            self.assertAlmostEqual(dpdx, (p_plus - p_minus) / 2 / dx, delta=1e-3 * max(abs(dpdx), 1))
+
+    def test_68(self):
+        rs = np.random.RandomState(42)
+        for i in range(20):
+            n = rs.randint(1, 5)
+            data = [list(rs.uniform(1, 500, n)), list(rs.uniform(-300, 300, n)), list(rs.uniform(0.05, 0.3, n)), list(rs.uniform(1e-6, 1e-4, n))]
+            for pipe in [HE2_OilPipe(*data), HE2_WaterPipe(*data)]:
+                pipe.segments[-1].inner_diam_m *= 0.8
+                for p0_bar, x_kgs, direction in product([1, 30, 80], [-10, 0, 0.5, 10], [1, -1]):
+                    func = pipe.perform_calc_forward if direction == 1 else pipe.perform_calc_backward
+                    p, t = func(p0_bar, 20, x_kgs)
+                    p_, t_ = pipe.perform_calc_by_segments(p0_bar, 20, x_kgs, direction)
+                    self.assertAlmostEqual(p, p_, 7)
+                    self.assertAlmostEqual(t, t_, 7)
+
+    def test_69(self):
+        # Random net pipes are replaced by oil pipes, and every third pipe is evaluated by python fallback,
+        # cause compiled network does not pack edges subclasses
+        class PythonOilPipe(HE2_OilPipe):
+            pass
+        for rs in range(10):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            for i, (u, v, k, obj) in enumerate(list(G.edges(keys=True, data='obj'))):
+                if isinstance(obj, HE2_WaterPipe):
+                    pipe_class = PythonOilPipe if i % 3 == 0 else HE2_OilPipe
+                    G[u][v][k]['obj'] = pipe_class([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+            solver = HE2_Solver(G, compiled=True)
+            solver.prepare_for_solve()
+            x_chordes = np.random.RandomState(rs).randn(len(solver.chordes), 1)
+            y = solver.target(x_chordes)
+            pt_on_tree, pt_residual_vec, derivatives = solver.pt_on_tree, solver.pt_residual_vec, solver.evaluate_derivatives_on_edges()[1]
+            solver.compiled_network = None
+            self.assertAlmostEqual(y, solver.target(x_chordes), 8)
+            for n, (p, t) in solver.pt_on_tree.items():
+                self.assertAlmostEqual(p, pt_on_tree[n][0], 8)
+                self.assertAlmostEqual(t, pt_on_tree[n][1], 8)
+            np.testing.assert_almost_equal(pt_residual_vec, solver.pt_residual_vec)
+            np.testing.assert_almost_equal(derivatives, solver.evaluate_derivatives_on_edges()[1])
+
+    def test_75(self):
+        # Solver with surrogates has to converge to the same solution, cause the last iterations are exact
+        for rs in range(3):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            for u, v, k in list(G.edges(keys=True)):
+                G[u][v][k]['obj'] = HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+            solver = HE2_Solver(G)
+            solver.solve(threshold=0.01)
+            P = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+            solver = HE2_Solver(G, surrogates=True)
+            solver.solve(threshold=0.01)
+            self.assertTrue(solver.op_result.success)
+            self.assertFalse(solver.surrogates_on)
+            self.assertGreater(len(solver.edge_surrogates), 0)
+            P_ = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+            np.testing.assert_allclose(P, P_, atol=0.01)
+
+    def test_80(self):
+        # Newton method with line search (and Broyden updates) has to find the same solution as default method
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            for u, v, k in list(G.edges(keys=True)):
+                G[u][v][k]['obj'] = HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+            solver = HE2_Solver(G)
+            solver.solve(threshold=0.01)
+            P = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+            for kwargs in [dict(method='newton'), dict(method='newton', broyden_updates=3)]:
+                solver = HE2_Solver(G)
+                solver.solve(threshold=0.01, **kwargs)
+                op_result = solver.op_result
+                self.assertTrue(op_result.success)
+                self.assertEqual(len(op_result.y_history), op_result.nfev)
+                self.assertEqual(len(op_result.rates), op_result.nfev - 1)
+                self.assertGreaterEqual(op_result.ntarget, op_result.nfev)
+                self.assertLessEqual(op_result.njev, op_result.nfev)
+                P_ = np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])
+                np.testing.assert_allclose(P, P_, atol=0.01)
+
+    def test_91(self):
+        # Solver has to keep its edges fluids, when other solver is built on the same edges objects
+        for rs in range(3):
+            Ps = []
+            for second_solver in [False, True]:
+                G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+                for u, v, k in list(G.edges(keys=True)):
+                    G[u][v][k]['obj'] = HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+                sources = [n for n in G.nodes if getattr(G.nodes[n]['obj'], 'is_source', False)]
+                for n, wc in zip(sources, [10, 50, 90]):
+                    G.nodes[n]['obj'].fluid = HE2_BlackOil(gimme_dummy_oil_params(volumeWater=wc))
+                p_node = [n for n in G.nodes if getattr(G.nodes[n]['obj'], 'kind', None) == 'P'][0]
+                solver = HE2_Solver(G)
+                solver.solve(threshold=0.01)
+                if second_solver:
+                    HE2_Solver(G).solve(threshold=0.01)
+                solver.update_parameters(nodes_values={p_node: G.nodes[p_node]['obj'].value + 20})
+                solver.solve(threshold=0.01)
+                Ps += [np.array([G.nodes[n]['obj'].result['P_bar'] for n in G.nodes])]
+            np.testing.assert_allclose(Ps[0], Ps[1], atol=1e-6)
+
+    def test_92(self):
+        # Initial approximation has dead end loops with zero flows, so full Newton step overshoots, and line search fails
+        # on exact derivatives. Rejected steps are never taken, loop matrix is damped instead
+        for rs in [3, 4]:
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            for u, v, k in list(G.edges(keys=True)):
+                G[u][v][k]['obj'] = HE2_OilPipe([100, 200], [10, -5], [0.1, 0.12], [1e-5, 1e-5])
+            solver = HE2_Solver(G)
+            solver.solve(threshold=1e-6, method='newton', mix_fluids=False)
+            op_result = solver.op_result
+            self.assertTrue(op_result.success)
+            self.assertGreater(op_result.backtracks, 0)
+            self.assertGreater(op_result.damping, 0)
+            self.assertLess(op_result.nfev, 20)
+            self.assertTrue(np.all(np.diff(op_result.y_history) <= 0))
+
+            rez = HE2_Solver(G).solve_batch([{}], threshold=1e-6)[0]
+            self.assertTrue(rez['success'])
+            self.assertEqual(rez['nfev'], op_result.nfev)
+
+    def test_73(self):
+        # Pump curves are scaled by frequency and stages ratio on evaluation, it has to be the same as interpolation of scaled curves
+        full_HPX = pd.read_csv('../../CommonData/PumpChart.csv')
+        fluid = HE2_BlackOil(gimme_dummy_oil_params())
+        pump = create_HE2_WellPump_instance_from_dataframe(full_HPX, model='ЭЦН5-125-2500', fluid=fluid)
+        for freq, ratio in product([40, 50, 57], [0.8, 1, 1.3]):
+            pump.changeFrequency(freq)
+            pump.change_stages_ratio(ratio)
+            freq_k = freq / 50
+            q_vec = pump.q_vec_50hz * freq_k
+            head_ref = interp1d(q_vec, pump.p_vec_50hz * ratio * freq_k ** 2, kind='quadratic')
+            power_ref = interp1d(q_vec, pump.n_vec_50hz * freq_k ** 3, kind='quadratic')
+            for q in np.linspace(q_vec[0], q_vec[-1], 50)[1:-1]:
+                self.assertAlmostEqual(pump.get_pressure_raise(q), head_ref(q)*1.0, 8)
+                pump.calculate_pressure_differrence(30, 20, q * fluid.CurrentLiquidDensity_kg_m3 / 86400, 1, fluid)
+                self.assertAlmostEqual(pump.power, power_ref(q)*1.0, 5)
+
+            curve, pump_param = pump.head_curve, np.array([freq_k, ratio, 1.])
+            for p0_bar, x_kgs in product([3, 30, 80], [-1, 0.5, 1.5, 5]):
+                p, t, dpdx = pump.perform_calc_forward_with_derivative(p0_bar, 20, x_kgs)
+                p_, t_, dpdx_ = edge_calc(PUMP, p0_bar, 20, x_kgs, 1, 0., np.array(fluid.oil_params, dtype=float), np.zeros((5, 0)),
+                                          1000., 1e-3, curve, pump_param)
+                self.assertAlmostEqual(p, p_, 8)
+                self.assertAlmostEqual(dpdx, dpdx_, 8)
+                p_, t_, dpdx_ = edge_calc(PUMP, p, 20, x_kgs, -1, 0., np.array(fluid.oil_params, dtype=float), np.zeros((5, 0)),
+                                          1000., 1e-3, curve, pump_param)
+                self.assertAlmostEqual(pump.perform_calc_backward(p, 20, x_kgs)[0], p_, 8)
+
+    def test_76(self):
+        # Mishenko split to pvt and flow stages has to give the same, and PVT table has to be close to exact calculation
+        for wc in [0, 50, 100]:
+            params = gimme_dummy_oil_params(volumeWater=wc)
+            for P, T, X in product([1.5, 10, 40, 66, 150, 300], [20, 45.5, 84], [0.1, 5]):
+                if msch.is_two_phase_flow(P, T, params):
+                    exact = msch.two_phase_flow(P, T, X, params)
+                    split = msch.two_phase_flow_by_pvt(msch.two_phase_pvt(P, T, params), X, params)
+                else:
+                    exact = msch.three_phase_flow(P, T, X, params)
+                    split = msch.three_phase_flow_by_pvt(msch.three_phase_pvt(P, T, params), X, params)
+                self.assertEqual(exact.oil_params, split.oil_params)
+                np.testing.assert_allclose(np.array(exact[1:], dtype=float), np.array(split[1:], dtype=float), rtol=1e-12)
+
+                exact = msch.from_oil_params(P, T, X, params)
+                by_table = msch.from_oil_params(P, T, X, params, use_table=True)
+                self.assertAlmostEqual(by_table.CurrentLiquidDensity_kg_m3 / exact.CurrentLiquidDensity_kg_m3, 1, 3)
+                self.assertAlmostEqual(by_table.CurrentOilViscosity_Pa_s / exact.CurrentOilViscosity_Pa_s, 1, 2)
+                self.assertAlmostEqual(by_table.VolumeGas_fraction, exact.VolumeGas_fraction, 2)
+
 
 class TestLazyInterpolation(unittest.TestCase):
     def setUp(self):
@@ -786,6 +1514,30 @@ class TestLazyInterpolation(unittest.TestCase):
             for j, y in enumerate(ys):
                 zs[i,j] = f2(x,y)
 
+    def test_74(self):
+        def f(x, y):
+            return np.sin(x) * np.cos(2 * y) + x * y
+
+        rs = np.random.RandomState(0)
+        pts = rs.uniform(-3, 3, (3000, 2))
+        f2 = create_lazy_spline_cache_f_wrapper(f, dx=0.3, dy=0.3, err_control_rate=0, max_pieces=4)
+        errs = [abs(f2(x, y) - f(x, y)) for x, y in pts]
+        self.assertLessEqual(len(f2.pieces), 4)
+        self.assertGreater(f2.info['evicted'], 0)
+        self.assertEqual(f2.info['cache_hit'] + f2.info['cache_miss'], len(pts))
+
+        # Coarse pieces are refined, when sampled error is greater than tol
+        f3 = create_lazy_spline_cache_f_wrapper(f, dx=0.3, dy=0.3, err_control_rate=0.2, tol=1e-6)
+        for x, y in pts:
+            f3(x, y)
+        errs_refined = [abs(f3(x, y) - f(x, y)) for x, y in pts]
+        self.assertGreater(f3.info['refined'], 0)
+        self.assertLess(np.mean(errs_refined), np.mean(errs) / 10)
+
+        for x, y in pts[:100]:
+            z, dzdy = f3.value_and_derivative(x, y)
+            self.assertAlmostEqual(dzdy, -2 * np.sin(x) * np.sin(2 * y) + x, 2)
+
 
 def test_62():
     def f(x, y):
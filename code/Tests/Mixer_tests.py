@@ -5,6 +5,8 @@ import Fluids.HE2_MixFluids2 as mixer2
 from Tools.HE2_ABC import Root
 import GraphNodes.HE2_Vertices as vrtxs
 import numpy as np
+from Solver.HE2_Solver import HE2_Solver
+from Tools import HE2_tools as tools
 
 class TestMixer(unittest.TestCase):
     def setUp(self):
@@ -296,6 +298,52 @@ class TestMixer(unittest.TestCase):
             cktl = cocktails[e]
             self.assertEqual(np.linalg.norm(cktl-eth3), 0)
 
+    def test_11(self):
+        mixers, solutions = [], []
+        for rs in range(5):
+            G, n_dict = tools.generate_random_net_v1(randseed=rs, P_CNT=2, N=30, E=40)
+            solver = HE2_Solver(G)
+            solver.solve()
+            x_dict = solver.edges_x
+            mixers += [mixer2.FluidMixer(solver.graph)]
+            solutions += [(solver.graph, x_dict)]
+
+            G2, mappings = mixer2.make_small_graph_for_mixer(solver.graph, removeRoot=True)
+            x_dict2 = mixer2.build_x_dict_for_reduced_graph(G2, x_dict, **mappings)
+            edges1, edges2, x_dict3 = mixer2.revert_edges_to_make_all_flows_positive(G2, x_dict2)
+            cocktails3, srcs = mixer2.evalute_network_fluids_wo_root(nx.DiGraph(edges2), x_dict3)
+            cocktails2 = mixer2.restore_reverted_edges_cocktails(cocktails3, edges1, edges2)
+            cocktails = mixer2.restore_cocktail_from_reduced_graph(cocktails2, srcs, x_dict2, **mappings)
+
+            cocktails_, srcs_ = mixers[-1].evaluate_network_fluids(x_dict)
+            self.assertEqual(srcs, srcs_)
+            self.assertEqual(set(cocktails.keys()), set(cocktails_.keys()))
+            for key, cktl in cocktails.items():
+                np.testing.assert_almost_equal(cktl, cocktails_[key], 6)
+
+        # Mixers are independent, so interleaved calls give the same results
+        for i in [4, 0, 3, 1, 2]:
+            G, x_dict = solutions[i]
+            cocktails, srcs = mixer2.evalute_network_fluids_with_root(G, x_dict)
+            cocktails_, srcs_ = mixers[i].evaluate_network_fluids(x_dict)
+            self.assertEqual(srcs, srcs_)
+            for key, cktl in cocktails.items():
+                np.testing.assert_almost_equal(cktl, cocktails_[key], 6)
+
+    def test_12(self):
+        # Flows have a cycle a -> b -> c -> a, so it is solved by sparse LU, not by topological sweep
+        G = nx.DiGraph()
+        edges = [('s', 'a'), ('r', 'b'), ('a', 'b'), ('b', 'c'), ('c', 'a'), ('c', 't')]
+        xs = [10, 5, 15, 20, 5, 15]
+        x_dict = dict(zip(edges, xs))
+        G.add_edges_from(edges)
+        cocktails, srcs = mixer2.evalute_network_fluids_wo_root(G, x_dict)
+        self.assertEqual(srcs, ['s', 'r'])
+        np.testing.assert_almost_equal(cocktails[('a', 'b')], [8/9, 1/9])
+        np.testing.assert_almost_equal(cocktails[('c', 't')], [2/3, 1/3])
+        np.testing.assert_almost_equal(cocktails['t'], [2/3, 1/3])
+        np.testing.assert_almost_equal(cocktails[('s', 'a')], [1, 0])
+
 
 if __name__ == "__main__":
     test = TestMixer()
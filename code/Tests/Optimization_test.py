@@ -12,6 +12,7 @@ from Tools.HE2_Logger import getLogger
 import numpy as np
 
 from Tools.HE2_tools import cut_single_well_subgraph
+from Solver.HE2_PrefitRunner import HE2_PrefitRunner, attach_wells_results
 
 logger = getLogger(__name__)
 
@@ -1047,7 +1048,7 @@ def model_DNS_2(pressures:dict = {}, plasts:dict = {}, DNS_daily_debit = 0, pump
 # Содержимое аргумента при выполнении тела функции, может быть разным, при вызове с одной и той же строкой параметров. Начинает зависеть от того с какими аргументами вызывалась функция раньше.
 # Вот и PyCharm это подчеркивает
 def model_DNS_2_by_parts(pressures: dict = {}, plasts: dict = {}, pumps=None, pump_curves=None, fluid=None,
-                         roughness=0.00001, real_diam_coefficient=1, well_list=None, DNS_daily_debit=0):
+                         roughness=0.00001, real_diam_coefficient=1, well_list=None, DNS_daily_debit=0, processes=None):
 
     G, inlets, juncs, outlets = build_DNS2_graph(pressures, plasts, pumps, pump_curves, fluid, roughness,
                                                  real_diam_coefficient, DNS_daily_debit)
@@ -1055,26 +1056,27 @@ def model_DNS_2_by_parts(pressures: dict = {}, plasts: dict = {}, pumps=None, pu
     if well_list:
         wells = list(set(well_list) & set(inlets))
 
+    # Wells subgraphs are independent, so they are solved by process pool
+    pad_well_list = [(well.split('_')[1], well.split('_')[3]) for well in wells]
+    with HE2_PrefitRunner(G, processes) as runner:
+        results = runner.solve_wells(pad_well_list)
+    attach_wells_results(G, results)
+
     good_cnt, bad_cnt = 0, 0
-    for well in wells:
-        l = well.split('_')
-        subG, well_node_list = cut_single_well_subgraph(G, l[1], l[3])
-        solver = HE2_Solver(subG)
-        solver.solve()
-        op_result = solver.op_result
-        Q = subG.nodes[well]['obj'].result['Q']
-        if op_result.fun < 1e-3 and Q > 0:
+    for well, rez in zip(wells, results):
+        Q = rez['nodes_result'][well]['Q']
+        if rez['fun'] < 1e-3 and Q > 0:
             # Q > 0 means node is a source
             # print(well, ' is ok')
             good_cnt+=1
             continue
 
         bad_cnt +=1
-        if op_result.fun > 1e-3:
-            print(f'NOT SOLVED, {op_result.fun: .3f}')
-        print(well, subG.nodes[well]['obj'].result)
+        if rez['fun'] > 1e-3:
+            print(f'NOT SOLVED, {rez["fun"]: .3f}')
+        print(well, rez['nodes_result'][well])
         u, v = list(G.edges(well))[0]
-        print(f'{u}-->{v}', subG[u][v]['obj'].result, '\n')
+        print(f'{u}-->{v}', rez['edges_result'][(u, v)], '\n')
 
     print(good_cnt, bad_cnt, len(wells))
     return None
@@ -3,6 +3,7 @@ from abc import abstractmethod
 from collections import namedtuple
 
 Root = 'Root'
+Root_T_C = 20 # Temperature of Root node, solvers start pressures and temperatures propagation from it
 SOLVER_VERSION = '0.205 d2af90f3'
 
 class HE2_ABC_Fluid(ABC):
@@ -23,6 +24,10 @@ class HE2_ABC_GraphEdge(ABC):
     2. perform_calc_forward() заданы p,t в начале координат трубы, возвращается p,t в конце координат
     3. perform_calc_backward() заданы p,t в конце координат трубы, возвращается p,t в начале координат
     1. perform_calc используется unifloc-style (00, 01, 10, 11) для указания направления потока и расчета
+    Опционально дуга может иметь метод perform_calc_forward_with_derivative(P_bar, T_C, X_kgsec) -> (p, t, dp/dx),
+    тогда солвер не считает производную конечной разностью, а берет ее из того же вызова
+    Также дуга может иметь метод perform_calc_forward_with_parameters_derivatives(P_bar, T_C, X_kgsec) -> (p, t, dict),
+    dict содержит производные давления в конце по настраиваемым параметрам дуги, при заданных давлении в начале и потоке
     """
     @abstractmethod
     def perform_calc(self, P_bar, T_C, X_kgsec, unifloc_direction):
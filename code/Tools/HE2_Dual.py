@@ -0,0 +1,282 @@
+import operator
+import numpy as np
+from numba import types
+from numba.core import cgutils
+from numba.extending import models, register_model, make_attribute_wrapper, intrinsic, overload, lower_cast
+
+'''
+Dual numbers for forward mode differentiation of njit functions. Dual is a pair (value, derivative), arithmetic,
+comparisons and numpy functions used by fluid properties and pressure drop correlations are overloaded for it, so the
+same njit function, called with dual arguments, returns the value and the derivative together.
+Comparisons and branches use values only, so derivative is taken on the branch which is chosen by values.
+Dual is unified with numbers, so numbers are casted to dual with zero derivative
+'''
+
+
+class DualType(types.Type):
+    def __init__(self):
+        super(DualType, self).__init__(name='Dual')
+
+    def unify(self, typingctx, other):
+        if isinstance(other, (types.Number, types.Boolean)):
+            return self
+
+
+dual_type = DualType()
+
+
+@register_model(DualType)
+class DualModel(models.StructModel):
+    def __init__(self, dmm, fe_type):
+        members = [('v', types.float64), ('d', types.float64)]
+        models.StructModel.__init__(self, dmm, fe_type, members)
+
+
+make_attribute_wrapper(DualType, 'v', 'v')
+make_attribute_wrapper(DualType, 'd', 'd')
+
+
+@intrinsic
+def dual(typingctx, v, d):
+    '''
+    :return: dual number with value v and derivative d
+    '''
+    def codegen(context, builder, signature, args):
+        v, d = args
+        vty, dty = signature.args
+        rez = cgutils.create_struct_proxy(dual_type)(context, builder)
+        rez.v = context.cast(builder, v, vty, types.float64)
+        rez.d = context.cast(builder, d, dty, types.float64)
+        return rez._getvalue()
+    return dual_type(v, d), codegen
+
+
+@lower_cast(types.Number, DualType)
+@lower_cast(types.Boolean, DualType)
+def number_to_dual(context, builder, fromty, toty, val):
+    rez = cgutils.create_struct_proxy(dual_type)(context, builder)
+    rez.v = context.cast(builder, val, fromty, types.float64)
+    rez.d = context.get_constant(types.float64, 0.)
+    return rez._getvalue()
+
+
+def is_dual(a):
+    return isinstance(a, DualType)
+
+
+def is_dual_args(a, b):
+    '''
+    :return: True if one of the args is dual, and the other one is dual or number
+    '''
+    numbers = (types.Number, types.Boolean, DualType)
+    return (is_dual(a) or is_dual(b)) and isinstance(a, numbers) and isinstance(b, numbers)
+
+
+# Overloads implementations are module level functions, not closures, so njit functions with dual args can be cached
+
+def to_dual(a):
+    pass
+
+
+@overload(to_dual)
+def to_dual_ovl(a):
+    if is_dual(a):
+        return lambda a: a
+    if isinstance(a, (types.Number, types.Boolean)):
+        return lambda a: dual(a, 0.)
+
+
+@overload(operator.add)
+def dual_add(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return dual(a.v + b.v, a.d + b.d)
+        return impl
+
+
+@overload(operator.sub)
+def dual_sub(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return dual(a.v - b.v, a.d - b.d)
+        return impl
+
+
+@overload(operator.mul)
+def dual_mul(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return dual(a.v * b.v, a.d * b.v + a.v * b.d)
+        return impl
+
+
+@overload(operator.truediv)
+def dual_div(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return dual(a.v / b.v, (a.d * b.v - a.v * b.d) / b.v ** 2)
+        return impl
+
+
+@overload(operator.pow)
+def dual_pow(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            v = a.v ** b.v
+            d = 0.
+            if a.d != 0:
+                d += b.v * a.v ** (b.v - 1) * a.d
+            if b.d != 0:
+                d += v * np.log(a.v) * b.d
+            return dual(v, d)
+        return impl
+
+
+@overload(operator.lt)
+def dual_lt(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v < to_dual(b).v
+
+
+@overload(operator.le)
+def dual_le(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v <= to_dual(b).v
+
+
+@overload(operator.gt)
+def dual_gt(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v > to_dual(b).v
+
+
+@overload(operator.ge)
+def dual_ge(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v >= to_dual(b).v
+
+
+@overload(operator.eq)
+def dual_eq(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v == to_dual(b).v
+
+
+@overload(operator.ne)
+def dual_ne(a, b):
+    if is_dual_args(a, b):
+        return lambda a, b: to_dual(a).v != to_dual(b).v
+
+
+@overload(max)
+def dual_max(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return a if a.v >= b.v else b
+        return impl
+
+
+@overload(min)
+def dual_min(a, b):
+    if is_dual_args(a, b):
+        def impl(a, b):
+            a, b = to_dual(a), to_dual(b)
+            return a if a.v <= b.v else b
+        return impl
+
+
+@overload(operator.neg)
+def dual_neg(a):
+    if is_dual(a):
+        return lambda a: dual(-a.v, -a.d)
+
+
+@overload(operator.pos)
+def dual_pos(a):
+    if is_dual(a):
+        return lambda a: a
+
+
+@overload(abs)
+def dual_abs(a):
+    if is_dual(a):
+        return lambda a: a if a.v >= 0 else dual(-a.v, -a.d)
+
+
+@overload(bool)
+def dual_bool(a):
+    if is_dual(a):
+        return lambda a: a.v != 0
+
+
+@overload(float)
+def dual_float(a):
+    if is_dual(a):
+        return lambda a: a.v
+
+
+@overload(np.sign)
+def dual_sign(a):
+    if is_dual(a):
+        return lambda a: np.sign(a.v)
+
+
+@overload(np.log)
+def dual_log(a):
+    if is_dual(a):
+        return lambda a: dual(np.log(a.v), a.d / a.v)
+
+
+@overload(np.log10)
+def dual_log10(a):
+    if is_dual(a):
+        return lambda a: dual(np.log10(a.v), a.d / (a.v * np.log(10.)))
+
+
+@overload(np.exp)
+def dual_exp(a):
+    if is_dual(a):
+        def impl(a):
+            v = np.exp(a.v)
+            return dual(v, v * a.d)
+        return impl
+
+
+@overload(np.sqrt)
+def dual_sqrt(a):
+    if is_dual(a):
+        def impl(a):
+            v = np.sqrt(a.v)
+            return dual(v, 0.5 * a.d / v)
+        return impl
+
+
+@overload(np.sin)
+def dual_sin(a):
+    if is_dual(a):
+        return lambda a: dual(np.sin(a.v), np.cos(a.v) * a.d)
+
+
+@overload(np.cos)
+def dual_cos(a):
+    if is_dual(a):
+        return lambda a: dual(np.cos(a.v), -np.sin(a.v) * a.d)
+
+
+@overload(np.interp)
+def dual_interp(x, xp, fp):
+    if is_dual(x):
+        def impl(x, xp, fp):
+            v = np.interp(x.v, xp, fp)
+            i = np.searchsorted(xp, x.v) - 1
+            slope = 0.
+            if 0 <= i < len(xp) - 1:
+                slope = (fp[i + 1] - fp[i]) / (xp[i + 1] - xp[i])
+            return dual(v, slope * x.d)
+        return impl
@@ -365,7 +365,8 @@ def make_multigraph_schema_from_OISPipe_dataframes(df_pipes, df_boundaries):
         #     print(d)
 
         if d['is_source']:
-            obj = vrtxs.HE2_Source_Vertex(d['kind'], d['value'], 'water', 20)
+            # Water pipes are evaluated with dummy water, source fluid is needed for solver fluids mixing only
+            obj = vrtxs.HE2_Source_Vertex(d['kind'], d['value'], gimme_dummy_BlackOil(), 20)
         elif d['kind']=='Q' and ((d['Q'] is None) or d['Q']==0):
             obj = vrtxs.HE2_ABC_GraphVertex()
         else:
@@ -10,11 +10,14 @@ import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 from collections import namedtuple
-from Fluids.HE2_Fluid import HE2_BlackOil
+from Fluids.HE2_Fluid import HE2_BlackOil, gimme_dummy_BlackOil
 from Tools.HE2_Logger import check_for_nan, getLogger
 
 logger = getLogger(__name__)
 
+# networkx 3.4 drops random_tree, random_labeled_tree is the same thing
+random_tree = getattr(nx.generators.trees, 'random_tree', None) or nx.random_labeled_tree
+
 CheckSolutionResults = namedtuple('CheckSolutionResults', ['first_CL_resd', 'second_CL_resd', 'negative_P', 'misdirected_flow', 'bad_directions', 'first_CL_OWG_resd'])
 
 
@@ -126,11 +129,11 @@ def generate_random_net_v1(N=15, E=20, SRC=3, SNK=3, P_CNT=1, Q=20, P=200, D=0.5
     p_nodes, sources, sinks = dict(), dict(), dict()
     for kind, src, q in zip(kinds, srcs, qs):
         if src and kind == 'P':
-            node = vrtxs.HE2_Source_Vertex(kind, np.random.randint(-P, P), 'water', 20)
+            node = vrtxs.HE2_Source_Vertex(kind, np.random.randint(-P, P), gimme_dummy_BlackOil(), 20)
             name = f'p_node_{len(p_nodes)}'
             p_nodes[name] = node
         elif src and kind == 'Q':
-            node = vrtxs.HE2_Source_Vertex(kind, q, 'water', 20)
+            node = vrtxs.HE2_Source_Vertex(kind, q, gimme_dummy_BlackOil(), 20)
             name = f'src_{len(sources)}'
             sources[name] = node
         elif not src and kind == 'P':
@@ -145,7 +148,7 @@ def generate_random_net_v1(N=15, E=20, SRC=3, SNK=3, P_CNT=1, Q=20, P=200, D=0.5
     nodes = {**p_nodes, **sources, **sinks, **juncs}
     assert len(nodes) == N
     mapping = dict(zip(range(N), nodes.keys()))
-    RT = nx.generators.trees.random_tree(N, seed=randseed)
+    RT = random_tree(N, seed=randseed)
     edgelist = [tuple(np.random.choice([u, v], 2, replace=False)) for u, v in RT.edges]
     edgelist += [tuple(np.random.choice(range(N), 2, replace=False)) for i in range(E-(N-1))]
 
@@ -169,6 +172,33 @@ def generate_random_net_v1(N=15, E=20, SRC=3, SNK=3, P_CNT=1, Q=20, P=200, D=0.5
 
     return G, dict(p_nodes=p_nodes, juncs=juncs, sources=sources, sinks=sinks)
 
+def generate_random_OISPipe_input_df(N=15, E=20, SRC=3, SNK=3, P_CNT=1, Q=20, P=200, D=0.5, H=50, L=1000, S=8, randseed=None):
+    '''
+    Input dataframe for DFOperations.HE2_DateframeWrapper.do_predict(), one row per pipe. Topology, boundaries and pipes are
+    taken from generate_random_net_v1(), pipes inner diameters are not less than D / 10, nodes altitudes are random in [0, H]
+    :param S: pipe wall thickness, mm
+    :return: dataframe in OIS Pipe units: D, S in mm, Q in m3/day
+    '''
+    G, n_dict = generate_random_net_v1(N=N, E=E, SRC=SRC, SNK=SNK, P_CNT=P_CNT, Q=Q, P=P, D=D, L=L, randseed=randseed)
+    node_ids = {n: i + 1 for i, n in enumerate(G.nodes)}
+    altitudes = {n: np.random.uniform(0, H) for n in G.nodes}
+    rows = []
+    for u, v, k in G.edges:
+        seg = G[u][v][k]['obj'].segments[0]
+        row = dict(L=seg.L_m, D=max(seg.inner_diam_m, D / 10) * 1000 + 2 * S, S=S)
+        for n, end in ((u, 'start'), (v, 'end')):
+            obj = G.nodes[n]['obj']
+            row.update({f'node_id_{end}': node_ids[n], f'node_name_{end}': n, f'altitude_{end}': altitudes[n]})
+            row.update({f'{end}_kind': None, f'{end}_Q': np.nan, f'{end}_is_source': None, f'{end}_P': np.nan})
+            if isinstance(obj, vrtxs.HE2_Boundary_Vertex):
+                row.update({f'{end}_kind': obj.kind, f'{end}_is_source': obj.is_source})
+                if obj.kind == 'Q':
+                    row[f'{end}_Q'] = obj.value * 86400 / 1000
+                else:
+                    row[f'{end}_P'] = obj.value
+        rows += [row]
+    return pd.DataFrame(rows)
+
 def HE2_draw_node_labels(G, g_nodes, nodelist, keys, **kwargs):
     lbls = dict()
     for n in list(set(nodelist) & g_nodes):
@@ -611,8 +641,9 @@ def split_input_df_to_pipes_and_boundaries(df):
     df_bnd_end = df[end_cols]
     df_bnd_end.columns = bnd_cols2 + bnd_cols1
     df_bnds = pd.concat([df_bnd_start, df_bnd_end])
-    df_bnds = df_bnds[~df_bnds.kind.isna()]
-    to_drop = start_cols + end_cols
+    df_bnds = df_bnds[~df_bnds.kind.isna()].rename(columns={'node_id': 'id'})
+    # Pipes keep their ends ids, graph is built by them
+    to_drop = ['start_' + col for col in bnd_cols1] + ['end_' + col for col in bnd_cols1]
     df_pipes = df.drop(columns=to_drop)
     return df_pipes, df_bnds
 
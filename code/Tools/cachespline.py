@@ -1,71 +1,126 @@
 import numpy as np
-from scipy.interpolate import interp2d
+from scipy.interpolate import RectBivariateSpline
 from itertools import product
-from collections import Counter
+from collections import Counter, OrderedDict
 
+spline_degrees = dict(linear=1, quadratic=2, cubic=3, quintic=5)
 
-def create_lazy_spline_cache_f_wrapper(f, dx=0.1, dy=0.1, half_nx=4, half_ny=4, kind='cubic', err_control_rate=0.001):
-    info = Counter()
-    nx = 2*half_nx
-    ny = 2*half_ny
-    grid_step_x = dx*(nx-1)
-    grid_step_y = dy*(ny-1)
-    covered = set()
-    surface_pieces = dict()
-    f_on_grid_cache = dict()
 
-    def get_nearest_grid_knot_idxs(x, y):
-        x_knot_idx = round(x / grid_step_x)
-        y_knot_idx = round(y / grid_step_y)
+class LazySplineCache():
+    '''
+    Lazily built spline surrogate of f(x, y). Plane is covered by knots grid, and spline surface piece is built over
+    the nearest knot on the first call near it. Piece is built by f values on fine grid with dx, dy steps around the knot.
+    Pieces are kept in LRU order, so memory is bounded by max_pieces.
+    Some calls are checked by f itself (err_control_rate), and if error is greater than tol, the piece is built again
+    on twice finer grid, up to max_level times
+    '''
+    def __init__(self, f, dx=0.1, dy=0.1, half_nx=4, half_ny=4, kind='cubic', err_control_rate=0.001, tol=None,
+                 max_pieces=None, max_level=3, seed=0):
+        self.f = f
+        self.dx, self.dy = dx, dy
+        self.half_nx, self.half_ny = half_nx, half_ny
+        self.nx, self.ny = 2 * half_nx, 2 * half_ny
+        self.grid_step_x = dx * (self.nx - 1)
+        self.grid_step_y = dy * (self.ny - 1)
+        self.degree = spline_degrees[kind]
+        self.err_control_rate = err_control_rate
+        self.tol = tol
+        self.max_pieces = max_pieces
+        self.max_level = max_level
+        self.random = np.random.RandomState(seed)
+        self.info = Counter()
+        self.pieces = OrderedDict()  # knot -> (level, spline)
+        self.f_on_grid_cache = dict()
+
+    def get_nearest_grid_knot_idxs(self, x, y):
+        x_knot_idx = round(x / self.grid_step_x)
+        y_knot_idx = round(y / self.grid_step_y)
         return x_knot_idx, y_knot_idx
 
-    def build_spline_surface_over_knot(x_knot_idx, y_knot_idx):
-        center_i = x_knot_idx * (nx-1)
-        center_j = y_knot_idx * (ny-1)
-        ld_corner_i = center_i - half_nx
-        ld_corner_j = center_j - half_ny
-        ru_corner_i = center_i + half_nx
-        ru_corner_j = center_j + half_ny
-        i_range = list(range(ld_corner_i, ru_corner_i+1))
-        j_range = list(range(ld_corner_j, ru_corner_j+1))
-        assert len(i_range) == nx+1
-        assert len(j_range) == ny+1
-        zs = np.zeros((nx+1, ny+1))
-        for (i, j) in product(i_range, j_range):
-            if not (i, j) in f_on_grid_cache:
-                z = f(i * dx, j * dy)
-                f_on_grid_cache[(i, j)] = z
-            else:
-                z = f_on_grid_cache[(i, j)]
-            ii = i - ld_corner_i
-            jj = j - ld_corner_j
-            zs[ii, jj] = z
-        xmin, xmax = i_range[0] * dx, i_range[-1] * dx
-        ymin, ymax = j_range[0] * dy, j_range[-1] * dy
-        xs = np.linspace(start=xmin, stop=xmax, num=nx+1)
-        ys = np.linspace(start=ymin, stop=ymax, num=ny+1)
-        zs = np.transpose(zs)
-        surface_piece = interp2d(x=xs, y=ys, z=zs, kind=kind)
-        return surface_piece
+    def get_piece_grid(self, x_knot_idx, y_knot_idx, level):
+        k = 2 ** level
+        center_i = x_knot_idx * (self.nx - 1) * k
+        center_j = y_knot_idx * (self.ny - 1) * k
+        i_range = range(center_i - self.half_nx * k, center_i + self.half_nx * k + 1)
+        j_range = range(center_j - self.half_ny * k, center_j + self.half_ny * k + 1)
+        return i_range, j_range
+
+    def get_grid_key(self, level, i, j):
+        # The same point on coarser grid has the same key, so f values are shared between levels
+        while level > 0 and i % 2 == 0 and j % 2 == 0:
+            level, i, j = level - 1, i // 2, j // 2
+        return level, i, j
+
+    def build_spline_surface_over_knot(self, x_knot_idx, y_knot_idx, level=0):
+        k = 2 ** level
+        i_range, j_range = self.get_piece_grid(x_knot_idx, y_knot_idx, level)
+        zs = np.zeros((len(i_range), len(j_range)))
+        for (ii, i), (jj, j) in product(enumerate(i_range), enumerate(j_range)):
+            key = self.get_grid_key(level, i, j)
+            if not key in self.f_on_grid_cache:
+                self.f_on_grid_cache[key] = self.f(i * self.dx / k, j * self.dy / k)
+            zs[ii, jj] = self.f_on_grid_cache[key]
+        xs = np.array(i_range) * self.dx / k
+        ys = np.array(j_range) * self.dy / k
+        return RectBivariateSpline(xs, ys, zs, kx=self.degree, ky=self.degree)
+
+    def add_piece(self, knot, level):
+        piece = (level, self.build_spline_surface_over_knot(*knot, level))
+        self.pieces[knot] = piece
+        self.pieces.move_to_end(knot)
+        if self.max_pieces is not None and len(self.pieces) > self.max_pieces:
+            evicted_knot, (evicted_level, _) = self.pieces.popitem(last=False)
+            self.info['evicted'] += 1
+            i_range, j_range = self.get_piece_grid(*evicted_knot, evicted_level)
+            for i, j in product(i_range, j_range):
+                self.f_on_grid_cache.pop(self.get_grid_key(evicted_level, i, j), None)
+        return piece
 
-    def f_caller(x, y):
-        nonlocal info
-        x_knot_idx, y_knot_idx = get_nearest_grid_knot_idxs(x, y)
-        if not (x_knot_idx, y_knot_idx) in covered:
-            info['cache_miss'] += 1
-            surface_piece_spline = build_spline_surface_over_knot(x_knot_idx, y_knot_idx)
-            covered.add((x_knot_idx, y_knot_idx))
-            surface_pieces[(x_knot_idx, y_knot_idx)] = surface_piece_spline
+    def get_piece(self, x, y):
+        knot = self.get_nearest_grid_knot_idxs(x, y)
+        piece = self.pieces.get(knot, None)
+        if piece is None:
+            self.info['cache_miss'] += 1
+            piece = self.add_piece(knot, 0)
         else:
-            info['cache_hit'] += 1
-            surface_piece_spline = surface_pieces[(x_knot_idx, y_knot_idx)]
-        z = surface_piece_spline(x, y)[0]
-        if np.random.uniform() < err_control_rate:
-            z_probe = f(x, y)
-            z_err = abs(z_probe - z)
-            bin = round(np.log2(z_err))
-            info[bin] += 1
-        return z
-    f_caller.info = info
+            self.info['cache_hit'] += 1
+            self.pieces.move_to_end(knot)
+        return knot, piece
+
+    def control_error(self, knot, level, x, y, z):
+        '''
+        :return: f(x, y) if the piece was refined, None otherwise
+        '''
+        if self.random.uniform() >= self.err_control_rate:
+            return None
+        z_probe = self.f(x, y)
+        z_err = abs(z_probe - z)
+        if z_err > 0:
+            self.info[round(np.log2(z_err))] += 1
+        if self.tol is None or z_err <= self.tol or level >= self.max_level:
+            return None
+        self.info['refined'] += 1
+        self.add_piece(knot, level + 1)
+        return z_probe
+
+    def __call__(self, x, y):
+        knot, (level, spline) = self.get_piece(x, y)
+        z = spline(x, y, grid=False) * 1.0
+        z_probe = self.control_error(knot, level, x, y, z)
+        return z if z_probe is None else z_probe
+
+    def value_and_derivative(self, x, y):
+        '''
+        :return: f(x, y) and df/dy
+        '''
+        knot, (level, spline) = self.get_piece(x, y)
+        z = spline(x, y, grid=False) * 1.0
+        z_probe = self.control_error(knot, level, x, y, z)
+        if z_probe is not None:
+            level, spline = self.pieces[knot]
+            z = z_probe
+        return z, spline(x, y, dy=1, grid=False) * 1.0
+
 
-    return f_caller
+def create_lazy_spline_cache_f_wrapper(f, dx=0.1, dy=0.1, half_nx=4, half_ny=4, kind='cubic', err_control_rate=0.001, **kwargs):
+    return LazySplineCache(f, dx=dx, dy=dy, half_nx=half_nx, half_ny=half_ny, kind=kind, err_control_rate=err_control_rate, **kwargs)